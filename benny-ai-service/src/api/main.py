@@ -1,32 +1,80 @@
 """API Server for Benny Wellness AI Endpoints"""
 
-import sys
+import os, sys
 from pathlib import Path
 from contextlib import asynccontextmanager
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field
 import uvicorn
 import asyncio
+import json
+import jwt
 
 sys.path.append(str(Path(__file__).parent.parent))
-from core.benny import BennyWellnessAI
+from core.admission import AdmissionLimiter, Overloaded
+from core.benny import FALLBACKS, TIMEOUTS, BennyMode, BennyWellnessAI
+# bennyDB is on the path once core.benny is imported
+import metrics
+import tracing
+
+# one JSON log line per event, carrying the request id
+tracing.configure_logging()
+log = tracing.get_logger("benny.ai.api")
 
 # initialize benny
 benny = None
 
+
+def mode_limiter(mode: BennyMode, max_concurrent: int, max_queue: int, max_wait: float) -> AdmissionLimiter:
+    """Admission limits for one mode, overridable with BENNY_<MODE>_* env vars"""
+    prefix = f"BENNY_{mode.name}_"
+    return AdmissionLimiter(
+        max_concurrent=int(os.getenv(prefix + "MAX_CONCURRENT", str(max_concurrent))),
+        max_queue=int(os.getenv(prefix + "MAX_QUEUE", str(max_queue))),
+        max_wait=float(os.getenv(prefix + "MAX_WAIT", str(max_wait)))
+    )
+
+
+# In-flight limits per mode, so a spike of one kind of request can't starve the other
+admission = {
+    BennyMode.CHAT: mode_limiter(BennyMode.CHAT, 32, 64, 2.0),
+    BennyMode.RECOMMEND: mode_limiter(BennyMode.RECOMMEND, 32, 128, 2.0)
+}
+
+# What a shed request gets: "reject" is a 429 with Retry-After,
+# "fallback" is the mode's fallback answer straight away
+OVERLOAD_POLICY = {
+    BennyMode.CHAT: os.getenv("BENNY_CHAT_OVERLOAD", "reject"),
+    BennyMode.RECOMMEND: os.getenv("BENNY_RECOMMEND_OVERLOAD", "fallback")
+}
+
+# The backend's SECRET_KEY, so chats can be saved under the user id of its sign-in
+# tokens. Without it every chat is anonymous.
+SECRET_KEY = os.getenv("SECRET_KEY")
+
 # Start Benny
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Initialize Benny when API starts"""
     global benny
     benny = BennyWellnessAI()
-    print("Benny API ready!")
+    if not SECRET_KEY:
+        log.warning("SECRET_KEY not set, chats are saved as anonymous")
+    log.info("benny api ready", llm_provider=benny.provider.name)
     yield
+    await benny.aclose()
 
 app = FastAPI(title="Benny Wellness AI", lifespan=lifespan)
+# request latency and in-flight counts by route, served at /metrics
+app.add_middleware(metrics.http_metrics)
+# X-Request-ID (the backend's, when it sent one) and Server-Timing on every response
+app.add_middleware(tracing.request_tracing)
 
 # Add CORS for React
 app.add_middleware(
@@ -49,12 +97,61 @@ class ChatRequest(BaseModel):
     message: str
 
 
+bearer = HTTPBearer(auto_error=False)
+
+
+def current_user_id(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer)) -> Optional[str]:
+    """
+    User id ("sub") of the caller's sign-in token, None for anonymous callers.
+    Chat history is only saved under an id from a token signed with SECRET_KEY.
+    """
+    if credentials is None or not SECRET_KEY:
+        return None
+    try:
+        return jwt.decode(credentials.credentials, SECRET_KEY, algorithms=["HS256"])["sub"]
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has expired")
+    except (jwt.InvalidTokenError, KeyError):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+
+
 class ChatResponse(BaseModel):
     success: bool
     response: str
     tokens_used: int
     error: Optional[str] = None
 
+@asynccontextmanager
+async def admitted(mode: BennyMode):
+    """Hold a slot from the mode's limiter, the wait shows as "admission" in Server-Timing"""
+    with tracing.span("admission"):
+        ticket = await admission[mode].acquire()
+    try:
+        yield ticket
+    finally:
+        ticket.release()
+
+def overloaded_response(mode: BennyMode, error: Overloaded):
+    """Answer for a request shed by admission control"""
+    if OVERLOAD_POLICY[mode] == "fallback" and benny:
+        FALLBACKS.inc(mode.value, "overloaded")
+        return ChatResponse(
+            success=False,
+            response=benny._get_fallback_response(mode),
+            tokens_used=0,
+            error="overloaded"
+        )
+    return JSONResponse(
+        status_code=429,
+        content=ChatResponse(
+            success=False,
+            response="Benny is busy right now. Try again in a moment.",
+            tokens_used=0,
+            error="overloaded"
+        ).dict(),
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
 class DailyCheckInData(BaseModel):
     nutrition: str
     sleep: str
@@ -64,6 +161,14 @@ class DailyCheckInData(BaseModel):
 class RecommendationRequest(BaseModel):
     daily_checkin: DailyCheckInData
 
+# most check-ins accepted in one /recommend/batch call
+BATCH_MAX_ITEMS = 10000
+
+class BatchRecommendationRequest(BaseModel):
+    checkins: List[DailyCheckInData] = Field(..., max_length=BATCH_MAX_ITEMS)
+    concurrency: Optional[int] = Field(None, ge=1, le=64)
+    tokens_per_minute: Optional[int] = Field(None, ge=100)
+
 # API ENDPOINTS
 @app.get("/")
 async def root():
@@ -73,8 +178,12 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "chat": "/chat",
+            "chat_stream": "/chat/stream",
             "recommend": "/recommend",
+            "recommend_batch": "/recommend/batch",
             "health": "/heath",
+            "stats": "/stats",
+            "metrics": "/metrics",
             "docs": "/docs"
         }
     }
@@ -82,14 +191,65 @@ async def root():
 
 @app.get("/health")
 async def health():
-    """Benny health check"""
-    return {"status": "healthy", "benny_ready": benny is not None}
+    """Benny health check, degraded while the Azure circuit breaker is open"""
+    if not benny:
+        return {"status": "healthy", "benny_ready": False}
+    circuit = benny.breaker.stats()
+    return {
+        "status": "healthy" if circuit["state"] == "closed" else "degraded",
+        "benny_ready": True,
+        "llm_provider": benny.provider.name,
+        "llm_circuit": circuit
+    }
+
+
+@app.get("/stats")
+async def stats():
+    """In-memory counters for monitoring"""
+    if not benny:
+        return {"benny_ready": False}
+    return {
+        "benny_ready": True,
+        "sessions": benny.sessions.stats(),
+        "recommend_cache": benny.recommend_cache.stats(),
+        "in_flight": benny.in_flight.stats(),
+        "admission": {mode.value: limiter.stats() for mode, limiter in admission.items()}
+    }
+
+
+def admission_gauges():
+    """Requests running and waiting per mode, for /metrics"""
+    values = {}
+    for mode, limiter in admission.items():
+        values[(mode.value, "active")] = limiter.active
+        values[(mode.value, "queued")] = limiter.queued
+    return values
+
+
+def circuit_gauges():
+    """1 for the breaker's current state, for /metrics"""
+    if not benny:
+        return {}
+    state = benny.breaker.state
+    return {(name,): int(name == state) for name in ("closed", "open", "half_open")}
+
+
+metrics.REGISTRY.callback_gauge(
+    "benny_admission_requests", "Requests holding or waiting for an admission slot", ("mode", "state"), admission_gauges)
+metrics.REGISTRY.callback_gauge(
+    "benny_llm_circuit_state", "LLM circuit breaker state", ("state",), circuit_gauges)
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus text format: request and LLM latency, tokens, fallbacks, timeouts and time in the database"""
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
 
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, user_id: Optional[str] = Depends(current_user_id)):
     """
-        Chat with Benny
+        Chat with Benny, saved under the signed-in user (Authorization: Bearer <token>)
     """
     # Benny not responding
     if not benny:
@@ -100,9 +260,10 @@ async def chat(request: ChatRequest):
         )
 
     try:
-        # Call benny with timeout
-        result = await asyncio.wait_for(
-            benny.chat(request.message), timeout=30.0)
+        # wait for a slot, then call benny with timeout
+        async with admitted(BennyMode.CHAT):
+            result = await asyncio.wait_for(
+                benny.chat(request.message, user_id), timeout=30.0)
 
         return ChatResponse(
             success=result["success"],
@@ -110,20 +271,85 @@ async def chat(request: ChatRequest):
             tokens_used=result.get("tokens_used", 0),
             error=result.get("error")
         )
+    except Overloaded as e:
+        return overloaded_response(BennyMode.CHAT, e)
     except asyncio.TimeoutError:
+        TIMEOUTS.inc(BennyMode.CHAT.value)
         return ChatResponse(
             success=False,
             response="Benny: I'm thinking extra hard, could you ask me again?",
+            tokens_used=0,
             error="timeout"
         )
     except Exception as e:
-        print(f"Chat error: {e}")
+        log.error("chat failed", error=str(e))
         return ChatResponse(
             success=False,
             response="Benny: Having technical difficulties. Let's try again.",
+            tokens_used=0,
             error=str(e)
         )
     
+def sse_event(data: Dict, event: Optional[str] = None) -> str:
+    """Format one server-sent event"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request,
+                      user_id: Optional[str] = Depends(current_user_id)):
+    """
+        Chat with Benny, streamed as server-sent events.
+        Each piece of the reply is a "data: {"token": ...}" event, followed by
+        one "event: done" with the ChatResponse fields.
+    """
+    ticket = None
+    if benny:
+        # shed before the response starts, so the caller gets a real 429
+        try:
+            with tracing.span("admission"):
+                ticket = await admission[BennyMode.CHAT].acquire()
+        except Overloaded as e:
+            return overloaded_response(BennyMode.CHAT, e)
+
+    async def events():
+        if not benny:
+            yield sse_event({
+                "success": False,
+                "response": "Benny is taking a break. Try again in a moment.",
+                "tokens_used": 0
+            }, event="done")
+            return
+
+        stream = benny.chat_stream(request.message, user_id)
+        try:
+            async for item in stream:
+                # stop early if the browser went away, closing the
+                # generator cancels the upstream Azure request
+                if await http_request.is_disconnected():
+                    break
+                if item["type"] == "token":
+                    yield sse_event({"token": item["text"]})
+                else:
+                    yield sse_event({
+                        "success": item["success"],
+                        "response": item.get("response", ""),
+                        "tokens_used": item.get("tokens_used", 0),
+                        "error": item.get("error")
+                    }, event="done")
+        finally:
+            await stream.aclose()
+            ticket.release()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # also frees the slot if the stream never started
+        background=BackgroundTask(ticket.release) if ticket else None
+    )
+
 @app.post("/recommend", response_model=ChatResponse)
 async def recommend(request: RecommendationRequest):
     """
@@ -136,9 +362,10 @@ async def recommend(request: RecommendationRequest):
             tokens_used=0
         )
     try:
-        # call benny with timeout
-        result = await asyncio.wait_for(
-            benny.recommend(request.daily_checkin.dict(exclude_unset=True)), timeout=30.0)
+        # wait for a slot, then call benny with timeout
+        async with admitted(BennyMode.RECOMMEND):
+            result = await asyncio.wait_for(
+                benny.recommend(request.daily_checkin.dict(exclude_unset=True)), timeout=30.0)
         
         return ChatResponse(
             success=result["success"],
@@ -146,7 +373,10 @@ async def recommend(request: RecommendationRequest):
             tokens_used=result.get("tokens_used", 0),
             error=result.get("error")
         )
+    except Overloaded as e:
+        return overloaded_response(BennyMode.RECOMMEND, e)
     except asyncio.TimeoutError:
+        TIMEOUTS.inc(BennyMode.RECOMMEND.value)
         return ChatResponse(
             success=False,
             response="Benny is thinking extra hard. Try again later",
@@ -154,7 +384,7 @@ async def recommend(request: RecommendationRequest):
             error="timeout"
         )
     except Exception as e:
-        print(f"Recommendation error: {e}")
+        log.error("recommendation failed", error=str(e))
         return ChatResponse(
             success=False,
             response="Benny is having technical difficulties. Try again later",
@@ -162,6 +392,59 @@ async def recommend(request: RecommendationRequest):
             error=str(e)
         )
 
+@app.post("/recommend/batch")
+async def recommend_batch(request: BatchRecommendationRequest, http_request: Request):
+    """
+    Recommendations for many check-ins, streamed as NDJSON.
+    One line per check-in as it completes, in completion order:
+    {"index": ..., "success": ..., "response": ..., "tokens_used": ..., "cached": ..., "error": ...}
+    """
+    async def lines():
+        if not benny:
+            for index in range(len(request.checkins)):
+                yield json.dumps({
+                    "index": index,
+                    "success": False,
+                    "response": "Benny is taking a break. Try again later",
+                    "tokens_used": 0,
+                    "error": "not ready"
+                }) + "\n"
+            return
+
+        options = {}
+        if request.concurrency:
+            options["concurrency"] = request.concurrency
+        if request.tokens_per_minute:
+            options["tokens_per_minute"] = request.tokens_per_minute
+
+        # each check-in takes a slot from the same limiter as /recommend,
+        # ones it sheds come back as fallback answers in the stream
+        results = benny.recommend_many(
+            [checkin.dict(exclude_unset=True) for checkin in request.checkins],
+            limiter=admission[BennyMode.RECOMMEND], **options)
+        try:
+            async for result in results:
+                # stop the remaining LLM calls if the caller went away
+                if await http_request.is_disconnected():
+                    break
+                yield json.dumps({
+                    "index": result["index"],
+                    "success": result["success"],
+                    "response": result.get("response", ""),
+                    "tokens_used": result.get("tokens_used", 0),
+                    "cached": result.get("cached", False),
+                    "error": result.get("error")
+                }) + "\n"
+        finally:
+            await results.aclose()
+
+    limiter = admission[BennyMode.RECOMMEND]
+    if benny and OVERLOAD_POLICY[BennyMode.RECOMMEND] == "reject" and limiter.full():
+        # once streaming starts a shed item can only get the fallback, so refuse up front
+        return overloaded_response(BennyMode.RECOMMEND, Overloaded("queue full", limiter.retry_after()))
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 # RUN SERVER
 
 if __name__ == "__main__":
@@ -0,0 +1,119 @@
+"""Admission control for requests that call the LLM"""
+
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed, retry_after is a hint in whole seconds"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A granted slot, release() is safe to call more than once"""
+
+    def __init__(self, limiter: "AdmissionLimiter", started: float):
+        self.limiter = limiter
+        self.started = started
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter._release(self)
+
+
+class AdmissionLimiter:
+    """
+    At most max_concurrent requests run at once and up to max_queue more wait
+    for a slot, for no longer than max_wait seconds. Anything beyond that is
+    refused straight away with Overloaded, so under a spike requests fail in
+    milliseconds instead of all timing out together.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, max_wait: float,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.clock = clock
+        self.slots = asyncio.Semaphore(max_concurrent)
+
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        # moving average of how long a request holds its slot, for Retry-After
+        self.service_seconds = 1.0
+
+    def full(self) -> bool:
+        """True if acquire() would be refused straight away"""
+        return self.active + self.queued >= self.max_concurrent + self.max_queue
+
+    async def acquire(self) -> Ticket:
+        """Wait for a slot, raises Overloaded if the queue is full or the wait too long"""
+        if self.full():
+            self.rejected += 1
+            raise Overloaded("queue full", self.retry_after())
+
+        started = self.clock()
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise Overloaded("queue wait too long", self.retry_after())
+        finally:
+            self.queued -= 1
+            waited = self.clock() - started
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+        self.active += 1
+        self.admitted += 1
+        return Ticket(self, self.clock())
+
+    @asynccontextmanager
+    async def admit(self):
+        """async with limiter.admit(): ... holds a slot for the block"""
+        ticket = await self.acquire()
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def retry_after(self) -> int:
+        """Seconds until the current queue has probably drained"""
+        backlog = (self.queued + self.active) / self.max_concurrent
+        return max(1, math.ceil(backlog * self.service_seconds))
+
+    def stats(self) -> Dict:
+        """Counters for monitoring"""
+        waits = self.admitted + self.timed_out
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_ms": round(self.wait_seconds_total / waits * 1000, 3) if waits else 0.0,
+            "max_wait_ms": round(self.wait_seconds_max * 1000, 3)
+        }
+
+    def _release(self, ticket: Ticket):
+        held = self.clock() - ticket.started
+        self.service_seconds = 0.8 * self.service_seconds + 0.2 * held
+        self.active -= 1
+        self.slots.release()
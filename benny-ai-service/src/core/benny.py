@@ -1,26 +1,86 @@
 """Benny - Wellness AI"""
 
 import os, sys
+import asyncio
+import time
 from datetime import datetime
-from typing import Dict, Optional
+from typing import AsyncIterator, Dict, List, Optional
 from enum import Enum
 from pathlib import Path
 
-from openai import AzureOpenAI
 from dotenv import load_dotenv
 
 # import db
 sys.path.append(str(Path(__file__).parent.parent.parent.parent / "bennyDB"))
-import db_connector_real
+import db_async
+from db_connector_real import ANONYMOUS_USER
+from metrics import REGISTRY
+import tracing
+
+from .admission import AdmissionLimiter, Overloaded
+from .context import estimate_tokens, fit_history, message_tokens, summary_message, transcript
+from .providers import LLMProvider, create_provider
+from .resilience import CircuitBreaker, CircuitOpen, call_with_retries, is_retryable
+from .recommend_cache import RecommendationCache, checkin_key, normalize_checkin
+from .sessions import SessionStore
+from .single_flight import SingleFlight, request_fingerprint
+from .token_budget import TokenBudget
 
 # Load environment variables
 load_dotenv()
 
+# Retries of transient Azure errors (429, 5xx, connection), all within LLM_DEADLINE
+# seconds, and the circuit breaker that stops calling Azure while it keeps failing
+LLM_MAX_ATTEMPTS = int(os.getenv("BENNY_LLM_MAX_ATTEMPTS", "3"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("BENNY_LLM_RETRY_BASE_DELAY", "0.25"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("BENNY_LLM_RETRY_MAX_DELAY", "4"))
+LLM_DEADLINE = float(os.getenv("BENNY_LLM_DEADLINE", "25"))
+BREAKER_FAILURES = int(os.getenv("BENNY_BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.getenv("BENNY_BREAKER_RESET", "30"))
+
+# Per-user conversation history, bounded so memory stays flat over time
+SESSION_MAX_MESSAGES = int(os.getenv("BENNY_SESSION_MAX_MESSAGES", "20"))
+SESSION_MAX_SESSIONS = int(os.getenv("BENNY_SESSION_MAX_SESSIONS", "10000"))
+SESSION_MAX_BYTES = int(os.getenv("BENNY_SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_TTL = float(os.getenv("BENNY_SESSION_TTL", "3600"))
+
+# Chat prompt size: recent turns fill CONTEXT_TOKENS newest first, older turns
+# are folded into a rolling summary once SUMMARY_BATCH of them have piled up
+CONTEXT_TOKENS = int(os.getenv("BENNY_CONTEXT_TOKENS", "1200"))
+SUMMARY_BATCH = int(os.getenv("BENNY_SUMMARY_BATCH", "4"))
+
+# Recommendations for identical check-ins, a size of 0 turns the cache off
+RECOMMEND_CACHE_SIZE = int(os.getenv("BENNY_RECOMMEND_CACHE_SIZE", "1024"))
+RECOMMEND_CACHE_VARIANTS = int(os.getenv("BENNY_RECOMMEND_CACHE_VARIANTS", "3"))
+RECOMMEND_CACHE_TTL = float(os.getenv("BENNY_RECOMMEND_CACHE_TTL", str(24 * 3600)))
+RECOMMEND_CACHE_PATH = os.getenv("BENNY_RECOMMEND_CACHE_PATH") or None
+
+# Batch recommendations: parallel LLM calls per batch (default and most a caller may ask
+# for) and the tokens per minute all batches in this process share
+BATCH_CONCURRENCY = int(os.getenv("BENNY_BATCH_CONCURRENCY", "8"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BENNY_BATCH_MAX_CONCURRENCY", "16"))
+BATCH_TOKENS_PER_MINUTE = int(os.getenv("BENNY_BATCH_TOKENS_PER_MINUTE", "60000"))
+BATCH_ITEM_TIMEOUT = float(os.getenv("BENNY_BATCH_ITEM_TIMEOUT", "30"))
+
+
+log = tracing.get_logger("benny.ai")
+
+# Prometheus metrics, served by the API at /metrics
+LLM_SECONDS = REGISTRY.histogram(
+    "benny_llm_request_duration_seconds",
+    "Time until the model answered, including retries (first chunk when streaming)", ("mode", "outcome"))
+LLM_IN_FLIGHT = REGISTRY.gauge("benny_llm_requests_in_flight", "Model requests waiting for an answer", ("mode",))
+LLM_TOKENS = REGISTRY.counter("benny_llm_tokens_total", "tokens_used reported by the model", ("mode",))
+FALLBACKS = REGISTRY.counter(
+    "benny_fallback_responses_total", "Requests answered with the mode's fallback", ("mode", "reason"))
+TIMEOUTS = REGISTRY.counter("benny_timeouts_total", "Requests that ran out of time", ("mode",))
+
 
 class BennyMode(Enum):
     """Different response styles for Benny"""
     CHAT = "chat"
     RECOMMEND = "recommend"
+    SUMMARY = "summary"
  
 
 class BennyWellnessAI:
@@ -62,41 +122,79 @@ class BennyWellnessAI:
             """,
             "max_tokens": 50,
             "temperature": 0.4,
+        },
+        BennyMode.SUMMARY: {
+            "prompt": """
+            You keep a running summary of a wellness coaching chat.
+            Update the summary with the new lines of conversation.
+            Keep the user's goals, habits, struggles and anything Benny
+            recommended. Write at most 80 words in the third person.
+            """,
+            "max_tokens": 120,
+            "temperature": 0.2
         }
     }
 
-    def __init__(self):
-        """Initialize Benny with Azure OpenAI"""
+    def __init__(self, provider: Optional[LLMProvider] = None,
+                 db: Optional[db_async.async_sharded_wellness_ai_db] = None,
+                 recommend_cache: Optional[RecommendationCache] = None):
+        """
+        Initialize Benny
+        Args:
+            provider: model backend, by default the one named by
+                BENNY_LLM_PROVIDER ("azure", or "stub" for offline load tests)
+            db: database chats are saved to, by default the bennyDB shards next to BENNY_DB_PATH
+            recommend_cache: by default one sized from the BENNY_RECOMMEND_CACHE_* settings
+        """
 
         # Get configuration from environment
-        self.endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        self.api_key = os.getenv("AZURE_OPENAI_API_KEY")
         self.deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT", "gpt-35-turbo")
 
-        # Validate configuration
-        if not self.endpoint or not self.api_key:
-            raise ValueError("Missing Azure OpenAI credentials")
-        
-        # Initialize Azure OpenAI client
-        self.client = AzureOpenAI(
-            azure_endpoint=self.endpoint,
-            api_key=self.api_key,
-            api_version="2025-01-01-preview"
+        # model backend, Azure raises ValueError here if its credentials are missing
+        self.provider = provider or create_provider()
+        # what requests are sent through, anything with the OpenAI client surface
+        self.client = self.provider
+        self.breaker = CircuitBreaker(
+            failure_threshold=BREAKER_FAILURES,
+            reset_timeout=BREAKER_RESET
         )
 
-        # conversation tracking
-        self.conversation_history = []
+        # conversation tracking, one bounded history per user
+        self.sessions = SessionStore(
+            max_messages=SESSION_MAX_MESSAGES,
+            max_sessions=SESSION_MAX_SESSIONS,
+            max_bytes=SESSION_MAX_BYTES,
+            ttl_seconds=SESSION_TTL
+        )
+
+        # recommendations already generated for the same normalized check-in
+        self.recommend_cache = recommend_cache or RecommendationCache(
+            max_keys=RECOMMEND_CACHE_SIZE,
+            variants=RECOMMEND_CACHE_VARIANTS,
+            ttl_seconds=RECOMMEND_CACHE_TTL,
+            path=RECOMMEND_CACHE_PATH
+        )
+
+        # identical requests already on their way to Azure, shared by later callers
+        self.in_flight = SingleFlight()
+
+        # background summary refreshes, one per user at a time
+        self.summary_tasks: Dict[str, asyncio.Task] = {}
 
-        # db connection
-        self.db = db_connector_real.wellness_ai_db()
+        # token rate shared by every batch, so concurrent batches can't multiply it
+        self.batch_budget = TokenBudget(BATCH_TOKENS_PER_MINUTE)
+
+        # db connection, each chat goes to its user's shard on that shard's worker threads
+        self.db = db or db_async.async_sharded_wellness_ai_db()
         
-        print("Benny initialized successful!")
+        log.info("benny initialized", llm_provider=self.provider.name)
 
-    async def chat(self, message: str) -> Dict: 
+    async def chat(self, message: str, user_id: Optional[str] = None) -> Dict: 
         """
         Chat with Benny
         Args:
             message: User's message
+            user_id: Who the chat is saved under, anonymous if not given
         
         Returns: 
             Response dictionary with chat response
@@ -104,36 +202,28 @@ class BennyWellnessAI:
         # Generate response
         response = await self._generate_response(
             message=message,
-            mode=BennyMode.CHAT
+            mode=BennyMode.CHAT,
+            user_id=user_id
         )
         # save chat to db
         if response["success"]:
-            await self._save_chat_to_db(message, response["response"])
+            await self._save_chat_to_db(message, response["response"], user_id)
 
         return response
     
-    async def _save_chat_to_db(self, user_message: str, benny_response: str):
+    async def _save_chat_to_db(self, user_message: str, benny_response: str,
+                               user_id: Optional[str] = None):
         """Save chat to database"""
+        user_id = user_id or ANONYMOUS_USER
         try:
-            today = datetime.now().strftime("%m/%d/%Y")
-
-            # check if chat exists today, if not create
-            existing_chat = self.db.fetch_main_chat_history_pk(today)
-            if not existing_chat:
-                self.db.insert_row_chat_history_main(today)
-                # refetch
-                existing_chat = self.db.fetch_main_chat_history_pk(today)
-            
-            # get number of entries
-            existing_entries = self.db.fetch_chat_logs_by_date(today)
-            seq_num = len(existing_entries) + 1
-
-            self.db.add_chat_entry(today, seq_num, 0, user_message)
-            self.db.add_chat_entry(today, seq_num + 1, 1, benny_response)
-            print("Chat saved to Database")
+            today = datetime.now().date().isoformat()
+            # parent row, sequence numbers and both entries in one transaction on the user's shard
+            await self.db.write(user_id, "append_chat_exchange", user_id,
+                                today, user_message, benny_response)
+            log.debug("chat saved", user_id=user_id)
         
         except Exception as e:
-            print(f"Error saving to database: {e}")
+            log.error("chat not saved", user_id=user_id, error=str(e))
     
     async def recommend(self, daily_checkin: Dict) -> Dict:
         """
@@ -142,9 +232,24 @@ class BennyWellnessAI:
             daily_checkin: Dict with keys:
                 nutrition, fitness, stress, sleep
 
-        Returns: Response dictionary with one-sentence recommendation
+        Returns: Response dictionary with one-sentence recommendation,
+            "cached" is True when it was served without calling the model
         """
-        checkin_message = self._format_checkin(daily_checkin)
+        # identical check-ins share answers, so prompt with the normalized one
+        key = checkin_key(daily_checkin)
+        with tracing.span("cache"):
+            cached = self.recommend_cache.get(key)
+        if cached is not None:
+            return {
+                "success": True,
+                "response": cached[0],
+                "mode": BennyMode.RECOMMEND.value,
+                "tokens_used": 0,
+                "cached": True,
+                "timestamp": datetime.now().isoformat()
+            }
+
+        checkin_message = self._format_checkin(normalize_checkin(daily_checkin))
 
         benny_prompt = f"""
         Here is today's check in Data: 
@@ -156,11 +261,100 @@ class BennyWellnessAI:
         Keep the suggestion short, to one actionable sentence and remain positive.
         """
 
-        return await self._generate_response(
+        response = await self._generate_response(
             message=benny_prompt,
             mode=BennyMode.RECOMMEND
         )
+        # only the call that went to the model stores its answer, callers that
+        # shared it would fill the variant slots with copies of the same sentence
+        if response["success"] and not response["shared"]:
+            self.recommend_cache.put(key, response["response"], response["tokens_used"])
+        response["cached"] = False
+        return response
     
+    async def recommend_many(self, checkins: List[Dict],
+                             concurrency: Optional[int] = None,
+                             tokens_per_minute: Optional[int] = None,
+                             timeout: float = BATCH_ITEM_TIMEOUT,
+                             limiter: Optional[AdmissionLimiter] = None) -> AsyncIterator[Dict]:
+        """
+        Recommendations for many check-ins, yielded as each one completes
+        Args:
+            checkins: list of daily check-in dicts, as for recommend()
+            concurrency: most LLM calls in flight at once, BATCH_CONCURRENCY by
+                default and never more than BATCH_MAX_CONCURRENCY
+            tokens_per_minute: a lower token rate for this batch, every batch
+                also draws on the shared BATCH_TOKENS_PER_MINUTE budget
+            timeout: seconds allowed for each recommendation
+            limiter: admission limiter each item takes a slot from, the same
+                one /recommend uses, items it sheds get the fallback answer
+
+        Yields:
+            {"index": position in checkins, ...same fields as recommend()}.
+            Check-ins that normalize the same are only sent once and their
+            results yielded together, a failed item doesn't stop the batch.
+        """
+        # one job per distinct check-in, remembering every index that asked for it
+        groups: Dict[str, List[int]] = {}
+        for index, checkin in enumerate(checkins):
+            groups.setdefault(checkin_key(checkin), []).append(index)
+
+        # callers can only ask for less than the server-side limits
+        concurrency = min(concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+        budgets = [self.batch_budget]
+        if tokens_per_minute and tokens_per_minute < BATCH_TOKENS_PER_MINUTE:
+            # this batch's own pace first, so it never holds shared tokens while it waits
+            budgets.insert(0, TokenBudget(tokens_per_minute))
+        estimate = self._estimate_tokens(BennyMode.RECOMMEND)
+        jobs: asyncio.Queue = asyncio.Queue()
+        for indexes in groups.values():
+            jobs.put_nowait(indexes)
+        results: asyncio.Queue = asyncio.Queue()
+
+        async def worker():
+            while not jobs.empty():
+                indexes = jobs.get_nowait()
+                for budget in budgets:
+                    await budget.reserve(estimate)
+                try:
+                    ticket = await limiter.acquire() if limiter else None
+                except Overloaded:
+                    result = self._failed_response(BennyMode.RECOMMEND, "overloaded", "overloaded")
+                else:
+                    try:
+                        result = await asyncio.wait_for(
+                            self.recommend(checkins[indexes[0]]), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        result = self._failed_response(BennyMode.RECOMMEND, "timeout", "timeout")
+                    except Exception as e:
+                        result = self._failed_response(BennyMode.RECOMMEND, str(e))
+                    finally:
+                        if ticket:
+                            ticket.release()
+                for budget in budgets:
+                    budget.settle(estimate, result.get("tokens_used", 0))
+                for position, index in enumerate(indexes):
+                    # tokens are reported once for the group
+                    tokens = result.get("tokens_used", 0) if position == 0 else 0
+                    await results.put(dict(result, index=index, tokens_used=tokens))
+
+        workers = [asyncio.create_task(worker())
+                   for _ in range(max(1, min(concurrency, len(groups))))]
+        try:
+            for _ in range(len(checkins)):
+                yield await results.get()
+        finally:
+            # the caller stopped early, or everything is done
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def _estimate_tokens(self, mode: BennyMode) -> int:
+        """Rough tokens one request in this mode uses, prompt plus the longest reply"""
+        config = self.MODE[mode]
+        prompt = self.BASE_PERSONALITY + config["prompt"]
+        return estimate_tokens(prompt) + 150 + config["max_tokens"]
+
     def _format_checkin(self, daily_checkin: Dict) -> str:
         """Format daily checkin-data to send to ai"""
         message = ""
@@ -177,60 +371,245 @@ class BennyWellnessAI:
         
         return message
 
-    async def _generate_response(self, message: str, mode: BennyMode) -> Dict:
-        """Internal method to generate response response"""
+    def _build_messages(self, message: str, mode: BennyMode,
+                        user_id: Optional[str] = None) -> List[Dict]:
+        """System prompt, the user's recent history for chat mode and the new message"""
+        # get the system prompt for this mode
+        config = self.MODE[mode]
+        system_prompt = self.BASE_PERSONALITY + config["prompt"]
 
+        # Build messages for API call
+        messages = [{"role": "system", "content": system_prompt}]
+
+        # add convo history for conversational mode, as many recent turns as
+        # fit in the token budget, older ones are covered by the summary
+        new_message = {"role": "user", "content": message}
+        if mode == BennyMode.CHAT:
+            key = user_id or ANONYMOUS_USER
+            summary, history = self.sessions.context(key)
+            if summary:
+                messages.append(summary_message(summary))
+            budget = CONTEXT_TOKENS - sum(message_tokens(m) for m in messages) - message_tokens(new_message)
+            keep = fit_history(history, budget)
+            self.sessions.retire(key, len(history) - keep)
+            messages.extend(history[len(history) - keep:])
+
+        messages.append(new_message)
+        return messages
+
+    def _completion_params(self, mode: BennyMode) -> Dict:
+        """Sampling settings sent with every request for this mode"""
+        config = self.MODE[mode]
+        return {
+            "model": self.deployment,
+            "max_tokens": config["max_tokens"],
+            "temperature": config["temperature"],
+            "top_p": 0.9,
+            "frequency_penalty": 0.3,
+            "presence_penalty": 0.2
+        }
+
+    def _record_exchange(self, message: str, benny_response: str, mode: BennyMode,
+                         user_id: Optional[str] = None):
+        """Update the user's conversation history after a completed chat reply"""
+        if mode == BennyMode.CHAT:
+            key = user_id or ANONYMOUS_USER
+            self.sessions.append(
+                key,
+                {"role": "user", "content": message},
+                {"role": "assistant", "content": benny_response}
+            )
+            self._schedule_summary(key)
+
+    def _schedule_summary(self, key: str):
+        """Refresh the user's rolling summary in the background once enough turns are retired"""
+        if key in self.summary_tasks or len(self.sessions.pending(key)[1]) < SUMMARY_BATCH:
+            return
+        task = asyncio.create_task(self._refresh_summary(key))
+        self.summary_tasks[key] = task
+        task.add_done_callback(lambda _: self.summary_tasks.pop(key, None))
+
+    async def _refresh_summary(self, key: str):
+        """Fold the user's retired messages into their summary, off the request path"""
+        summary, pending = self.sessions.pending(key)
+        prompt = f"Current summary: {summary or 'none yet'}\n\nNew lines:\n{transcript(pending)}"
+        messages = [
+            {"role": "system", "content": self.MODE[BennyMode.SUMMARY]["prompt"]},
+            {"role": "user", "content": prompt}
+        ]
         try:
-            # get the system prompt for this mode
-            config = self.MODE[mode]
-            system_prompt = self.BASE_PERSONALITY + config["prompt"]
+            new_summary, _ = await self._complete(messages, self._completion_params(BennyMode.SUMMARY),
+                                                  BennyMode.SUMMARY)
+            self.sessions.set_summary(key, new_summary, pending)
+        except Exception as e:
+            # keep the old summary, the messages stay pending for the next try
+            log.warning("summary not refreshed", user_id=key, error=str(e))
 
-            # Build messages for API call
-            messages = [{"role": "system", "content": system_prompt}]
+    async def _create(self, mode: BennyMode, **kwargs):
+        """chat.completions.create with retries, raises CircuitOpen while Azure is failing"""
+        started = time.perf_counter()
+        outcome = "error"
+        LLM_IN_FLIGHT.inc(mode.value)
+        try:
+            with tracing.span("llm"):
+                response = await call_with_retries(
+                    lambda: self.client.chat.completions.create(**kwargs),
+                    self.breaker,
+                    max_attempts=LLM_MAX_ATTEMPTS,
+                    base_delay=LLM_RETRY_BASE_DELAY,
+                    max_delay=LLM_RETRY_MAX_DELAY,
+                    deadline=time.monotonic() + LLM_DEADLINE
+                )
+            outcome = "ok"
+            return response
+        except CircuitOpen:
+            outcome = "circuit_open"
+            raise
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except Exception as e:
+            log.warning("llm request failed", mode=mode.value, error=str(e),
+                        elapsed_ms=round((time.perf_counter() - started) * 1000, 3))
+            raise
+        finally:
+            LLM_IN_FLIGHT.dec(mode.value)
+            LLM_SECONDS.observe(time.perf_counter() - started, mode.value, outcome)
 
-            # add convo history for conversational mode (10 tokens)
-            if mode == BennyMode.CHAT and self.conversation_history:
-                messages.extend(self.conversation_history[-10:])
-            
-            messages.append({"role": "user", "content": message})
+    async def _complete(self, messages: List[Dict], params: Dict, mode: BennyMode):
+        """One completion request, returns (reply text, total tokens)"""
+        response = await self._create(
+            mode,
+            messages=messages,
+            **params
+        )
+        LLM_TOKENS.inc(mode.value, amount=response.usage.total_tokens)
+        return response.choices[0].message.content.strip(), response.usage.total_tokens
+
+    async def _generate_response(self, message: str, mode: BennyMode,
+                                 user_id: Optional[str] = None) -> Dict:
+        """Internal method to generate response response"""
+
+        try:
+            messages = self._build_messages(message, mode, user_id)
+            params = self._completion_params(mode)
             
-            # Generate response
-            response = self.client.chat.completions.create(
-                model=self.deployment,
-                messages=messages,
-                max_tokens=config["max_tokens"],
-                temperature=config["temperature"],
-                top_p=0.9,
-                frequency_penalty=0.3,
-                presence_penalty=0.2
+            # Generate response, callers sending the same prompt at the
+            # same time share one upstream call
+            (benny_response, tokens_used), shared = await self.in_flight.run(
+                request_fingerprint(messages, params),
+                lambda: self._complete(messages, params, mode)
             )
             
-            benny_response = response.choices[0].message.content.strip()
-            
             # Update conversation history
-            if mode == BennyMode.CHAT:
-                self.conversation_history.extend([
-                    {"role": "user", "content": message},
-                    {"role": "assistant", "content": benny_response}
-                ])
+            self._record_exchange(message, benny_response, mode, user_id)
             
             return {
                 "success": True,
                 "response": benny_response,
                 "mode": mode.value,
-                "tokens_used": response.usage.total_tokens,
+                # tokens are only counted for the caller that made the call
+                "tokens_used": 0 if shared else tokens_used,
+                "shared": shared,
                 "timestamp": datetime.now().isoformat()
             }
             
+        except CircuitOpen as e:
+            return self._failed_response(mode, str(e), "circuit_open")
         except Exception as e:
-            return {
-                "success": False,
-                "error": str(e),
-                "mode": mode.value,
-                "response": self._get_fallback_response(mode),
-                "timestamp": datetime.now().isoformat()
-            }
+            return self._failed_response(mode, str(e))
+
+    def _failed_response(self, mode: BennyMode, error: str, reason: str = "error") -> Dict:
+        """Response dictionary with the mode's fallback answer, counted under reason"""
+        FALLBACKS.inc(mode.value, reason)
+        if reason == "timeout":
+            TIMEOUTS.inc(mode.value)
+        return {
+            "success": False,
+            "error": error,
+            "mode": mode.value,
+            "response": self._get_fallback_response(mode),
+            "tokens_used": 0,
+            "timestamp": datetime.now().isoformat()
+        }
    
+    async def chat_stream(self, message: str,
+                          user_id: Optional[str] = None) -> AsyncIterator[Dict]:
+        """
+        Chat with Benny, yielding the reply as it is generated
+        Args:
+            message: User's message
+            user_id: Who the chat is saved under, anonymous if not given
+
+        Yields:
+            {"type": "token", "text": ...} for each piece of the reply, then one
+            {"type": "done", ...} with the same fields chat() returns.
+            History and the database are only updated once the reply is complete;
+            closing the generator early, or the reply taking longer than
+            LLM_DEADLINE, cancels the upstream request.
+        """
+        mode = BennyMode.CHAT
+        stream = None
+        pieces = []
+        tokens_used = 0
+        # the whole reply gets LLM_DEADLINE, so an upstream that keeps trickling
+        # chunks can't hold the admission slot and the connection forever
+        deadline = time.monotonic() + LLM_DEADLINE
+
+        try:
+            stream = await self._create(
+                mode,
+                messages=self._build_messages(message, mode, user_id),
+                stream=True,
+                stream_options={"include_usage": True},
+                **self._completion_params(mode)
+            )
+            chunks = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=max(0.0, deadline - time.monotonic()))
+                except StopAsyncIteration:
+                    break
+                if chunk.usage:
+                    tokens_used = chunk.usage.total_tokens
+                if not chunk.choices:
+                    continue
+                text = chunk.choices[0].delta.content
+                if text:
+                    pieces.append(text)
+                    yield {"type": "token", "text": text}
+
+        except asyncio.TimeoutError:
+            yield dict(self._failed_response(mode, "timeout", "timeout"), type="done")
+            return
+
+        except Exception as e:
+            if stream is not None and is_retryable(e):
+                # failed part way through, creating the stream already counted as a success
+                self.breaker.record_failure()
+            reason = "circuit_open" if isinstance(e, CircuitOpen) else "error"
+            yield dict(self._failed_response(mode, str(e), reason), type="done")
+            return
+
+        finally:
+            # runs on normal completion and when the client goes away mid-stream
+            if stream is not None:
+                await stream.close()
+
+        benny_response = "".join(pieces).strip()
+        LLM_TOKENS.inc(mode.value, amount=tokens_used)
+        self._record_exchange(message, benny_response, mode, user_id)
+        await self._save_chat_to_db(message, benny_response, user_id)
+
+        yield {
+            "type": "done",
+            "success": True,
+            "response": benny_response,
+            "mode": mode.value,
+            "tokens_used": tokens_used,
+            "timestamp": datetime.now().isoformat()
+        }
+
     def _get_fallback_response(self, mode: BennyMode) -> str:
         """default response for each mode"""
 
@@ -243,7 +622,17 @@ class BennyWellnessAI:
 
         return fallbacks[mode]
 
-    def clear_conversation(self):
-        """Clear conversation history"""
-        self.conversation_history = []
+    async def aclose(self):
+        """Close the model backend's connections and the database"""
+        for task in list(self.summary_tasks.values()):
+            task.cancel()
+        await self.client.close()
+        if self.provider is not self.client:
+            await self.provider.close()
+        self.db.close()
+        self.recommend_cache.close()
+
+    def clear_conversation(self, user_id: Optional[str] = None):
+        """Clear one user's conversation history, or everyone's"""
+        self.sessions.clear(user_id)
         return {"success": True, "message": "Conversation history cleared"}
\ No newline at end of file
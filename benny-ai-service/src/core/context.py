@@ -0,0 +1,49 @@
+"""Token-budgeted prompt context for Benny chat mode"""
+
+import math
+from typing import Dict, List
+
+# average characters per token for English text with GPT tokenizers
+CHARS_PER_TOKEN = 4
+
+# tokens the chat format adds around every message (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Fast local token estimate, no tokenizer needed.
+    Slightly generous for English so a full prompt stays under the budget.
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def message_tokens(message: Dict) -> int:
+    """Estimated tokens for one {"role", "content"} message"""
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def fit_history(history: List[Dict], budget: int) -> int:
+    """
+    How many of the newest messages in history fit in budget tokens,
+    filling from newest to oldest and stopping at the first that doesn't fit
+    """
+    used = 0
+    count = 0
+    for message in reversed(history):
+        used += message_tokens(message)
+        if used > budget:
+            break
+        count += 1
+    return count
+
+
+def summary_message(summary: str) -> Dict:
+    """System message carrying the rolling summary of older turns"""
+    return {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+
+
+def transcript(messages: List[Dict]) -> str:
+    """Messages as plain "User: ..." / "Benny: ..." lines for the summarizer"""
+    speakers = {"user": "User", "assistant": "Benny"}
+    return "\n".join(f"{speakers.get(m['role'], m['role'])}: {m['content']}" for m in messages)
@@ -0,0 +1,256 @@
+"""LLM backends for Benny"""
+
+import abc
+import asyncio
+import hashlib
+import math
+import os
+import random
+import time
+from collections import deque
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+import httpx
+from openai import AsyncAzureOpenAI
+
+from .context import estimate_tokens
+
+# Connection pool for the Azure client, shared by every request
+LLM_MAX_CONNECTIONS = int(os.getenv("BENNY_LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.getenv("BENNY_LLM_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("BENNY_LLM_KEEPALIVE_EXPIRY", "30"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("BENNY_LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("BENNY_LLM_READ_TIMEOUT", "30"))
+
+
+class LLMProvider(abc.ABC):
+    """
+    What Benny needs from a model backend: the OpenAI client surface.
+
+    provider.chat.completions.create(messages=..., model=..., stream=..., ...)
+    returns a completion, or an async iterator of chunks when stream=True, and
+    close() releases connections. Errors should carry status_code (and
+    response.headers for Retry-After) like openai.APIStatusError so the retry
+    layer can tell transient failures apart.
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    @abc.abstractmethod
+    async def create(self, **kwargs):
+        """One chat completion, the arguments of chat.completions.create"""
+
+    async def close(self):
+        pass
+
+
+class AzureProvider(LLMProvider):
+    """Azure OpenAI over a pooled, long-lived HTTP client"""
+
+    name = "azure"
+
+    def __init__(self):
+        self.endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+        self.api_key = os.getenv("AZURE_OPENAI_API_KEY")
+
+        # Validate configuration
+        if not self.endpoint or not self.api_key:
+            raise ValueError("Missing Azure OpenAI credentials")
+
+        # async so a request in flight doesn't block the event loop
+        # and can be cancelled on timeout
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+        )
+        self.client = AsyncAzureOpenAI(
+            azure_endpoint=self.endpoint,
+            api_key=self.api_key,
+            api_version="2025-01-01-preview",
+            http_client=self.http_client,
+            # retries are done by call_with_retries, which knows about the breaker
+            max_retries=0
+        )
+        self.chat = self.client.chat
+
+    async def create(self, **kwargs):
+        return await self.client.chat.completions.create(**kwargs)
+
+    async def close(self):
+        await self.client.close()
+        await self.http_client.aclose()
+
+
+class StubAPIError(Exception):
+    """Injected failure, shaped like openai.APIStatusError"""
+
+    def __init__(self, status_code: int, message: str, headers: Optional[Dict] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+# replies the stub picks from, by hash of the prompt so the same prompt gets the same reply
+STUB_REPLIES = [
+    "Try a 10-minute walk after lunch to lift your energy and ease stress.",
+    "Aim for lights out by 10:30 tonight and keep your phone outside the bedroom.",
+    "Add one serving of vegetables to dinner, half the plate is a good target.",
+    "Take five slow breaths, in for four seconds and out for six, before your next meeting.",
+    "Drink a glass of water with each meal to stay hydrated through the day.",
+]
+
+
+class StubStream:
+    """Streams a reply word by word, like the chunks of a real stream"""
+
+    def __init__(self, words: List[str], usage, first_token_delay: float,
+                 token_delay: float, include_usage: bool):
+        self.words = words
+        self.usage = usage
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.include_usage = include_usage
+        self.closed = False
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.first_token_delay)
+        for position, word in enumerate(self.words):
+            if self.closed:
+                return
+            if position:
+                await asyncio.sleep(self.token_delay)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word))], usage=None)
+        if self.include_usage:
+            yield SimpleNamespace(choices=[], usage=self.usage)
+
+    async def close(self):
+        self.closed = True
+
+
+class StubProvider(LLMProvider):
+    """
+    Local stand-in for Azure, for load tests and benchmarks without a network.
+
+    Latency is drawn from a fixed, uniform or lognormal distribution around
+    latency_ms, streams send one word every token_ms. error_rate of the
+    requests fail with a 500, and more than rate_limit_rpm requests in any
+    minute get a 429 with Retry-After. With a seed the random choices repeat
+    run to run.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency_ms: float = 300, latency_jitter_ms: float = 100,
+                 distribution: str = "lognormal", token_ms: float = 15,
+                 error_rate: float = 0.0, rate_limit_rpm: int = 0,
+                 seed: Optional[int] = None):
+        super().__init__()
+        if distribution not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.distribution = distribution
+        self.token_ms = token_ms
+        self.error_rate = error_rate
+        self.rate_limit_rpm = rate_limit_rpm
+        self.random = random.Random(seed)
+
+        self.requests = deque()     # start times within the last minute
+        self.calls = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    @classmethod
+    def from_env(cls) -> "StubProvider":
+        seed = os.getenv("BENNY_STUB_SEED")
+        return cls(
+            latency_ms=float(os.getenv("BENNY_STUB_LATENCY_MS", "300")),
+            latency_jitter_ms=float(os.getenv("BENNY_STUB_LATENCY_JITTER_MS", "100")),
+            distribution=os.getenv("BENNY_STUB_LATENCY_DISTRIBUTION", "lognormal"),
+            token_ms=float(os.getenv("BENNY_STUB_TOKEN_MS", "15")),
+            error_rate=float(os.getenv("BENNY_STUB_ERROR_RATE", "0")),
+            rate_limit_rpm=int(os.getenv("BENNY_STUB_RATE_LIMIT_RPM", "0")),
+            seed=int(seed) if seed else None
+        )
+
+    async def create(self, messages: List[Dict], max_tokens: int = 150,
+                     stream: bool = False, stream_options: Optional[Dict] = None, **params):
+        self.calls += 1
+        self._check_rate_limit()
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            raise StubAPIError(500, "Injected upstream error")
+
+        reply = self._reply(messages, max_tokens)
+        prompt_tokens = sum(estimate_tokens(m["content"]) for m in messages)
+        completion_tokens = estimate_tokens(reply)
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                total_tokens=prompt_tokens + completion_tokens)
+        latency = self._latency()
+
+        if stream:
+            words = [word + " " for word in reply.split()]
+            words[-1] = words[-1].rstrip()
+            return StubStream(words, usage, latency, self.token_ms / 1000,
+                              bool(stream_options and stream_options.get("include_usage")))
+
+        await asyncio.sleep(latency)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=reply))],
+            usage=usage
+        )
+
+    def stats(self) -> Dict:
+        return {"calls": self.calls, "errors": self.errors, "rate_limited": self.rate_limited}
+
+    def _check_rate_limit(self):
+        if not self.rate_limit_rpm:
+            return
+        now = time.monotonic()
+        while self.requests and now - self.requests[0] >= 60:
+            self.requests.popleft()
+        if len(self.requests) >= self.rate_limit_rpm:
+            self.rate_limited += 1
+            wait = math.ceil(60 - (now - self.requests[0]))
+            raise StubAPIError(429, "Injected rate limit", {"retry-after": str(wait)})
+        self.requests.append(now)
+
+    def _latency(self) -> float:
+        """Seconds until the reply (or the first streamed word)"""
+        if self.latency_ms <= 0:
+            return 0.0
+        if self.distribution == "fixed":
+            latency = self.latency_ms
+        elif self.distribution == "uniform":
+            latency = self.random.uniform(self.latency_ms - self.latency_jitter_ms,
+                                          self.latency_ms + self.latency_jitter_ms)
+        else:
+            # lognormal with this mean and standard deviation, a long right tail like real APIs
+            sigma2 = math.log(1 + (self.latency_jitter_ms / self.latency_ms) ** 2)
+            latency = self.random.lognormvariate(math.log(self.latency_ms) - sigma2 / 2, math.sqrt(sigma2))
+        return max(0.0, latency) / 1000
+
+    def _reply(self, messages: List[Dict], max_tokens: int) -> str:
+        """Same prompt, same reply, cut to roughly max_tokens"""
+        digest = hashlib.sha1(messages[-1]["content"].encode("utf-8")).digest()
+        reply = STUB_REPLIES[digest[0] % len(STUB_REPLIES)]
+        return reply[:max_tokens * 4]
+
+
+PROVIDERS = {"azure": AzureProvider, "stub": StubProvider.from_env}
+
+
+def create_provider(name: Optional[str] = None) -> LLMProvider:
+    """Provider named by BENNY_LLM_PROVIDER (azure by default)"""
+    name = (name or os.getenv("BENNY_LLM_PROVIDER", "azure")).lower()
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown LLM provider: {name}, expected one of {', '.join(PROVIDERS)}")
+    return PROVIDERS[name]()
@@ -0,0 +1,224 @@
+"""Cache of daily check-in recommendations for Benny"""
+
+import concurrent.futures
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+# check-in fields in the order they appear in a cache key
+CHECKIN_FIELDS = ("nutrition", "sleep", "fitness", "stress")
+
+# answers that mean the same thing, after case and whitespace folding
+SYNONYMS = {
+    "great": "excellent",
+    "amazing": "excellent",
+    "ok": "okay",
+    "fine": "okay",
+    "average": "okay",
+    "so-so": "okay",
+    "bad": "poor",
+    "terrible": "poor",
+    "y": "yes",
+    "yes, completed": "yes",
+    "completed": "yes",
+    "done": "yes",
+    "n": "no",
+    "no, skipped": "no",
+    "skipped": "no",
+    "partially completed": "partial",
+    "partially": "partial",
+    "some": "partial",
+    "medium": "moderate",
+    "very low": "low",
+    "extreme": "very high",
+}
+
+WHITESPACE = re.compile(r"\s+")
+
+log = logging.getLogger("benny.ai.recommend_cache")
+
+
+def normalize_answer(answer) -> str:
+    """Fold case, whitespace and trailing punctuation, then map synonyms"""
+    folded = WHITESPACE.sub(" ", str(answer or "")).strip().lower().rstrip(".!")
+    return SYNONYMS.get(folded, folded)
+
+
+def normalize_checkin(daily_checkin: Dict) -> Dict:
+    """Check-in with every known field normalized, unknown fields dropped"""
+    return {field: normalize_answer(daily_checkin[field])
+            for field in CHECKIN_FIELDS if field in daily_checkin}
+
+
+def checkin_key(daily_checkin: Dict) -> str:
+    """Cache key for a check-in, equal for check-ins that normalize the same"""
+    normalized = normalize_checkin(daily_checkin)
+    return "|".join(f"{field}={normalized.get(field, '')}" for field in CHECKIN_FIELDS)
+
+
+class CacheEntry:
+    """Up to `variants` answers for one key, handed out in turn"""
+
+    def __init__(self, created: float):
+        self.answers: List[Tuple[str, int]] = []
+        self.created = created
+        self.next = 0
+
+    def pick(self) -> Tuple[str, int]:
+        answer = self.answers[self.next % len(self.answers)]
+        self.next += 1
+        return answer
+
+
+class RecommendationCache:
+    """
+    Recommendations keyed on the normalized check-in.
+
+    A key keeps collecting answers from the model until it has `variants` of
+    them, after that lookups rotate through those answers so users with the
+    same check-in don't all read the same sentence. Keys expire ttl_seconds
+    after their first answer and the least recently used keys are evicted
+    past max_keys. With a path, answers are also written to a SQLite file and
+    loaded back on start, so the cache survives restarts. Those writes run on
+    a background thread, so get() and put() never wait on the disk; close()
+    waits for them to finish.
+    """
+
+    def __init__(self, max_keys: int = 1024, variants: int = 3,
+                 ttl_seconds: float = 24 * 3600, path: Optional[str] = None,
+                 clock: Callable[[], float] = time.time):
+        self.max_keys = max_keys
+        self.variants = variants
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+
+        # least recently used first
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self.evictions = 0
+
+        self.conn = None
+        self.lock = threading.Lock()
+        self.writer = None
+        if path:
+            self.writer = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="recommend-cache-writer")
+            self._open(path)
+
+    def get(self, key: str) -> Optional[Tuple[str, int]]:
+        """(answer, tokens it cost) once the key has all its variants, otherwise None"""
+        entry = self.entries.get(key)
+        if entry is not None and self.clock() - entry.created > self.ttl_seconds:
+            self._drop(key)
+            entry = None
+        if entry is None or len(entry.answers) < self.variants:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        answer, tokens = entry.pick()
+        self.hits += 1
+        self.tokens_saved += tokens
+        return answer, tokens
+
+    def put(self, key: str, answer: str, tokens: int):
+        """Store an answer from the model, ignored once the key is full"""
+        if self.max_keys <= 0:
+            return
+        now = self.clock()
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = CacheEntry(now)
+        if len(entry.answers) >= self.variants:
+            return
+        entry.answers.append((answer, tokens))
+        self.entries.move_to_end(key)
+
+        self._persist("INSERT INTO recommendation_cache (key, answer, tokens, created) VALUES (?, ?, ?, ?);",
+                      (key, answer, tokens, entry.created))
+
+        while len(self.entries) > self.max_keys:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def clear(self):
+        """Forget every cached answer"""
+        self.entries.clear()
+        self._persist("DELETE FROM recommendation_cache;", ())
+
+    def stats(self) -> Dict:
+        """Counters for monitoring"""
+        lookups = self.hits + self.misses
+        return {
+            "keys": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "tokens_saved": self.tokens_saved,
+            "evictions": self.evictions
+        }
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.shutdown(wait=True)
+            self.writer = None
+        if self.conn is not None:
+            with self.lock:
+                self.conn.close()
+            self.conn = None
+
+    def _open(self, path: str):
+        """Open the SQLite file and load the answers that haven't expired"""
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL;")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS recommendation_cache (
+                key TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                created REAL NOT NULL
+            );""")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_recommendation_cache_key ON recommendation_cache (key);")
+            cutoff = self.clock() - self.ttl_seconds
+            self.conn.execute("DELETE FROM recommendation_cache WHERE created < ?;", (cutoff,))
+            self.conn.commit()
+            rows = self.conn.execute(
+                "SELECT key, answer, tokens, created FROM recommendation_cache ORDER BY created, rowid;"
+            ).fetchall()
+
+        for key, answer, tokens, created in rows:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = CacheEntry(created)
+            if len(entry.answers) < self.variants:
+                entry.answers.append((answer, tokens))
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_keys:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, key: str):
+        self.entries.pop(key, None)
+        self._persist("DELETE FROM recommendation_cache WHERE key = ?;", (key,))
+
+    def _persist(self, query: str, args: tuple):
+        """Queue a write to the SQLite file, in order, on the writer thread"""
+        if self.writer is not None:
+            self.writer.submit(self._write, query, args)
+
+    def _write(self, query: str, args: tuple):
+        try:
+            with self.lock:
+                self.conn.execute(query, args)
+                self.conn.commit()
+        except sqlite3.Error as e:
+            # the in-memory cache is still right, only the copy on disk is behind
+            log.warning("recommendation cache write failed: %s", e)
@@ -0,0 +1,160 @@
+"""Retries and a circuit breaker around calls to the LLM"""
+
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+import openai
+
+T = TypeVar("T")
+
+# status codes worth trying again: timeout, conflict, rate limit and server errors
+RETRY_STATUSES = {408, 409, 429}
+
+
+class CircuitOpen(Exception):
+    """Raised without calling upstream while the breaker is open"""
+
+
+def is_retryable(error: Exception) -> bool:
+    """True for transient failures: rate limits, 5xx and connection problems"""
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    status = getattr(error, "status_code", None)
+    return status is not None and (status in RETRY_STATUSES or status >= 500)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait, from Retry-After or retry-after-ms"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass    # an HTTP date, fall back to our own backoff
+    return None
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing upstream.
+
+    After failure_threshold transient failures in a row the breaker opens and
+    calls fail fast with CircuitOpen. Once reset_timeout seconds have passed
+    one probe call is let through (half open): success closes the breaker,
+    failure opens it again for another reset_timeout.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+        self.times_opened = 0
+        self.short_circuited = 0
+
+    def allow(self) -> bool:
+        """Whether a call may go upstream now"""
+        if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        self.short_circuited += 1
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.times_opened += 1
+            self.state = self.OPEN
+            self.opened_at = self.clock()
+        self.probing = False
+
+    def abandon(self):
+        """A call was cancelled before it finished, so it proves nothing"""
+        self.probing = False
+
+    def stats(self) -> Dict:
+        """State and counters for /health"""
+        retry_in = 0.0
+        if self.state == self.OPEN:
+            retry_in = max(0.0, self.reset_timeout - (self.clock() - self.opened_at))
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "short_circuited": self.short_circuited,
+            "retry_in_seconds": round(retry_in, 3)
+        }
+
+
+async def call_with_retries(call: Callable[[], Awaitable[T]], breaker: CircuitBreaker,
+                            max_attempts: int = 3, base_delay: float = 0.25,
+                            max_delay: float = 4.0, deadline: Optional[float] = None,
+                            clock: Callable[[], float] = time.monotonic,
+                            sleep: Callable[[float], Awaitable] = asyncio.sleep) -> T:
+    """
+    Run call(), retrying transient failures with full-jitter exponential backoff
+    Args:
+        call: makes one upstream request
+        breaker: checked before and updated after every attempt
+        max_attempts: attempts in total, including the first
+        base_delay, max_delay: backoff bounds in seconds, a server's Retry-After wins
+        deadline: clock() value after which no new attempt starts
+
+    Raises:
+        CircuitOpen while the breaker is open, otherwise the last error
+    """
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpen("circuit open")
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            breaker.abandon()
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                # upstream answered, the request itself was bad
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            attempt += 1
+            if attempt >= max_attempts or breaker.state == breaker.OPEN:
+                raise
+
+            delay = retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            if deadline is not None and clock() + delay >= deadline:
+                raise
+            await sleep(delay)
+            continue
+
+        breaker.record_success()
+        return result
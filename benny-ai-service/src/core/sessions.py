@@ -0,0 +1,193 @@
+"""Per-user conversation sessions for Benny"""
+
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+# rough per-message overhead of the dict and deque slot, on top of the text
+MESSAGE_OVERHEAD_BYTES = 120
+
+
+def message_bytes(message: Dict) -> int:
+    """Approximate memory held by one {"role", "content"} message"""
+    return len(message["content"].encode("utf-8")) + MESSAGE_OVERHEAD_BYTES
+
+
+class Session:
+    """
+    One user's recent messages in a fixed-size ring buffer, plus the rolling
+    summary of older turns and the retired messages not folded into it yet
+    """
+
+    def __init__(self, max_messages: int, now: float):
+        self.messages = deque(maxlen=max_messages)
+        # if the summarizer falls behind, the oldest unsummarized messages are dropped
+        self.pending = deque(maxlen=max_messages * 2)
+        self.summary = ""
+        self.bytes = 0
+        self.last_used = now
+
+    def append(self, message: Dict):
+        """Add a message, the oldest one moves to pending when the buffer is full"""
+        if len(self.messages) == self.messages.maxlen:
+            self.pending.append(self.messages[0])
+        self.messages.append(message)
+
+    def retire(self, count: int):
+        """Move the oldest count messages out of the window, to be summarized"""
+        for _ in range(min(count, len(self.messages))):
+            self.pending.append(self.messages.popleft())
+
+    def measure(self) -> int:
+        """Approximate bytes held by the session"""
+        return (sum(message_bytes(message) for message in self.messages)
+                + sum(message_bytes(message) for message in self.pending)
+                + len(self.summary.encode("utf-8")))
+
+
+class SessionStore:
+    """
+    Conversation history keyed by user id, bounded in memory.
+
+    Each session keeps only its last max_messages messages, older ones wait in
+    pending until they are folded into the session's rolling summary. Sessions
+    idle for longer than ttl_seconds expire, and the least recently used
+    sessions are evicted whenever there are more than max_sessions or they take
+    more than max_bytes in total. Used from the event loop, so no locking.
+    """
+
+    def __init__(self, max_messages: int = 10, max_sessions: int = 10000,
+                 max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 3600,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_messages = max_messages
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+
+        # least recently used first
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.resident_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.summaries = 0
+
+    def history(self, user_id: str) -> List[Dict]:
+        """Messages for this user, oldest first (empty for a new or expired session)"""
+        return self.context(user_id)[1]
+
+    def context(self, user_id: str) -> Tuple[str, List[Dict]]:
+        """(rolling summary, recent messages oldest first) for this user"""
+        session = self._lookup(user_id)
+        if session is None:
+            self.misses += 1
+            return "", []
+        self.hits += 1
+        return session.summary, list(session.messages)
+
+    def append(self, user_id: str, *messages: Dict):
+        """Add messages to a user's session, creating it if needed"""
+        session = self._lookup(user_id)
+        now = self.clock()
+        if session is None:
+            session = self.sessions[user_id] = Session(self.max_messages, now)
+        session.last_used = now
+
+        for message in messages:
+            session.append(message)
+        self._update_bytes(session)
+
+        self._expire_idle(now)
+        self._evict_over_limits(keep=user_id)
+
+    def retire(self, user_id: str, count: int):
+        """Move a user's oldest count messages out of the prompt window"""
+        session = self.sessions.get(user_id)
+        if session is not None and count > 0:
+            session.retire(count)
+
+    def pending(self, user_id: str) -> Tuple[str, List[Dict]]:
+        """(current summary, retired messages waiting to be folded into it)"""
+        session = self.sessions.get(user_id)
+        if session is None:
+            return "", []
+        return session.summary, list(session.pending)
+
+    def set_summary(self, user_id: str, summary: str, folded: List[Dict]):
+        """Store a new rolling summary that covers the folded pending messages"""
+        session = self.sessions.get(user_id)
+        if session is None:
+            return
+        folded_ids = {id(message) for message in folded}
+        while session.pending and id(session.pending[0]) in folded_ids:
+            session.pending.popleft()
+        session.summary = summary
+        self.summaries += 1
+        self._update_bytes(session)
+        self._evict_over_limits(keep=user_id)
+
+    def clear(self, user_id: Optional[str] = None):
+        """Forget one user's session, or every session"""
+        if user_id is None:
+            self.sessions.clear()
+            self.resident_bytes = 0
+            return
+        session = self.sessions.pop(user_id, None)
+        if session is not None:
+            self.resident_bytes -= session.bytes
+
+    def stats(self) -> Dict:
+        """Counters for monitoring"""
+        return {
+            "sessions": len(self.sessions),
+            "resident_bytes": self.resident_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "summaries": self.summaries
+        }
+
+    def _lookup(self, user_id: str) -> Optional[Session]:
+        """Live session for user_id, marked as most recently used"""
+        session = self.sessions.get(user_id)
+        if session is None:
+            return None
+        if self.clock() - session.last_used > self.ttl_seconds:
+            self._drop(user_id)
+            self.expirations += 1
+            return None
+        session.last_used = self.clock()
+        self.sessions.move_to_end(user_id)
+        return session
+
+    def _expire_idle(self, now: float):
+        """Drop expired sessions, they sit at the front in last-used order"""
+        while self.sessions:
+            user_id, session = next(iter(self.sessions.items()))
+            if now - session.last_used <= self.ttl_seconds:
+                break
+            self._drop(user_id)
+            self.expirations += 1
+
+    def _evict_over_limits(self, keep: str):
+        """Evict least recently used sessions until both caps hold"""
+        while (len(self.sessions) > self.max_sessions
+               or self.resident_bytes > self.max_bytes):
+            user_id = next(iter(self.sessions))
+            if user_id == keep:
+                break
+            self._drop(user_id)
+            self.evictions += 1
+
+    def _update_bytes(self, session: Session):
+        size = session.measure()
+        self.resident_bytes += size - session.bytes
+        session.bytes = size
+
+    def _drop(self, user_id: str):
+        session = self.sessions.pop(user_id)
+        self.resident_bytes -= session.bytes
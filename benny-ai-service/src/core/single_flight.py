@@ -0,0 +1,77 @@
+"""Coalescing of identical in-flight LLM requests"""
+
+import asyncio
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+
+def request_fingerprint(messages: List[Dict], params: Dict) -> str:
+    """Stable hash of everything sent upstream for one completion"""
+    payload = json.dumps([messages, params], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class Flight:
+    """One upstream call and the number of callers waiting on it"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time.
+
+    The first caller for a key starts the call, callers that arrive while it
+    is still running wait for the same result (or exception). Each caller
+    waits through asyncio.shield, so one caller timing out or disconnecting
+    doesn't cancel the call for the others. The call is only cancelled when
+    every caller waiting on it has gone away.
+    """
+
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def run(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Result of factory() for this key, shared with concurrent callers
+        Returns:
+            (result, shared), shared is True when another caller started the call
+        """
+        flight = self.flights.get(key)
+        shared = flight is not None
+        if flight is None:
+            flight = self.flights[key] = Flight(asyncio.ensure_future(factory()))
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.leaders += 1
+        else:
+            self.followers += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), shared
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                # last one waiting, stop the upstream call and wait for it to unwind
+                self._forget(key, flight)
+                flight.task.cancel()
+                await asyncio.wait({flight.task})
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def stats(self) -> Dict:
+        """Counters for monitoring"""
+        return {
+            "in_flight": len(self.flights),
+            "leaders": self.leaders,
+            "followers": self.followers
+        }
+
+    def _forget(self, key: str, flight: Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
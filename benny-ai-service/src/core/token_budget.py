@@ -0,0 +1,43 @@
+"""Tokens-per-minute budget for batches of LLM requests"""
+
+import asyncio
+import time
+from typing import Callable
+
+
+class TokenBudget:
+    """
+    Token bucket refilled at tokens_per_minute / 60 per second, holding at
+    most one minute's worth. Callers reserve an estimate before a request and
+    settle the difference once the real usage is known.
+    """
+
+    def __init__(self, tokens_per_minute: int,
+                 clock: Callable[[], float] = time.monotonic):
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self.available = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self.lock = asyncio.Lock()
+
+    async def reserve(self, tokens: int):
+        """Wait until tokens are available and take them"""
+        tokens = min(tokens, self.capacity)
+        # one waiter at a time so reservations are served in order
+        async with self.lock:
+            self._refill()
+            while self.available < tokens:
+                await asyncio.sleep((tokens - self.available) / self.rate)
+                self._refill()
+            self.available -= tokens
+
+    def settle(self, reserved: int, used: int):
+        """Give back an over-estimate, or take an under-estimate"""
+        self._refill()
+        self.available = min(self.capacity, self.available + reserved - used)
+
+    def _refill(self):
+        now = self.clock()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
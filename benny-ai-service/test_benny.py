@@ -1,8 +1,35 @@
 """Simple unit tests for Benny Wellness AI"""
 
+import os
+import tempfile
+import threading
+import time
 import unittest
 import asyncio
-from src.core.benny import BennyWellnessAI
+from types import SimpleNamespace
+from unittest import mock
+import httpx
+import jwt
+from src.core.admission import AdmissionLimiter, Overloaded
+from src.core.benny import BennyWellnessAI, BennyMode, FALLBACKS, LLM_SECONDS, LLM_TOKENS
+from src.core.context import estimate_tokens, fit_history, message_tokens
+from src.core.providers import LLMProvider, StubAPIError, StubProvider, create_provider
+from src.core.resilience import CircuitBreaker, CircuitOpen, call_with_retries
+from src.core.recommend_cache import RecommendationCache, checkin_key
+from src.core.sessions import SessionStore, message_bytes
+from src.core.token_budget import TokenBudget
+# bennyDB is on the path once src.core.benny is imported
+import db_async
+
+
+def offline_benny(directory, provider=None):
+    """Benny saving chats to a database in directory, with an in-memory recommendation cache,
+    so tests never touch bennyDB/BennyDB.sqlite3 or BENNY_RECOMMEND_CACHE_PATH"""
+    return BennyWellnessAI(
+        provider=provider,
+        db=db_async.async_sharded_wellness_ai_db(directory=directory),
+        recommend_cache=RecommendationCache()
+    )
 
 
 class TestBennyWelness(unittest.TestCase):
@@ -11,13 +38,24 @@ class TestBennyWelness(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         """Initialize Benny for all test"""
+        # one loop for the whole class, the client's connection pool belongs to it
+        cls.loop = asyncio.new_event_loop()
+        cls.directory = tempfile.TemporaryDirectory()
         try:
-            cls.benny = BennyWellnessAI()
+            cls.benny = offline_benny(cls.directory.name)
             cls.setup_success = True
         except Exception as e:
             print(f"Setup failed: {e}")
             cls.setup_success = False
 
+    @classmethod
+    def tearDownClass(cls):
+        """Close Benny's connections and the loop"""
+        if cls.setup_success:
+            cls.loop.run_until_complete(cls.benny.aclose())
+        cls.loop.close()
+        cls.directory.cleanup()
+
     def setUp(self):
         """Check benny is initialized"""
         if not self.setup_success:
@@ -33,7 +71,7 @@ class TestBennyWelness(unittest.TestCase):
     def test_2_chat_simple(self):
         """Test Chat Intro"""
         message = "Hello Benny"
-        result = asyncio.run(self.benny.chat(message))
+        result = self.loop.run_until_complete(self.benny.chat(message))
 
         self.assertTrue(result["success"])
         self.assertIn("response", result)
@@ -49,7 +87,7 @@ class TestBennyWelness(unittest.TestCase):
     def test_3_wellness_chat(self):
         """Test Chat with Wellness Topic"""
         message = "How can I improve my endurance?"
-        result = asyncio.run(self.benny.chat(message))
+        result = self.loop.run_until_complete(self.benny.chat(message))
         
         self.assertTrue(result["success"])
         self.assertIn("response", result)
@@ -61,5 +99,785 @@ class TestBennyWelness(unittest.TestCase):
         print("=============================\n")
 
 
+class FakeCompletions:
+    """Stands in for client.chat.completions, answers after a delay"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+        self.cancelled = 0
+        self.active = 0
+        self.max_active = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        if kwargs.get("stream"):
+            return FakeStream(["Drink ", "a glass ", "of water."], self.delay)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.active -= 1
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Drink a glass of water."))],
+            usage=SimpleNamespace(total_tokens=42)
+        )
+
+
+class FakeStream:
+    """Stands in for the streamed completion, one chunk per piece"""
+
+    def __init__(self, pieces, delay):
+        self.pieces = pieces
+        self.delay = delay
+        self.closed = False
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        for piece in self.pieces:
+            await asyncio.sleep(self.delay)
+            yield SimpleNamespace(
+                choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))],
+                usage=None
+            )
+        yield SimpleNamespace(choices=[], usage=SimpleNamespace(total_tokens=42))
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeClientTestCase(unittest.IsolatedAsyncioTestCase):
+    """Benny with the Azure client swapped for FakeCompletions"""
+
+    CHECKIN = {"nutrition": "good", "sleep": "poor", "fitness": "yes", "stress": "high"}
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.benny = offline_benny(self.directory.name, StubProvider(latency_ms=0))
+        self.completions = FakeCompletions(delay=0.3)
+        self.benny.client = SimpleNamespace(
+            chat=SimpleNamespace(completions=self.completions),
+            close=self._noop
+        )
+
+    async def asyncTearDown(self):
+        await self.benny.aclose()
+        self.directory.cleanup()
+
+    async def _noop(self):
+        pass
+
+
+class TestBennyConcurrency(FakeClientTestCase):
+    """Requests to the LLM run concurrently and can be cancelled (no Azure needed)"""
+
+    async def test_concurrent_requests_overlap(self):
+        """N concurrent requests take about as long as one"""
+        checkins = [dict(self.CHECKIN, nutrition=f"meal {n}") for n in range(10)]
+        started = time.perf_counter()
+        results = await asyncio.gather(*[self.benny.recommend(checkin) for checkin in checkins])
+        elapsed = time.perf_counter() - started
+
+        self.assertTrue(all(result["success"] for result in results))
+        self.assertEqual(self.completions.calls, 10)
+        self.assertLess(elapsed, 0.3 * 3)
+
+    async def test_timeout_cancels_upstream_call(self):
+        """wait_for fires on time and cancels the call in flight"""
+        self.completions.delay = 5
+        started = time.perf_counter()
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.benny.recommend(self.CHECKIN), timeout=0.1)
+
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual(self.completions.cancelled, 1)
+
+    async def test_identical_requests_share_one_call(self):
+        """Concurrent callers with the same prompt wait on one upstream call"""
+        results = await asyncio.gather(*[self.benny.recommend(self.CHECKIN) for _ in range(10)])
+
+        self.assertTrue(all(result["success"] for result in results))
+        self.assertEqual(self.completions.calls, 1)
+        self.assertEqual(sum(result["tokens_used"] for result in results), 42)
+        self.assertEqual(self.benny.in_flight.stats(), {"in_flight": 0, "leaders": 1, "followers": 9})
+
+    async def test_one_caller_cancelling_keeps_shared_call(self):
+        """A caller that times out doesn't cancel the call for the others"""
+        impatient = asyncio.create_task(asyncio.wait_for(self.benny.recommend(self.CHECKIN), timeout=0.05))
+        patient = asyncio.create_task(self.benny.recommend(self.CHECKIN))
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await impatient
+        result = await patient
+
+        self.assertTrue(result["success"])
+        self.assertEqual(self.completions.calls, 1)
+        self.assertEqual(self.completions.cancelled, 0)
+
+
+class TestBennyStreaming(FakeClientTestCase):
+    """Streaming chat replies (no Azure needed)"""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.completions.delay = 0.01
+        self.streams = []
+        create = self.completions.create
+
+        async def tracking_create(**kwargs):
+            stream = await create(**kwargs)
+            self.streams.append(stream)
+            return stream
+
+        self.completions.create = tracking_create
+
+    async def test_stream_yields_tokens_then_saves(self):
+        """Tokens arrive one by one, then history is updated"""
+        items = [item async for item in self.benny.chat_stream("How much water?", "stream-user")]
+
+        self.assertEqual([item["text"] for item in items[:-1]], ["Drink ", "a glass ", "of water."])
+        self.assertEqual(items[-1]["type"], "done")
+        self.assertTrue(items[-1]["success"])
+        self.assertEqual(items[-1]["tokens_used"], 42)
+        self.assertEqual(self.benny.sessions.history("stream-user")[-1]["content"], "Drink a glass of water.")
+        self.assertTrue(self.streams[0].closed)
+
+    async def test_closing_stream_early_cancels_upstream(self):
+        """A client that goes away mid-reply closes the upstream stream and saves nothing"""
+        stream = self.benny.chat_stream("How much water?", "early-close-user")
+        first = await stream.__anext__()
+        self.assertEqual(first["type"], "token")
+        await stream.aclose()
+
+        self.assertTrue(self.streams[0].closed)
+        self.assertEqual(self.benny.sessions.history("early-close-user"), [])
+
+    async def test_slow_stream_stops_at_deadline(self):
+        """An upstream that keeps trickling chunks is cut off once the reply runs past LLM_DEADLINE"""
+        self.completions.delay = 0.2
+        with mock.patch("src.core.benny.LLM_DEADLINE", 0.3):
+            items = [item async for item in self.benny.chat_stream("How much water?", "slow-stream-user")]
+
+        self.assertEqual([item["type"] for item in items], ["token", "done"])
+        self.assertFalse(items[-1]["success"])
+        self.assertEqual(items[-1]["error"], "timeout")
+        self.assertTrue(self.streams[0].closed)
+        self.assertEqual(self.benny.sessions.history("slow-stream-user"), [])
+
+
+class TestBennySessions(FakeClientTestCase):
+    """Each user only sees their own history (no Azure needed)"""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.completions.delay = 0
+        self.sent = []
+        create = self.completions.create
+
+        async def tracking_create(**kwargs):
+            self.sent.append(kwargs["messages"])
+            return await create(**kwargs)
+
+        self.completions.create = tracking_create
+
+    async def test_users_do_not_share_history(self):
+        await self.benny.chat("I slept badly", "user-a")
+        await self.benny.chat("How much water?", "user-b")
+
+        # system prompt and the new message only, nothing from user-a
+        self.assertEqual(len(self.sent[1]), 2)
+        self.assertEqual(len(self.benny.sessions.history("user-a")), 2)
+
+    async def test_history_is_capped(self):
+        for n in range(20):
+            await self.benny.chat(f"question {n}", "chatty-user")
+
+        history = self.benny.sessions.history("chatty-user")
+        self.assertEqual(len(history), self.benny.sessions.max_messages)
+        self.assertEqual(history[-2]["content"], "question 19")
+
+    async def test_long_turns_trimmed_to_token_budget(self):
+        long_question = "Tell me everything about sleep. " * 200
+        await self.benny.chat(long_question, "wordy-user")
+        await self.benny.chat("And about water?", "wordy-user")
+
+        # the long turn no longer fits, so it is left out and queued for the summary
+        prompt = self.sent[-1]
+        self.assertNotIn(long_question, [m["content"] for m in prompt])
+        self.assertLess(sum(message_tokens(m) for m in prompt), 1200)
+        self.assertEqual(self.benny.sessions.pending("wordy-user")[1][0]["content"], long_question)
+
+    async def test_older_turns_folded_into_summary_in_background(self):
+        self.benny.sessions.max_messages = 2
+        self.benny.sessions.clear()
+        for n in range(3):
+            await self.benny.chat(f"question {n}", "long-chat-user")
+        await asyncio.gather(*self.benny.summary_tasks.values())
+
+        summary, history = self.benny.sessions.context("long-chat-user")
+        self.assertEqual(summary, "Drink a glass of water.")
+        await self.benny.chat("question 3", "long-chat-user")
+        self.assertEqual(self.sent[-1][1]["content"], "Summary of the earlier conversation: Drink a glass of water.")
+
+
+class TestBennyBatch(FakeClientTestCase):
+    """recommend_many fan-out (no Azure needed)"""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.completions.delay = 0.05
+
+    async def test_batch_dedupes_and_limits_concurrency(self):
+        checkins = [dict(self.CHECKIN, nutrition=f"meal {n % 10}") for n in range(30)]
+        results = [result async for result in self.benny.recommend_many(checkins, concurrency=3)]
+
+        self.assertEqual(sorted(result["index"] for result in results), list(range(30)))
+        self.assertTrue(all(result["success"] for result in results))
+        self.assertEqual(self.completions.calls, 10)
+        self.assertEqual(self.completions.max_active, 3)
+        self.assertEqual(sum(result["tokens_used"] for result in results), 42 * 10)
+
+    async def test_one_failure_does_not_fail_batch(self):
+        create = self.completions.create
+
+        async def failing_create(**kwargs):
+            if "meal 1" in kwargs["messages"][-1]["content"]:
+                raise RuntimeError("upstream error")
+            return await create(**kwargs)
+
+        self.completions.create = failing_create
+        checkins = [dict(self.CHECKIN, nutrition=f"meal {n}") for n in range(3)]
+        results = {result["index"]: result async for result in self.benny.recommend_many(checkins)}
+
+        self.assertFalse(results[1]["success"])
+        self.assertEqual(results[1]["error"], "upstream error")
+        self.assertTrue(results[0]["success"] and results[2]["success"])
+
+    async def test_caller_concurrency_is_capped(self):
+        checkins = [dict(self.CHECKIN, nutrition=f"meal {n}") for n in range(10)]
+        with mock.patch("src.core.benny.BATCH_MAX_CONCURRENCY", 2):
+            results = [result async for result in self.benny.recommend_many(checkins, concurrency=50)]
+
+        self.assertEqual(len(results), 10)
+        self.assertEqual(self.completions.max_active, 2)
+
+    async def test_items_take_admission_slots(self):
+        limiter = AdmissionLimiter(max_concurrent=1, max_queue=0, max_wait=0.01)
+        checkins = [dict(self.CHECKIN, nutrition=f"meal {n}") for n in range(3)]
+        results = [result async for result in self.benny.recommend_many(checkins, concurrency=3, limiter=limiter)]
+
+        self.assertEqual(self.completions.calls, 1)
+        shed = [result for result in results if not result["success"]]
+        self.assertEqual([result["error"] for result in shed], ["overloaded", "overloaded"])
+        self.assertEqual(shed[0]["response"], self.benny._get_fallback_response(BennyMode.RECOMMEND))
+        stats = limiter.stats()
+        self.assertEqual((stats["admitted"], stats["rejected"], stats["active"]), (1, 2, 0))
+
+    async def test_batches_share_one_token_budget(self):
+        reserved = []
+        reserve = self.benny.batch_budget.reserve
+
+        async def tracking_reserve(tokens):
+            reserved.append(tokens)
+            await reserve(tokens)
+
+        self.benny.batch_budget.reserve = tracking_reserve
+        batches = [[dict(self.CHECKIN, nutrition=f"batch {batch} meal {n}") for n in range(3)] for batch in range(2)]
+
+        async def run(checkins):
+            return [result async for result in self.benny.recommend_many(checkins, tokens_per_minute=10 ** 9)]
+
+        await asyncio.gather(*(run(checkins) for checkins in batches))
+        self.assertEqual(len(reserved), 6)
+
+
+class TestTokenBudget(unittest.IsolatedAsyncioTestCase):
+    """TokenBudget waits for the bucket to refill"""
+
+    async def test_reserve_waits_when_empty(self):
+        budget = TokenBudget(600)       # refills 10 tokens a second
+        await budget.reserve(600)
+        started = time.perf_counter()
+        await budget.reserve(3)
+        self.assertGreater(time.perf_counter() - started, 0.25)
+
+    async def test_settle_returns_unused_tokens(self):
+        budget = TokenBudget(600)
+        await budget.reserve(600)
+        budget.settle(600, 100)
+        started = time.perf_counter()
+        await budget.reserve(500)
+        self.assertLess(time.perf_counter() - started, 0.1)
+
+
+class TestAdmissionLimiter(unittest.IsolatedAsyncioTestCase):
+    """Requests over the limit wait briefly or are shed at once"""
+
+    async def hold(self, limiter, seconds):
+        async with limiter.admit():
+            await asyncio.sleep(seconds)
+
+    async def test_full_queue_is_rejected_immediately(self):
+        limiter = AdmissionLimiter(max_concurrent=2, max_queue=1, max_wait=5)
+        running = [asyncio.create_task(self.hold(limiter, 0.2)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+
+        started = time.perf_counter()
+        with self.assertRaises(Overloaded) as caught:
+            await limiter.acquire()
+        self.assertLess(time.perf_counter() - started, 0.05)
+        self.assertGreaterEqual(caught.exception.retry_after, 1)
+
+        await asyncio.gather(*running)
+        stats = limiter.stats()
+        self.assertEqual((stats["admitted"], stats["rejected"], stats["active"], stats["queued"]), (3, 1, 0, 0))
+        self.assertGreater(stats["max_wait_ms"], 150)
+
+    async def test_wait_is_bounded(self):
+        limiter = AdmissionLimiter(max_concurrent=1, max_queue=10, max_wait=0.05)
+        running = asyncio.create_task(self.hold(limiter, 0.3))
+        await asyncio.sleep(0.01)
+
+        with self.assertRaises(Overloaded):
+            await limiter.acquire()
+        self.assertEqual(limiter.stats()["timed_out"], 1)
+        await running
+
+    async def test_ticket_release_is_idempotent(self):
+        limiter = AdmissionLimiter(max_concurrent=1, max_queue=0, max_wait=1)
+        ticket = await limiter.acquire()
+        ticket.release()
+        ticket.release()
+        self.assertEqual(limiter.active, 0)
+        (await limiter.acquire()).release()
+
+
+class UpstreamError(Exception):
+    """Looks like an openai APIStatusError to the retry logic"""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+class TestRetries(unittest.IsolatedAsyncioTestCase):
+    """call_with_retries and CircuitBreaker"""
+
+    async def asyncSetUp(self):
+        self.delays = []
+        self.calls = 0
+
+    async def record_sleep(self, seconds):
+        self.delays.append(seconds)
+
+    def failing(self, *errors):
+        async def call():
+            self.calls += 1
+            if self.calls <= len(errors):
+                raise errors[self.calls - 1]
+            return "ok"
+        return call
+
+    async def test_retries_transient_errors_honoring_retry_after(self):
+        call = self.failing(UpstreamError(503), UpstreamError(429, {"retry-after": "2"}))
+        result = await call_with_retries(call, CircuitBreaker(), sleep=self.record_sleep)
+
+        self.assertEqual(result, "ok")
+        self.assertEqual(self.calls, 3)
+        self.assertLessEqual(self.delays[0], 0.5)
+        self.assertEqual(self.delays[1], 2.0)
+
+    async def test_client_errors_not_retried(self):
+        with self.assertRaises(UpstreamError):
+            await call_with_retries(self.failing(UpstreamError(400)), CircuitBreaker(), sleep=self.record_sleep)
+        self.assertEqual(self.calls, 1)
+
+    async def test_no_retry_past_deadline(self):
+        call = self.failing(UpstreamError(429, {"retry-after": "10"}))
+        with self.assertRaises(UpstreamError):
+            await call_with_retries(call, CircuitBreaker(), deadline=time.monotonic() + 5,
+                                    sleep=self.record_sleep)
+        self.assertEqual((self.calls, self.delays), (1, []))
+
+    async def test_breaker_opens_then_probes(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=clock)
+        call = self.failing(*[UpstreamError(500)] * 3)
+        with self.assertRaises(UpstreamError):
+            await call_with_retries(call, breaker, max_attempts=5, sleep=self.record_sleep)
+        self.assertEqual((self.calls, breaker.state), (2, "open"))
+
+        with self.assertRaises(CircuitOpen):
+            await call_with_retries(call, breaker, sleep=self.record_sleep)
+        self.assertEqual(self.calls, 2)
+
+        # half open: one failed probe opens it again, the next probe closes it
+        clock.now = 30
+        with self.assertRaises(UpstreamError):
+            await call_with_retries(call, breaker, max_attempts=1, sleep=self.record_sleep)
+        self.assertEqual(breaker.state, "open")
+        clock.now = 60
+        self.assertEqual(await call_with_retries(call, breaker, sleep=self.record_sleep), "ok")
+        self.assertEqual(breaker.stats()["state"], "closed")
+        self.assertEqual(breaker.stats()["times_opened"], 2)
+
+
+class TestBennyCircuit(FakeClientTestCase):
+    """An open breaker answers with the fallback without calling Azure"""
+
+    async def test_open_breaker_falls_back_fast(self):
+        async def failing_create(**kwargs):
+            self.completions.calls += 1
+            raise UpstreamError(500)
+
+        self.completions.create = failing_create
+        self.benny.breaker.failure_threshold = 2
+        fallbacks = FALLBACKS.value("recommend", "circuit_open")
+        first = await self.benny.recommend(self.CHECKIN)
+        self.assertFalse(first["success"])
+        self.assertEqual(self.benny.breaker.state, "open")
+
+        calls = self.completions.calls
+        started = time.perf_counter()
+        result = await self.benny.recommend(self.CHECKIN)
+        self.assertLess(time.perf_counter() - started, 0.01)
+        self.assertEqual(result["error"], "circuit open")
+        self.assertEqual(result["response"], self.benny._get_fallback_response(BennyMode.RECOMMEND))
+        self.assertEqual(self.completions.calls, calls)
+        self.assertEqual(FALLBACKS.value("recommend", "circuit_open"), fallbacks + 1)
+
+
+class TestStubProvider(unittest.IsolatedAsyncioTestCase):
+    """Benny on the local stub backend, no network at all"""
+
+    async def asyncSetUp(self):
+        self.stub = StubProvider(latency_ms=20, latency_jitter_ms=5, token_ms=1, seed=7)
+        self.directory = tempfile.TemporaryDirectory()
+        self.benny = offline_benny(self.directory.name, self.stub)
+
+    async def asyncTearDown(self):
+        await self.benny.aclose()
+        self.directory.cleanup()
+
+    async def test_recommend_and_stream(self):
+        tokens = LLM_TOKENS.value("recommend")
+        calls = LLM_SECONDS.snapshot("recommend", "ok")["count"]
+        result = await self.benny.recommend({"nutrition": "good", "sleep": "poor", "fitness": "yes", "stress": "high"})
+        self.assertTrue(result["success"])
+        self.assertGreater(result["tokens_used"], 0)
+        # metrics by mode for /metrics
+        self.assertEqual(LLM_TOKENS.value("recommend"), tokens + result["tokens_used"])
+        self.assertEqual(LLM_SECONDS.snapshot("recommend", "ok")["count"], calls + 1)
+
+        items = [item async for item in self.benny.chat_stream("How do I sleep better?", "stub-user")]
+        self.assertGreater(len(items), 2)
+        self.assertEqual("".join(item["text"] for item in items[:-1]), items[-1]["response"])
+        self.assertGreater(items[-1]["tokens_used"], 0)
+
+    async def test_same_prompt_same_reply(self):
+        messages = [{"role": "user", "content": "hello"}]
+        first = await self.stub.create(messages=messages)
+        second = await self.stub.create(messages=messages)
+        self.assertEqual(first.choices[0].message.content, second.choices[0].message.content)
+
+    async def test_injected_errors_fall_back(self):
+        self.stub.error_rate = 1.0
+        result = await self.benny.recommend({"nutrition": "okay"})
+        self.assertFalse(result["success"])
+        self.assertEqual(result["error"], "Injected upstream error")
+        self.assertEqual(self.stub.stats()["errors"], self.benny.breaker.failures)
+
+    async def test_rate_limit(self):
+        stub = StubProvider(latency_ms=0, rate_limit_rpm=2)
+        messages = [{"role": "user", "content": "hello"}]
+        await stub.create(messages=messages)
+        await stub.create(messages=messages)
+        with self.assertRaises(StubAPIError) as caught:
+            await stub.create(messages=messages)
+        self.assertEqual(caught.exception.status_code, 429)
+        self.assertEqual(caught.exception.response.headers["retry-after"], "60")
+
+    def test_create_provider_by_name(self):
+        self.assertIsInstance(create_provider("stub"), StubProvider)
+        with self.assertRaises(ValueError):
+            create_provider("nope")
+
+    def test_provider_from_env(self):
+        with mock.patch.dict(os.environ, {"BENNY_LLM_PROVIDER": "stub", "BENNY_STUB_LATENCY_MS": "5"}):
+            provider = create_provider()
+        self.assertIsInstance(provider, StubProvider)
+        self.assertEqual(provider.latency_ms, 5)
+
+    def test_provider_must_implement_create(self):
+        class NoCreate(LLMProvider):
+            name = "incomplete"
+
+        with self.assertRaises(TypeError):
+            NoCreate()
+
+
+SECRET_KEY = "test-secret-key-for-signing-tokens"
+
+
+class TestChatAuth(unittest.IsolatedAsyncioTestCase):
+    """/chat saves history under the user of a verified sign-in token, never the request body"""
+
+    async def asyncSetUp(self):
+        from src.api import main as api
+        self.api = api
+        self.secret_key = api.SECRET_KEY
+        api.SECRET_KEY = SECRET_KEY
+        self.directory = tempfile.TemporaryDirectory()
+        self.benny = api.benny = offline_benny(self.directory.name, StubProvider(latency_ms=0, token_ms=0))
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://benny")
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+        await self.benny.aclose()
+        self.api.benny = None
+        self.api.SECRET_KEY = self.secret_key
+        self.directory.cleanup()
+
+    def token(self, user_id, secret=SECRET_KEY, expires_in=3600):
+        return jwt.encode({"sub": user_id, "exp": int(time.time()) + expires_in}, secret, algorithm="HS256")
+
+    async def saved_for(self, user_id):
+        return await self.benny.db.read(user_id, "fetch_chat_page", user_id, 10)
+
+    async def test_chat_saved_under_token_user(self):
+        response = await self.client.post("/chat", json={"message": "hello"},
+                                          headers={"Authorization": f"Bearer {self.token('user-a')}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["success"])
+        self.assertEqual(len(await self.saved_for("user-a")), 2)
+
+    async def test_body_user_id_is_ignored(self):
+        response = await self.client.post("/chat", json={"message": "hello", "user_id": "someone-else"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await self.saved_for("someone-else"), [])
+        self.assertEqual(len(await self.saved_for("anonymous")), 2)
+
+    async def test_bad_tokens_rejected(self):
+        for token in (self.token("user-a", secret="x" * 32), self.token("user-a", expires_in=-60), "garbage"):
+            response = await self.client.post("/chat", json={"message": "hello"},
+                                              headers={"Authorization": f"Bearer {token}"})
+            self.assertEqual(response.status_code, 401)
+        self.assertEqual(await self.saved_for("user-a"), [])
+
+
+class TestContext(unittest.TestCase):
+    """Token estimates and budget filling"""
+
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens(""), 0)
+        self.assertEqual(estimate_tokens("abcd" * 10), 10)
+
+    def test_fit_history_fills_newest_first(self):
+        history = [{"role": "user", "content": "x" * 400},
+                   {"role": "assistant", "content": "short"},
+                   {"role": "user", "content": "short"}]
+        self.assertEqual(fit_history(history, 20), 2)
+        self.assertEqual(fit_history(history, 1000), 3)
+        self.assertEqual(fit_history(history, 0), 0)
+
+
+class TestBennyRecommendCache(FakeClientTestCase):
+    """Identical check-ins are answered from the cache (no Azure needed)"""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.completions.delay = 0
+
+    async def test_cache_fills_then_serves(self):
+        variants = self.benny.recommend_cache.variants
+        for _ in range(variants):
+            result = await self.benny.recommend(self.CHECKIN)
+            self.assertFalse(result["cached"])
+
+        same_checkin = {"nutrition": " Good ", "sleep": "Bad", "fitness": "Yes, completed", "stress": "HIGH"}
+        result = await self.benny.recommend(same_checkin)
+
+        self.assertTrue(result["cached"])
+        self.assertEqual(result["tokens_used"], 0)
+        self.assertEqual(self.completions.calls, variants)
+        self.assertEqual(self.benny.recommend_cache.stats()["tokens_saved"], 42)
+
+    async def test_concurrent_identical_recommends_store_one_answer(self):
+        self.completions.delay = 0.05
+        results = await asyncio.gather(*(self.benny.recommend(self.CHECKIN) for _ in range(5)))
+
+        self.assertTrue(all(result["success"] for result in results))
+        self.assertEqual(self.completions.calls, 1)
+        entry = self.benny.recommend_cache.entries[checkin_key(self.CHECKIN)]
+        self.assertEqual(entry.answers, [("Drink a glass of water.", 42)])
+
+
+class TestRecommendationCache(unittest.TestCase):
+    """RecommendationCache keys, bounds and persistence"""
+
+    def test_key_folds_case_whitespace_and_synonyms(self):
+        self.assertEqual(
+            checkin_key({"nutrition": "Great!", "sleep": " very   GOOD", "fitness": "done", "stress": "Medium"}),
+            checkin_key({"stress": "moderate", "fitness": "Yes, completed", "sleep": "Very good", "nutrition": "excellent"}))
+        self.assertNotEqual(checkin_key({"sleep": "good"}), checkin_key({"sleep": "poor"}))
+
+    def test_rotates_through_variants(self):
+        cache = RecommendationCache(variants=2)
+        cache.put("key", "Walk for 10 minutes.", 30)
+        self.assertIsNone(cache.get("key"))
+        cache.put("key", "Drink a glass of water.", 20)
+        cache.put("key", "ignored, key is full", 10)
+
+        answers = [cache.get("key")[0] for _ in range(4)]
+        self.assertEqual(answers, ["Walk for 10 minutes.", "Drink a glass of water."] * 2)
+        self.assertEqual(cache.stats()["tokens_saved"], 100)
+
+    def test_least_recently_used_key_evicted(self):
+        cache = RecommendationCache(max_keys=2, variants=1)
+        cache.put("a", "answer", 1)
+        cache.put("b", "answer", 1)
+        cache.get("a")
+        cache.put("c", "answer", 1)
+
+        self.assertEqual(list(cache.entries), ["a", "c"])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_keys_expire(self):
+        clock = FakeClock()
+        cache = RecommendationCache(variants=1, ttl_seconds=60, clock=clock)
+        cache.put("key", "answer", 1)
+        clock.now = 61
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.stats()["keys"], 0)
+
+    def test_survives_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/cache.sqlite3"
+            cache = RecommendationCache(variants=1, path=path)
+            cache.put("key", "Sleep by 10pm.", 25)
+            cache.close()
+
+            reopened = RecommendationCache(variants=1, path=path)
+            self.assertEqual(reopened.get("key"), ("Sleep by 10pm.", 25))
+            reopened.close()
+
+    def test_disk_writes_run_off_the_calling_thread(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = RecommendationCache(variants=1, path=f"{directory}/cache.sqlite3")
+            writers = []
+            write = cache._write
+            cache._write = lambda *args: (writers.append(threading.current_thread()), write(*args))
+            cache.put("key", "Sleep by 10pm.", 25)
+            cache.close()
+
+            self.assertEqual(len(writers), 1)
+            self.assertIsNot(writers[0], threading.current_thread())
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSessionStore(unittest.TestCase):
+    """SessionStore bounds and counters"""
+
+    @staticmethod
+    def exchange(n):
+        return ({"role": "user", "content": f"question {n}"},
+                {"role": "assistant", "content": f"answer {n}"})
+
+    def test_ring_buffer_keeps_last_messages(self):
+        store = SessionStore(max_messages=4)
+        for n in range(5):
+            store.append("user", *self.exchange(n))
+
+        history = store.history("user")
+        self.assertEqual([m["content"] for m in history],
+                         ["question 3", "answer 3", "question 4", "answer 4"])
+        # the two oldest wait to be summarized
+        _, pending = store.pending("user")
+        self.assertEqual([m["content"] for m in pending][-2:], ["question 2", "answer 2"])
+        self.assertEqual(store.resident_bytes, sum(message_bytes(m) for m in history + pending))
+
+    def test_summary_replaces_pending(self):
+        store = SessionStore(max_messages=2)
+        for n in range(3):
+            store.append("user", *self.exchange(n))
+        _, pending = store.pending("user")
+        store.set_summary("user", "Asked questions 0 and 1.", pending)
+
+        self.assertEqual(store.context("user"), ("Asked questions 0 and 1.", list(self.exchange(2))))
+        self.assertEqual(store.pending("user")[1], [])
+        self.assertEqual(store.resident_bytes,
+                         sum(message_bytes(m) for m in self.exchange(2)) + len("Asked questions 0 and 1."))
+
+    def test_least_recently_used_session_evicted(self):
+        store = SessionStore(max_sessions=2)
+        store.append("a", *self.exchange(1))
+        store.append("b", *self.exchange(1))
+        store.history("a")
+        store.append("c", *self.exchange(1))
+
+        self.assertEqual(list(store.sessions), ["a", "c"])
+        self.assertEqual(store.stats()["evictions"], 1)
+
+    def test_evicts_over_byte_cap(self):
+        one_exchange = sum(message_bytes(m) for m in self.exchange(1))
+        store = SessionStore(max_bytes=one_exchange * 3)
+        for user in range(10):
+            store.append(f"user-{user}", *self.exchange(1))
+
+        self.assertEqual(len(store.sessions), 3)
+        self.assertLessEqual(store.resident_bytes, store.max_bytes)
+        self.assertEqual(store.evictions, 7)
+
+    def test_idle_sessions_expire(self):
+        clock = FakeClock()
+        store = SessionStore(ttl_seconds=60, clock=clock)
+        store.append("idle", *self.exchange(1))
+        clock.now = 30
+        store.append("active", *self.exchange(1))
+        clock.now = 61
+
+        store.append("active", *self.exchange(2))
+        self.assertNotIn("idle", store.sessions)
+        clock.now = 200
+        self.assertEqual(store.history("active"), [])
+
+        stats = store.stats()
+        self.assertEqual(stats["expirations"], 2)
+        self.assertEqual(stats["sessions"], 0)
+        self.assertEqual(stats["resident_bytes"], 0)
+
+    def test_hit_and_miss_counters(self):
+        store = SessionStore()
+        store.history("nobody")
+        store.append("user", *self.exchange(1))
+        store.history("user")
+
+        self.assertEqual((store.hits, store.misses), (1, 1))
+
+    def test_clear(self):
+        store = SessionStore()
+        store.append("a", *self.exchange(1))
+        store.append("b", *self.exchange(1))
+        store.clear("a")
+        self.assertEqual(list(store.sessions), ["b"])
+        store.clear()
+        self.assertEqual(store.stats()["sessions"], 0)
+        self.assertEqual(store.resident_bytes, 0)
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
\ No newline at end of file
@@ -0,0 +1,165 @@
+"""Client for the Benny AI service"""
+
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import httpx
+
+import tracing
+from metrics import REGISTRY
+from config import (BENNY_AI_URL, BENNY_AI_TIMEOUT, BENNY_AI_CONNECT_TIMEOUT,
+                    BENNY_AI_MAX_CONNECTIONS, BENNY_AI_MAX_KEEPALIVE,
+                    BENNY_AI_KEEPALIVE_EXPIRY, BENNY_AI_HTTP2)
+
+log = tracing.get_logger("benny.backend.ai_client")
+
+# latency of calls to the AI service, for /metrics (bennyDB must be on sys.path)
+AI_CALL_SECONDS = REGISTRY.histogram(
+    "benny_ai_client_request_duration_seconds", "Time for a call to the AI service, by endpoint and outcome",
+    ("endpoint", "outcome"))
+
+
+@dataclass
+class AIResponse:
+    """Result of one call to the AI service, never raised as an exception"""
+    success: bool
+    response: Optional[str]
+    tokens_used: int = 0
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+    elapsed_ms: float = 0.0
+    # the AI service's Server-Timing stages in milliseconds, e.g. {"llm": 310.5, "total": 312.9}
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+class CallTimings:
+    """Call count, errors and latency for one AI service endpoint"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, elapsed_ms: float, success: bool):
+        self.count += 1
+        self.errors += 0 if success else 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def as_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3)
+        }
+
+
+def http2_available() -> bool:
+    """HTTP/2 needs the optional h2 package (pip install httpx[http2])"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def create_http_client(base_url: str = BENNY_AI_URL, http2: bool = BENNY_AI_HTTP2) -> httpx.AsyncClient:
+    """Long-lived pooled client, connections are kept alive between check-ins"""
+    if http2 and not http2_available():
+        log.warning("http2 unavailable", detail="BENNY_AI_HTTP2 is set but h2 is not installed, using HTTP/1.1")
+        http2 = False
+    return httpx.AsyncClient(
+        base_url=base_url,
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=BENNY_AI_MAX_CONNECTIONS,
+            max_keepalive_connections=BENNY_AI_MAX_KEEPALIVE,
+            keepalive_expiry=BENNY_AI_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(BENNY_AI_TIMEOUT, connect=BENNY_AI_CONNECT_TIMEOUT)
+    )
+
+
+class BennyAIClient:
+    """
+    Typed wrapper for the AI service's /recommend and /chat.
+
+    Create one per process (the app lifespan does) so every request reuses
+    the same connection pool. Failures come back as AIResponse(success=False)
+    with the error, so callers can carry on without a recommendation.
+
+    Calls made while a request is traced send its X-Request-ID, and add an
+    "ai" stage plus the AI service's own stages (as "ai_<stage>") to it.
+    """
+
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None):
+        self.http_client = http_client or create_http_client()
+        self.timings = {"recommend": CallTimings(), "chat": CallTimings()}
+
+    async def recommend(self, daily_checkin: Dict[str, str]) -> AIResponse:
+        """One-sentence recommendation for a daily check-in"""
+        return await self._post("recommend", "/recommend", {"daily_checkin": daily_checkin})
+
+    async def chat(self, message: str, token: Optional[str] = None) -> AIResponse:
+        """Benny's reply to a chat message, saved under the user of the sign-in token if given"""
+        headers = {"Authorization": f"Bearer {token}"} if token else None
+        return await self._post("chat", "/chat", {"message": message}, headers)
+
+    def stats(self) -> Dict:
+        """Per-endpoint call timings"""
+        return {name: timings.as_dict() for name, timings in self.timings.items()}
+
+    async def aclose(self):
+        await self.http_client.aclose()
+
+    async def _post(self, name: str, path: str, body: Dict,
+                    headers: Optional[Dict[str, str]] = None) -> AIResponse:
+        headers = dict(headers or {})
+        request_id = tracing.request_id()
+        if request_id:
+            headers[tracing.REQUEST_ID_HEADER] = request_id
+
+        started = time.perf_counter()
+        with tracing.span("ai"):
+            try:
+                http_response = await self.http_client.post(path, json=body, headers=headers)
+                result = self._parse(http_response)
+            except httpx.HTTPError as e:
+                result = AIResponse(success=False, response=None, error=f"{type(e).__name__}: {e}")
+
+        result.elapsed_ms = round((time.perf_counter() - started) * 1000, 3)
+        self.timings[name].add(result.elapsed_ms, result.success)
+        AI_CALL_SECONDS.observe(result.elapsed_ms / 1000, name, "ok" if result.success else "error")
+        current = tracing.current_trace.get()
+        if current is not None:
+            for stage, ms in result.timings.items():
+                current.add(f"ai_{stage}", ms / 1000)
+        log.info("ai call", endpoint=name, success=result.success, status_code=result.status_code,
+                 elapsed_ms=result.elapsed_ms, error=result.error, ai_timings=result.timings)
+        return result
+
+    @staticmethod
+    def _parse(http_response: httpx.Response) -> AIResponse:
+        timings = tracing.parse_server_timing(http_response.headers.get("server-timing"))
+        if http_response.status_code != 200:
+            return AIResponse(success=False, response=None, error=f"HTTP {http_response.status_code}",
+                              status_code=http_response.status_code, timings=timings)
+        try:
+            data = http_response.json()
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            # e.g. a proxy's HTML error page with a 200
+            return AIResponse(success=False, response=None, error="Invalid JSON response",
+                              status_code=http_response.status_code, timings=timings)
+        return AIResponse(
+            success=bool(data.get("success")),
+            response=data.get("response"),
+            tokens_used=data.get("tokens_used", 0),
+            error=data.get("error"),
+            status_code=http_response.status_code,
+            timings=timings
+        )
@@ -6,4 +6,27 @@ config = Config('.env')
 SECRET_KEY = config('SECRET_KEY', cast=str)
 GOOGLE_CLIENT_ID = config('GOOGLE_CLIENT_ID', cast=str, default=None)
 GOOGLE_CLIENT_SECRET = config('GOOGLE_CLIENT_SECRET', cast=str, default=None)
-# Need to add Apple and Facebook Client secrets at some point
\ No newline at end of file
+# Need to add Apple and Facebook Client secrets at some point
+
+# /debug/db-stats, /debug/ai-stats and /debug/job-stats, off unless asked for
+DEBUG_ENDPOINTS_ENABLED = config('DEBUG_ENDPOINTS_ENABLED', cast=bool, default=False)
+
+# Database query instrumentation, see /debug/db-stats
+DB_STATS_ENABLED = config('DB_STATS_ENABLED', cast=bool, default=False)
+DB_SLOW_QUERY_MS = config('DB_SLOW_QUERY_MS', cast=float, default=100.0)
+
+# Benny AI service, one pooled HTTP client is shared by every request
+BENNY_AI_URL = config('BENNY_AI_URL', cast=str, default='http://127.0.0.1:8001')
+BENNY_AI_TIMEOUT = config('BENNY_AI_TIMEOUT', cast=float, default=30.0)
+BENNY_AI_CONNECT_TIMEOUT = config('BENNY_AI_CONNECT_TIMEOUT', cast=float, default=2.0)
+BENNY_AI_MAX_CONNECTIONS = config('BENNY_AI_MAX_CONNECTIONS', cast=int, default=100)
+BENNY_AI_MAX_KEEPALIVE = config('BENNY_AI_MAX_KEEPALIVE', cast=int, default=20)
+BENNY_AI_KEEPALIVE_EXPIRY = config('BENNY_AI_KEEPALIVE_EXPIRY', cast=float, default=30.0)
+BENNY_AI_HTTP2 = config('BENNY_AI_HTTP2', cast=bool, default=False)
+
+# Background jobs that fetch check-in recommendations, see jobs.py
+RECOMMENDATION_WORKERS = config('RECOMMENDATION_WORKERS', cast=int, default=4)
+RECOMMENDATION_MAX_ATTEMPTS = config('RECOMMENDATION_MAX_ATTEMPTS', cast=int, default=3)
+RECOMMENDATION_RETRY_DELAY = config('RECOMMENDATION_RETRY_DELAY', cast=float, default=5.0)
+RECOMMENDATION_POLL_INTERVAL = config('RECOMMENDATION_POLL_INTERVAL', cast=float, default=2.0)
+RECOMMENDATION_LEASE = config('RECOMMENDATION_LEASE', cast=float, default=120.0)
@@ -0,0 +1,210 @@
+"""Background jobs that turn submitted check-ins into Benny's recommendations"""
+
+import asyncio
+import datetime
+import time
+import uuid
+from typing import Dict, List, Optional, Set
+
+import tracing
+from config import (RECOMMENDATION_WORKERS, RECOMMENDATION_MAX_ATTEMPTS,
+                    RECOMMENDATION_RETRY_DELAY, RECOMMENDATION_POLL_INTERVAL,
+                    RECOMMENDATION_LEASE)
+
+# job states, the same strings bennyDB stores in recommendation_jobs.status
+FINISHED = ("done", "failed")
+
+# saving an attempt's outcome is tried this many times, SAVE_RETRY_DELAY apart and doubling
+SAVE_ATTEMPTS = 3
+SAVE_RETRY_DELAY = 0.2
+
+log = tracing.get_logger("benny.backend.jobs")
+
+
+class RecommendationJobRunner:
+    """
+    A fixed pool of workers that claim queued jobs from the database.
+    db is an async_sharded_wellness_ai_db: a job is stored on its user's
+    shard next to their daily log, and workers claim from every shard.
+
+    The job lives in recommendation_jobs, so a check-in submitted just before
+    a restart is still answered: jobs the old process left running are
+    queued again on start(). Workers wake as soon as a job is submitted, and
+    also check every poll_interval seconds for retries that have come due.
+    A failed call is retried after retry_delay, doubling each time, until
+    max_attempts is reached. Each attempt is traced under the request id of
+    the check-in that queued it, which is passed on to the AI service.
+    A claimed job is leased to its worker for lease seconds; if its outcome
+    can't be saved it stays running and is claimed again when the lease ends.
+    """
+
+    def __init__(self, db, benny_ai, workers: int = RECOMMENDATION_WORKERS,
+                 max_attempts: int = RECOMMENDATION_MAX_ATTEMPTS,
+                 retry_delay: float = RECOMMENDATION_RETRY_DELAY,
+                 poll_interval: float = RECOMMENDATION_POLL_INTERVAL,
+                 lease: float = RECOMMENDATION_LEASE):
+        self.db = db
+        self.benny_ai = benny_ai
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.lease = lease
+
+        self.wakeup = asyncio.Event()
+        self.finished: Dict[str, Set[asyncio.Event]] = {}   # job_id -> one event per waiting get(), set when it is done or failed
+        self.tasks: List[asyncio.Task] = []
+        self.next_shard = 0   # where the next claim starts looking, so no shard is favoured
+
+        self.submitted = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.requeued = 0
+        self.unsaved = 0
+
+    async def start(self):
+        """Requeue jobs interrupted by the last shutdown, then start the workers"""
+        self.requeued = sum(await asyncio.gather(*(self.db.shard(shard_id).write("requeue_running_recommendation_jobs")
+                                                   for shard_id in self.db.shard_ids())))
+        if self.requeued:
+            log.warning("recommendation jobs requeued", count=self.requeued)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Cancel the workers, a job cut off here stays running and is requeued on the next start"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def submit(self, checkin: Dict[str, str], user_id: str = "anonymous") -> str:
+        """Save the check-in and queue its job in one write, returns the job id"""
+        job_id = uuid.uuid4().hex
+        today = datetime.date.today().isoformat()
+        await self.db.write(user_id, "add_checkin_with_job", job_id, today, checkin, user_id, tracing.request_id())
+        self.submitted += 1
+        self.wakeup.set()
+        return job_id
+
+    async def get(self, job_id: str, wait: float = 0) -> Optional[Dict]:
+        """The job as stored, waiting up to wait seconds for it to finish. None if unknown"""
+        if wait <= 0:
+            return await self._find(job_id)
+        # registered before the first read, so a job finishing during that read still wakes us
+        finished = asyncio.Event()
+        self.finished.setdefault(job_id, set()).add(finished)
+        try:
+            job = await self._find(job_id)
+            if job is None or job["status"] in FINISHED:
+                return job
+            try:
+                await asyncio.wait_for(finished.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+            return await self._find(job_id)
+        finally:
+            waiting = self.finished.get(job_id)
+            if waiting is not None:
+                waiting.discard(finished)
+                if not waiting:
+                    del self.finished[job_id]
+
+    async def _find(self, job_id: str) -> Optional[Dict]:
+        """The job from whichever shard holds it, all shards are asked at once"""
+        jobs = await self.db.read_each("get_recommendation_job", job_id)
+        return next((job for job in jobs if job is not None), None)
+
+    def stats(self) -> Dict:
+        """Worker count and job counters since startup"""
+        return {
+            "workers": len(self.tasks),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "unsaved": self.unsaved,
+            "requeued_on_start": self.requeued
+        }
+
+    async def _worker(self):
+        while True:
+            # cleared before claiming, so a submit that lands after an empty claim still wakes us
+            self.wakeup.clear()
+            try:
+                job = await self._claim()
+            except Exception as e:
+                log.error("recommendation job claim failed", error=str(e))
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            with tracing.start_trace(job["request_id"]) as trace:
+                try:
+                    status = await self._run(job)
+                except Exception as e:
+                    # one bad attempt must not take the worker down with it
+                    log.error("recommendation job attempt crashed", job_id=job["job_id"], error=str(e))
+                    status = await self._settle(job, None, f"{type(e).__name__}: {e}")
+                log.info("recommendation job attempt", job_id=job["job_id"], attempt=job["attempts"],
+                         status=status, duration_ms=round(trace.elapsed_ms(), 3), timings=trace.timings())
+
+    async def _claim(self) -> Optional[Dict]:
+        """The next due job, trying each shard in turn"""
+        shard_ids = self.db.shard_ids()
+        self.next_shard += 1
+        for n in range(len(shard_ids)):
+            shard_id = shard_ids[(self.next_shard + n) % len(shard_ids)]
+            job = await self.db.shard(shard_id).write("claim_recommendation_job", self.lease)
+            if job is not None:
+                return job
+        return None
+
+    async def _run(self, job: Dict) -> str:
+        """One attempt at a job, returns the status it was left in"""
+        result = await self.benny_ai.recommend(job["checkin"])
+        if result.success and result.response:
+            return await self._settle(job, result.response, None)
+        return await self._settle(job, None, result.error)
+
+    async def _settle(self, job: Dict, recommendation: Optional[str], error: Optional[str]) -> str:
+        """Save an attempt's outcome: done, queued again for a retry, or failed for good"""
+        job_id = job["job_id"]
+        try:
+            if recommendation:
+                await self._save(job, "complete_recommendation_job", job_id, recommendation)
+                self.completed += 1
+                status = "done"
+            elif job["attempts"] < self.max_attempts:
+                retry_at = time.time() + self.retry_delay * 2 ** (job["attempts"] - 1)
+                await self._save(job, "fail_recommendation_job", job_id, error, retry_at)
+                self.retried += 1
+                return "queued"
+            else:
+                await self._save(job, "fail_recommendation_job", job_id, error)
+                self.failed += 1
+                status = "failed"
+        except Exception as e:
+            # the job stays running and is claimed again once its lease ends
+            log.error("recommendation job not saved", job_id=job_id, error=str(e))
+            self.unsaved += 1
+            status = "running"
+
+        # waiting pollers re-read the job, whether or not it was saved
+        for finished in self.finished.pop(job_id, ()):
+            finished.set()
+        return status
+
+    async def _save(self, job: Dict, name: str, *args):
+        """db.write on the job user's shard, retried with backoff so a brief database error doesn't lose the outcome"""
+        for attempt in range(SAVE_ATTEMPTS):
+            try:
+                return await self.db.write(job["user_id"], name, *args)
+            except Exception as e:
+                if attempt == SAVE_ATTEMPTS - 1:
+                    raise
+                log.warning("recommendation job save retried", query=name, attempt=attempt + 1, error=str(e))
+                await asyncio.sleep(SAVE_RETRY_DELAY * 2 ** attempt)
@@ -1,26 +1,65 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import APIRouter, FastAPI, HTTPException, Depends, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware 
 from pydantic import BaseModel
 from typing import List, Optional
+from contextlib import asynccontextmanager
 import uvicorn
-import datetime
 import sys
 from pathlib import Path
-from config import SECRET_KEY
+from config import SECRET_KEY, DB_STATS_ENABLED, DB_SLOW_QUERY_MS, DEBUG_ENDPOINTS_ENABLED
 from routers import auth, users
-import httpx
 
 # add bennyDB directory to Python path
 bennydb_path = Path(__file__).parent.parent/"bennyDB"
 sys.path.append(str(bennydb_path))
 
-import db_connector_real
-db = db_connector_real.wellness_ai_db()
-print("Database connected successfully!")
+import db_async
+from db_connector_real import ANONYMOUS_USER
+import metrics
+import tracing
+from benny_client import BennyAIClient
+from jobs import RecommendationJobRunner
+# one JSON log line per event, carrying the request id
+tracing.configure_logging()
+log = tracing.get_logger("benny.backend")
 
+# database calls run on worker threads so handlers never block the event loop
+# db holds the reference tables (check-in questions), user_db each user's own rows,
+# spread over the shard files and routed by the catalog (see bennyDB/db_shards.py)
+db = db_async.async_wellness_ai_db()
+user_db = db_async.async_sharded_wellness_ai_db()
+if DB_STATS_ENABLED:
+    db.sync.enable_stats(slow_query_ms=DB_SLOW_QUERY_MS)
+    for shard_id in user_db.shard_ids():
+        user_db.sync.shard(shard_id).enable_stats(slow_query_ms=DB_SLOW_QUERY_MS)
+log.info("database connected")
 
-app = FastAPI()
+# client for the AI service, one connection pool for the whole process
+benny_ai = None
+# workers that fetch check-in recommendations in the background
+recommendation_jobs = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Open the AI service client and start the recommendation workers on startup,
+    stop the workers and close the client's connections on shutdown
+    """
+    global benny_ai, recommendation_jobs
+    benny_ai = BennyAIClient()
+    recommendation_jobs = RecommendationJobRunner(user_db, benny_ai)
+    await recommendation_jobs.start()
+    yield
+    await recommendation_jobs.stop()
+    await benny_ai.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+# request latency and in-flight counts by route, served at /metrics
+app.add_middleware(metrics.http_metrics)
+# X-Request-ID and Server-Timing on every response, one log line per request
+app.add_middleware(tracing.request_tracing)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -32,6 +71,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE"],
     allow_headers=["*"],
+    # so the frontend can read them when reporting a slow check-in
+    expose_headers=["X-Request-ID", "Server-Timing"],
 )
 app.include_router(auth.router)
 app.include_router(users.router)
@@ -64,101 +105,168 @@ async def health_check():
         "database_connected": db is not None,
     }
 
+# /debug/* shows SQL text and lets callers reset counters, so it is only served
+# when DEBUG_ENDPOINTS_ENABLED is set (local profiling, never in production)
+debug = APIRouter(prefix="/debug")
+
+@debug.get("/db-stats")
+async def db_stats(reset: bool = False):
+    """
+    Per-statement timings, row counts, lock waits and the slow query log,
+    for the main database and under "shards" for each user shard.
+    Only collected when DB_STATS_ENABLED is set.
+    """
+    databases = [db.sync] + [user_db.sync.shard(shard_id) for shard_id in user_db.shard_ids()]
+    stats = db.sync.get_stats()
+    stats["shards"] = {shard_id: user_db.sync.shard(shard_id).get_stats() for shard_id in user_db.shard_ids()}
+    if reset:
+        for database in databases:
+            if database.stats is not None:
+                database.stats.reset()
+    return stats
+
+@debug.get("/ai-stats")
+async def ai_stats():
+    """Call counts, errors and latency of requests to the Benny AI service"""
+    return benny_ai.stats()
+
+@debug.get("/job-stats")
+async def job_stats():
+    """Recommendation job counters since startup"""
+    return recommendation_jobs.stats()
+
+if DEBUG_ENDPOINTS_ENABLED:
+    app.include_router(debug)
+
+def job_counts():
+    """Recommendation job counters for /metrics"""
+    if recommendation_jobs is None:
+        return {}
+    return {(name,): value for name, value in recommendation_jobs.stats().items()}
+
+metrics.REGISTRY.callback_gauge(
+    "benny_recommendation_jobs", "Recommendation workers and job counters since startup", ("stat",), job_counts)
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus text format: request latency by route, AI service calls and time in the database"""
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+# clients may reuse the questions for this long before revalidating with the ETag
+QUESTIONS_MAX_AGE = 300
+
+@app.get("/api/checkin/questions")
+async def get_checkin_questions(request: Request, response: Response):
+    """
+    Daily check-in questions, served from the reference cache.
+    Repeat clients send If-None-Match and get a 304 without a body.
+    """
+    if not db:
+        raise HTTPException(status_code=500, detail="Database not connected")
+
+    questions, etag = await db.read("get_form_questions_with_etag")
+    cache_headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={QUESTIONS_MAX_AGE}",
+    }
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=cache_headers)
+
+    response.headers.update(cache_headers)
+    return {
+        "success": True,
+        "questions": [{"id": row[0], "question": row[1]} for row in questions]
+    }
+
 @app.post("/api/checkin/submit")
-async def submit_checkin(submission: CheckInSubmission):
-    """Submit daily check-in responses"""
+async def submit_checkin(submission: CheckInSubmission,
+                         user_id: Optional[str] = Depends(users.get_optional_user_id)):
+    """
+    Submit daily check-in responses, saved under the signed-in user if a token is sent.
+    Returns once the check-in is saved, Benny's recommendation is made by a
+    background job: poll recommendation_url until it is done.
+    """
     
     if not db:
         raise HTTPException(status_code=500, detail="Database not connected")
 
     try:
-        # Get today's date
-        today = datetime.datetime.now().strftime("%m/%d/%Y")
-        
         # Process the responses into the format the database expects
         checkin_data = {}
         
         for response in submission.responses:
             checkin_data[response.category] = response.response
         
-        print(f"Saving check-in for {today}: {checkin_data}")
-        
-        # Simple database insert
-        db.run_query("""
-            INSERT INTO daily_log_table 
-            (log_date, nutrition, sleep_quality, stress_level, activity_complete, activity_name, user_program_row_id, activity_addresses_goal)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, today, checkin_data.get("nutrition"), checkin_data.get("sleep"), 
-            checkin_data.get("stress"), 1, "Daily Check-in", 1, 1)
-        
-        print(f"Saved to database")
-
-        # Call AI for recommendation
-        benny_recommendation = None
-        try:
-            import httpx
-
-            async with httpx.AsyncClient() as client:
-                ai_response = await client.post(
-                    "http://127.0.0.1:8001/recommend",
-                    json={"daily_checkin": checkin_data},
-                    timeout=30.0
-                )
-
-                if ai_response.status_code == 200:
-                    ai_data = ai_response.json()
-                    if ai_data.get("success"):
-                        benny_recommendation = ai_data.get("response")
-
-        except Exception:
-            pass    # continue without rec iv AI service fails
+        # the daily log row and its recommendation job are saved in one transaction on the
+        # user's shard, the job keeps this request's id and sends it on to the AI service
+        job_id = await recommendation_jobs.submit(checkin_data, user_id or ANONYMOUS_USER)
+        log.info("checkin saved", job_id=job_id)
 
         return {
             "success": True,
             "message": "Check-in saved!",
             "data": checkin_data,
-            "recommendation": benny_recommendation
+            "recommendation": None,
+            "job_id": job_id,
+            "recommendation_url": f"/api/checkin/recommendation/{job_id}"
         }
         
     except Exception as e:
-        print(f"Error: {e}")
+        log.error("checkin not saved", error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
+
+# longest a poll may wait for a job to finish
+RECOMMENDATION_MAX_WAIT = 30
+
+@app.get("/api/checkin/recommendation/{job_id}")
+async def get_checkin_recommendation(job_id: str, wait: float = Query(0, ge=0, le=RECOMMENDATION_MAX_WAIT)):
+    """
+    Status of a check-in's recommendation job: queued, running, done or failed.
+    With ?wait=N the request is held for up to N seconds until the job finishes,
+    so a client can long-poll instead of asking repeatedly.
+    """
+    job = await recommendation_jobs.get(job_id, wait)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Recommendation job not found")
+    return {
+        "success": True,
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "recommendation": job["recommendation"],
+        "attempts": job["attempts"],
+        "error": job["error"]
+    }
     
 @app.get("/api/chat/recent")
-async def get_recent_chat_messages():
-#
-# async def get_recent_chat_messages(current_user: dict = Depends(users.get_current_user)):
-#
+async def get_recent_chat_messages(
+    before: Optional[str] = Query(None, description="Cursor from next_before of the previous page"),
+    limit: int = Query(10, ge=1, le=100),
+    current_user: dict = Depends(users.get_current_user),
+):
     """
-    Get the last 10 recent chat messages
+    Get the current user's chat messages, newest page first.
+    Pass the returned next_before as ?before= to load older messages.
     """
 
     if not db:
         raise HTTPException(status_code=500, detail="Database not connected")
-    
-    # Add this in to query individual user history
-    # user_id = current_user['user']['sub']
-    # print(f"Fetching chat history for user: {user_id}")
-    
+
+    user_id = current_user['user']['sub']
+
+    # cursor is "<date>:<sequence_number>" of the oldest message already shown
+    before_date, before_seq = None, None
+    if before:
+        try:
+            before_date, before_seq = before.rsplit(":", 1)
+            before_seq = int(before_seq)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
     try:
-        # get database chat history
-        # -- WHERE ch.user_id = ?  <-- Something like this needs to be added to separate user history
-        query = """
-        SELECT
-            che.sequence_number,
-            che.user_or_benny,
-            che.entry_text,
-            ch.date
-        FROM chat_history_entries che
-        JOIN chat_history ch ON che.fk_row_id =  ch.row_id
-        ORDER BY ch.date DESC, che.sequence_number DESC
-        LIMIT 10
-        """
-
-        # result = db.run_query(query, user_id) 
-        # The query would need the user_id
-        result = db.run_query(query)
-        messages = result.fetchall()
+        # keyset pagination, backed by the (user_id, date) and (fk_row_id, sequence_number) indexes
+        messages = await user_db.read(user_id, "fetch_chat_page", user_id, limit, before_date, before_seq)
 
         # format response
         formatted_messages = []
@@ -170,14 +278,22 @@ async def get_recent_chat_messages():
                 "date": message[3]
             })
 
+        next_before = None
+        if len(messages) == limit:
+            oldest = messages[-1]
+            next_before = f"{oldest[3]}:{oldest[0]}"
+
         formatted_messages.reverse()
         return {
             "success": True,
-            "messages": formatted_messages
+            "messages": formatted_messages,
+            "next_before": next_before
         }
     
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        print(f"Error fetching recent messages: {e}")
+        log.error("recent messages not fetched", error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
            
 
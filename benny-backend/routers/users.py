@@ -1,3 +1,4 @@
+from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import jwt
@@ -5,6 +6,7 @@ from routers.auth import SECRET_KEY
 
 router = APIRouter(prefix='/api/v1/users')
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 def decode_jwt(token: str):
     """
@@ -25,4 +27,12 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     """
     token = credentials.credentials
     user_data = decode_jwt(token)
-    return {"user": user_data}
\ No newline at end of file
+    return {"user": user_data}
+
+async def get_optional_user_id(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    """
+    The signed-in user's id, or None if no token was sent
+    """
+    if credentials is None:
+        return None
+    return decode_jwt(credentials.credentials)["sub"]
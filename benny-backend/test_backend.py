@@ -0,0 +1,330 @@
+"""Unit tests for the Benny backend, no AI service needed"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+# main opens the database when it is imported, so point it at a throwaway file first
+DIRECTORY = tempfile.mkdtemp(prefix="benny-backend-test-")
+os.environ["BENNY_DB_PATH"] = os.path.join(DIRECTORY, "BennyDB.sqlite3")
+os.environ.setdefault("SECRET_KEY", "test-secret-key-for-signing-tokens")
+
+import httpx
+
+import main
+# bennyDB is on the path once main is imported
+import db_async
+from benny_client import AIResponse, BennyAIClient
+import jobs
+from jobs import RecommendationJobRunner
+from routers.auth import generate_jwt
+
+
+def tearDownModule():
+    main.db.close()
+    main.user_db.close()
+    shutil.rmtree(DIRECTORY, ignore_errors=True)
+
+
+def auth_header(user_id):
+    return {"Authorization": f"Bearer {generate_jwt({'sub': user_id})}"}
+
+
+class BackendTestCase(unittest.IsolatedAsyncioTestCase):
+    """The backend app called in-process, without its lifespan"""
+
+    async def asyncSetUp(self):
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://backend")
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+
+
+class TestRecentChat(BackendTestCase):
+    """/api/chat/recent returns the chats the AI service saved under the signed-in user"""
+
+    async def test_chat_read_back_by_its_user(self):
+        # what the AI service writes for a /chat sent with this user's token
+        await main.user_db.write("recent-user", "append_chat_exchange", "recent-user", "2025-03-01",
+                                 "How do I sleep better?", "Try a fixed bedtime.")
+
+        response = await self.client.get("/api/chat/recent", headers=auth_header("recent-user"))
+        self.assertEqual(response.status_code, 200)
+        messages = response.json()["messages"]
+        self.assertEqual([message["entry_text"] for message in messages],
+                         ["How do I sleep better?", "Try a fixed bedtime."])
+
+        other = await self.client.get("/api/chat/recent", headers=auth_header("someone-else"))
+        self.assertEqual(other.json()["messages"], [])
+
+    async def test_token_required(self):
+        response = await self.client.get("/api/chat/recent")
+        self.assertIn(response.status_code, (401, 403))
+
+
+def ai_client(handler):
+    """BennyAIClient whose requests are answered by handler(request) -> httpx.Response"""
+    return BennyAIClient(httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://ai"))
+
+
+class TestBennyAIClient(unittest.IsolatedAsyncioTestCase):
+    """Every outcome of a call to the AI service comes back as an AIResponse"""
+
+    async def test_success_and_forwarded_headers(self):
+        seen = []
+
+        def handler(request):
+            seen.append(request)
+            return httpx.Response(200, json={"success": True, "response": "Drink water.", "tokens_used": 12},
+                                  headers={"server-timing": "llm;dur=40.5, total;dur=42"})
+
+        client = ai_client(handler)
+        result = await client.chat("hello", token="signed-token")
+        await client.aclose()
+
+        self.assertTrue(result.success)
+        self.assertEqual((result.response, result.tokens_used), ("Drink water.", 12))
+        self.assertEqual(result.timings, {"llm": 40.5, "total": 42.0})
+        self.assertEqual(seen[0].headers["authorization"], "Bearer signed-token")
+        self.assertEqual(client.stats()["chat"]["count"], 1)
+
+    async def test_failures_never_raise(self):
+        responses = [
+            httpx.Response(200, text="<html>Bad gateway</html>"),
+            httpx.Response(200, json=["not", "an", "object"]),
+            httpx.Response(503, text="unavailable"),
+        ]
+
+        def handler(request):
+            if not responses:
+                raise httpx.ConnectError("connection refused", request=request)
+            return responses.pop(0)
+
+        client = ai_client(handler)
+        results = [await client.recommend({"sleep": "poor"}) for _ in range(4)]
+        await client.aclose()
+
+        self.assertFalse(any(result.success for result in results))
+        self.assertEqual([result.status_code for result in results], [200, 200, 503, None])
+        self.assertEqual(results[0].error, "Invalid JSON response")
+        self.assertTrue(results[3].error.startswith("ConnectError"))
+        self.assertEqual(client.stats()["recommend"]["errors"], 4)
+
+
+class FakeAI:
+    """Stands in for BennyAIClient.recommend, answers are queued or held until released"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.release = asyncio.Event()
+        self.release.set()
+        self.calls = 0
+
+    async def recommend(self, checkin):
+        self.calls += 1
+        await self.release.wait()
+        outcome = self.outcomes.pop(0) if self.outcomes else "Walk for 10 minutes."
+        if isinstance(outcome, Exception):
+            raise outcome
+        return AIResponse(success=True, response=outcome)
+
+
+class TestRecommendationJobRunner(unittest.IsolatedAsyncioTestCase):
+    """Workers claim check-in jobs from the database and store the recommendation"""
+
+    CHECKIN = {"nutrition": "good", "sleep": "poor", "fitness": "yes", "stress": "high"}
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = db_async.async_sharded_wellness_ai_db(shard_count=2, directory=self.directory.name)
+        self.runners = []
+
+    async def asyncTearDown(self):
+        for runner in self.runners:
+            await runner.stop()
+        self.db.close()
+        self.directory.cleanup()
+
+    async def start(self, ai, db=None, **options):
+        runner = RecommendationJobRunner(db or self.db, ai, workers=2, retry_delay=0, poll_interval=0.05, **options)
+        await runner.start()
+        self.runners.append(runner)
+        return runner
+
+    async def wait_for_status(self, runner, job_id, *statuses):
+        for _ in range(200):
+            job = await runner.get(job_id)
+            if job["status"] in statuses:
+                return job
+            await asyncio.sleep(0.01)
+        self.fail(f"job never reached {statuses}")
+
+    async def test_job_completes(self):
+        runner = await self.start(FakeAI())
+        job_id = await runner.submit(self.CHECKIN, "job-user")
+        job = await runner.get(job_id, wait=5)
+        self.assertEqual((job["status"], job["recommendation"]), ("done", "Walk for 10 minutes."))
+
+    async def test_jobs_on_every_shard_complete(self):
+        runner = await self.start(FakeAI())
+        job_ids = {f"shard-user-{n}": await runner.submit(self.CHECKIN, f"shard-user-{n}") for n in range(8)}
+        self.assertEqual({self.db.sync.shard_id_for(user_id) for user_id in job_ids}, {0, 1})
+
+        for user_id, job_id in job_ids.items():
+            job = await runner.get(job_id, wait=5)
+            self.assertEqual((job["status"], job["user_id"]), ("done", user_id))
+
+    async def test_crashed_attempt_is_retried_and_worker_survives(self):
+        runner = await self.start(FakeAI(RuntimeError("boom"), ValueError("bad JSON")))
+        job_id = await runner.submit(self.CHECKIN)
+        job = await self.wait_for_status(runner, job_id, "done", "failed")
+
+        self.assertEqual((job["status"], job["attempts"]), ("done", 3))
+        self.assertEqual(runner.stats()["retried"], 2)
+        self.assertTrue(all(not task.done() for task in runner.tasks))
+
+    async def test_crashes_fail_the_job_after_max_attempts(self):
+        runner = await self.start(FakeAI(RuntimeError("boom"), RuntimeError("boom")), max_attempts=2)
+        job_id = await runner.submit(self.CHECKIN)
+        job = await runner.get(job_id, wait=5)
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["error"], "RuntimeError: boom")
+
+    async def test_long_poll_wakes_when_job_finishes_during_first_read(self):
+        ai = FakeAI()
+        ai.release.clear()
+        db = self.db
+        runner = None
+
+        class FinishDuringRead:
+            """The job finishes right after get()'s first read returns the running job"""
+            def __init__(self):
+                self.first = True
+
+            async def read_each(self, name, *args):
+                jobs = await db.read_each(name, *args)
+                if self.first:
+                    self.first = False
+                    ai.release.set()
+                    while runner.completed == 0:
+                        await asyncio.sleep(0.01)
+                return jobs
+
+            def __getattr__(self, name):
+                return getattr(db, name)
+
+        runner = await self.start(ai, db=FinishDuringRead())
+        job_id = await runner.submit(self.CHECKIN)
+        while ai.calls == 0:
+            await asyncio.sleep(0.01)
+
+        started = time.perf_counter()
+        job = await runner.get(job_id, wait=5)
+        self.assertEqual(job["status"], "done")
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual(runner.finished, {})
+
+    def failing_writes(self, name, times):
+        """self.db whose first `times` writes of name raise"""
+        db = self.db
+
+        class FailingWrites:
+            def __init__(self):
+                self.failures = 0
+
+            async def write(self, user_id, query, *args):
+                if query == name and self.failures < times:
+                    self.failures += 1
+                    raise RuntimeError("database is locked")
+                return await db.write(user_id, query, *args)
+
+            def __getattr__(self, attr):
+                return getattr(db, attr)
+
+        return FailingWrites()
+
+    @mock.patch("jobs.SAVE_RETRY_DELAY", 0)
+    async def test_failed_save_is_retried(self):
+        db = self.failing_writes("complete_recommendation_job", 1)
+        runner = await self.start(FakeAI(), db=db)
+        job_id = await runner.submit(self.CHECKIN)
+        job = await runner.get(job_id, wait=5)
+
+        self.assertEqual((job["status"], job["attempts"]), ("done", 1))
+        self.assertEqual(db.failures, 1)
+        self.assertEqual(runner.finished, {})
+
+    @mock.patch("jobs.SAVE_RETRY_DELAY", 0)
+    async def test_unsaved_job_wakes_pollers_and_is_claimed_again(self):
+        ai = FakeAI()
+        ai.release.clear()
+        db = self.failing_writes("complete_recommendation_job", jobs.SAVE_ATTEMPTS)
+        runner = await self.start(ai, db=db, lease=0.3)
+        job_id = await runner.submit(self.CHECKIN)
+        while ai.calls == 0:
+            await asyncio.sleep(0.01)
+
+        poll = asyncio.create_task(runner.get(job_id, wait=5))
+        await asyncio.sleep(0.05)
+        started = time.perf_counter()
+        ai.release.set()
+        job = await poll
+        self.assertEqual(job["status"], "running")
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual(runner.stats()["unsaved"], 1)
+
+        job = await self.wait_for_status(runner, job_id, "done", "failed")
+        self.assertEqual((job["status"], job["attempts"], ai.calls), ("done", 2, 2))
+
+    async def test_timed_out_poll_forgets_its_waiter(self):
+        ai = FakeAI()
+        ai.release.clear()
+        runner = await self.start(ai)
+        job_id = await runner.submit(self.CHECKIN)
+        job = await runner.get(job_id, wait=0.1)
+        self.assertIn(job["status"], ("queued", "running"))
+        self.assertEqual(runner.finished, {})
+        ai.release.set()
+
+
+class TestCheckinSubmit(BackendTestCase):
+    """A check-in is saved on the signed-in user's shard, anonymous without a token"""
+
+    CHECKIN = {"responses": [{"category": "sleep", "question": "How did you sleep?", "response": "poor"}]}
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        main.recommendation_jobs = RecommendationJobRunner(main.user_db, FakeAI())
+
+    async def asyncTearDown(self):
+        main.recommendation_jobs = None
+        await super().asyncTearDown()
+
+    async def test_saved_under_token_user(self):
+        for headers, user_id in ((auth_header("checkin-user"), "checkin-user"), ({}, "anonymous")):
+            response = await self.client.post("/api/checkin/submit", json=self.CHECKIN, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            job = await main.user_db.read(user_id, "get_recommendation_job", response.json()["job_id"])
+            self.assertEqual((job["user_id"], job["status"]), (user_id, "queued"))
+
+    async def test_bad_token_rejected(self):
+        response = await self.client.post("/api/checkin/submit", json=self.CHECKIN,
+                                          headers={"Authorization": "Bearer garbage"})
+        self.assertEqual(response.status_code, 401)
+
+
+class TestDebugEndpoints(BackendTestCase):
+    """/debug/* is not served unless DEBUG_ENDPOINTS_ENABLED is set"""
+
+    async def test_not_mounted_by_default(self):
+        for path in ("/debug/db-stats?reset=true", "/debug/ai-stats", "/debug/job-stats"):
+            response = await self.client.get(path)
+            self.assertEqual(response.status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -44,7 +44,11 @@ function Chat() {
     }
 
     try {
-      const res = await axios.post(`${API_URL}/chat`, { message: userInput });
+      // signed-in chats are saved under the user, so chat history can show them
+      const token = localStorage.getItem('authToken');
+      const res = await axios.post(`${API_URL}/chat`, { message: userInput }, {
+        headers: token ? { Authorization: `Bearer ${token}` } : {}
+      });
       let aiMessage = { type: 'ai', text: res.data.response || "Sorry, something went wrong." };
       // This will correctly append the AI response to the new message history
       setMessages(prev => [...prev, aiMessage]);
@@ -17,7 +17,10 @@ const ChatHistory = () => {
     const loadRecentMessages = async () => {
         try {
             setLoading(true);
-            const response = await axios.get(`${BACKEND_URL}/api/chat/recent`);
+            const token = localStorage.getItem('authToken');
+            const response = await axios.get(`${BACKEND_URL}/api/chat/recent`, {
+                headers: { Authorization: `Bearer ${token}` }
+            });
             if (response.data.success) {
                 setRecentMessages(response.data.messages);
             }
@@ -31,7 +34,7 @@ const ChatHistory = () => {
 
     const formatDateTime = (dateString) => {
         if (!dateString) return '';
-        const [month, day, year] = dateString.split('/');
+        const [year, month, day] = dateString.split('-');
         // Handle potential invalid date strings gracefully
         if (!month || !day || !year) return dateString;
         
@@ -5,6 +5,8 @@ import ChatBubble from './components/ChatBubble';
 import bennyIcon from './assets/benny_icon.png';
 
 const BACKEND_URL = 'http://127.0.0.1:8000';
+// give up on the recommendation after this many long-polls
+const RECOMMENDATION_POLLS = 6;
 
 const DailyCheckin = () => {
     const [messages, setMessages] = useState([]);
@@ -85,14 +87,21 @@ const DailyCheckin = () => {
     const submitCheckin = async (finalResponses) => {
         console.log('Submitting check-in: ', finalResponses);
         try {
+            // signed-in check-ins are saved under the user, on their database shard
+            const token = localStorage.getItem('authToken');
             const response = await axios.post(`${BACKEND_URL}/api/checkin/submit`, {
                 responses: finalResponses
+            }, {
+                headers: token ? { Authorization: `Bearer ${token}` } : {}
             });
 
             if (response.data.success) {
                 console.log('Check in submitted successfully');
                 if (response.data.recommendation) {
                     setBennyRecommendation(response.data.recommendation);
+                } else if (response.data.recommendation_url) {
+                    // made in the background, don't hold up the check-in for it
+                    waitForRecommendation(response.data.recommendation_url);
                 }
             } else {
                 console.error('check in submission failed.');
@@ -102,6 +111,28 @@ const DailyCheckin = () => {
         }
     };
 
+    // long-poll the recommendation job, each request waits up to 25 seconds on the server
+    const waitForRecommendation = async (recommendationUrl) => {
+        for (let attempt = 0; attempt < RECOMMENDATION_POLLS; attempt++) {
+            try {
+                const response = await axios.get(`${BACKEND_URL}${recommendationUrl}`, {
+                    params: { wait: 25 }
+                });
+                if (response.data.status === 'done') {
+                    setBennyRecommendation(response.data.recommendation);
+                    return;
+                }
+                if (response.data.status === 'failed') {
+                    console.warn('No recommendation today:', response.data.error);
+                    return;
+                }
+            } catch (error) {
+                console.error('Error fetching recommendation', error);
+                return;
+            }
+        }
+    };
+
     return (
         <div className="w-full max-w-3xl mx-auto text-center">
             <img src={bennyIcon} alt="Benny the Beaver" className="w-20 h-20 mb-4 mx-auto" />
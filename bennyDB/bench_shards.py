@@ -0,0 +1,81 @@
+# Write throughput benchmark for the sharded database.
+#
+# Runs the same chat-append workload against 1, 2, 4 and 8 shards in a
+# temporary folder and prints appends per second for each. Every writer thread
+# owns a set of users. synchronous defaults to FULL so each commit pays for an
+# fsync.
+#
+# Sharding only helps when writers spend most of their time waiting on a
+# shard's write lock while another commit is being flushed, i.e. when fsync is
+# slow compared to the Python work around it. On fast storage, or with a
+# single CPU, the threads are bound by the GIL instead and the results stay
+# flat or drop slightly with more shards (more files and connections). Run it
+# on the target machine before changing SHARD_COUNT; the cpus field says how
+# many cores the run had.
+#
+#   python bench_shards.py --threads 8 --writes 200 --shards 1 2 4 8
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+from db_shards import sharded_wellness_ai_db
+
+
+def run(shard_count, threads, writes_per_thread, synchronous):
+    with tempfile.TemporaryDirectory() as directory:
+        shards = sharded_wellness_ai_db(shard_count, directory, synchronous=synchronous)
+        users = [f"bench-user-{n}" for n in range(threads * 4)]
+        for user_id in users:
+            shards.shard_id_for(user_id)
+        start_line = threading.Barrier(threads + 1)
+
+        def writer(thread_number):
+            my_users = users[thread_number::threads]
+            start_line.wait()
+            for i in range(writes_per_thread):
+                user_id = my_users[i % len(my_users)]
+                # the route-checked path the backend and AI service use
+                shards.write_for(user_id, "append_chat_exchange", user_id, "2025-01-01", "How do I sleep better?", "Keep a regular bedtime.")
+
+        workers = [threading.Thread(target=writer, args=(n,)) for n in range(threads)]
+        for worker in workers:
+            worker.start()
+        start_line.wait()
+        started = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        shards.close()
+
+    total = threads * writes_per_thread
+    return {"shards": shard_count, "appends": total, "seconds": round(elapsed, 3),
+            "appends_per_second": round(total / elapsed, 1), "cpus": os.cpu_count()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chat writes across shard counts")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--writes", type=int, default=200, help="appends per thread")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--synchronous", default="FULL")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per shard count")
+    args = parser.parse_args()
+
+    baseline = None
+    for shard_count in args.shards:
+        result = run(shard_count, args.threads, args.writes, args.synchronous)
+        baseline = baseline or result["appends_per_second"]
+        result["speedup"] = round(result["appends_per_second"] / baseline, 2)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"{shard_count:>3} shards: {result['appends_per_second']:>9} appends/s  "
+                  f"({result['speedup']}x, {result['appends']} appends in {result['seconds']}s)")
+
+
+if __name__ == "__main__":
+    main()
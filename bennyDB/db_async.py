@@ -0,0 +1,170 @@
+# Async access to the Benny database for FastAPI handlers.
+#
+# sqlite3 calls block, so awaiting them directly from an async def stalls the
+# whole event loop. async_wellness_ai_db runs every call on a worker thread:
+# writes go to a single writer thread (SQLite only has one writer anyway, so
+# they queue there in order) and reads go to a small pool of reader threads
+# that use the read-only connections from db_pool.
+#
+#   db = async_wellness_ai_db()
+#   rows = (await db.run_query("SELECT ...", arg)).fetchall()
+#   questions = await db.read("get_form_questions_daily_checkin")
+#   await db.write("insert_row_chat_history_main", today)
+#
+# async_sharded_wellness_ai_db does the same for per-user rows spread over
+# db_shards' shard files. Each shard gets its own writer thread, so writes for
+# users on different shards run at the same time:
+#
+#   users = async_sharded_wellness_ai_db()
+#   await users.write(user_id, "append_chat_exchange", user_id, today, question, answer)
+#   page = await users.read(user_id, "fetch_chat_page", user_id, 10)
+
+import asyncio
+import concurrent.futures
+import functools
+import threading
+import time
+
+from db_connector_real import wellness_ai_db, is_read_query
+from db_shards import sharded_wellness_ai_db, user_moved
+from metrics import REGISTRY
+from tracing import span
+
+
+READER_THREADS = 4
+
+#time in wellness_ai_db calls, recorded on the worker threads for /metrics
+DB_CALL_SECONDS = REGISTRY.histogram(
+    "bennydb_call_duration_seconds", "Time a wellness_ai_db call ran on its worker thread", ("method", "thread"))
+DB_QUEUE_SECONDS = REGISTRY.histogram(
+    "bennydb_queue_wait_seconds", "Time a wellness_ai_db call waited for a free worker thread", ("thread",))
+
+
+class async_wellness_ai_db:
+    #db is an existing wellness_ai_db, otherwise one is opened with db_options
+    def __init__(self, db=None, reader_threads=READER_THREADS, **db_options):
+        self.sync = db if db is not None else wellness_ai_db(**db_options)
+        self.writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="bennydb-writer")
+        self.readers = concurrent.futures.ThreadPoolExecutor(
+            max_workers=reader_threads, thread_name_prefix="bennydb-reader")
+
+
+    async def _submit(self, executor, func, *args, **kwargs):
+        if isinstance(func, str):
+            func = getattr(self.sync, func)
+        thread = "writer" if executor is self.writer else "reader"
+        loop = asyncio.get_running_loop()
+        # the request's "db" stage in Server-Timing, queue wait included
+        with span("db"):
+            return await loop.run_in_executor(executor, functools.partial(
+                self._timed, func, thread, time.perf_counter(), args, kwargs))
+
+
+    #runs on the worker thread, so the histograms are updated from that thread's own shard
+    @staticmethod
+    def _timed(func, thread, submitted, args, kwargs):
+        started = time.perf_counter()
+        DB_QUEUE_SECONDS.observe(started - submitted, thread)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_CALL_SECONDS.observe(time.perf_counter() - started, getattr(func, "__name__", "call"), thread)
+
+
+    #same as wellness_ai_db.run_query, routed to a reader or the writer thread
+    async def run_query(self, query, *query_args):
+        executor = self.readers if is_read_query(query) else self.writer
+        return await self._submit(executor, self.sync.run_query, query, *query_args)
+
+
+    async def run_many(self, query, rows):
+        return await self._submit(self.writer, self.sync.run_many, query, rows)
+
+
+    #call a read-only wellness_ai_db method (by name) or any callable on a reader thread
+    async def read(self, func, *args, **kwargs):
+        return await self._submit(self.readers, func, *args, **kwargs)
+
+
+    #call a method or callable that writes on the writer thread
+    #use a callable with "with db.sync.transaction():" inside for multi-statement writes
+    async def write(self, func, *args, **kwargs):
+        return await self._submit(self.writer, func, *args, **kwargs)
+
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
+        self.sync.close()
+
+
+#read_on/write_on bound to one call, named after the method so the histograms still show it
+def _routed(method, shard_id, user_id, func):
+    call = functools.partial(method, shard_id, user_id, func)
+    call.__name__ = func if isinstance(func, str) else getattr(func, "__name__", "call")
+    return call
+
+
+class async_sharded_wellness_ai_db:
+    #shards is an existing sharded_wellness_ai_db, otherwise one is opened with shard_options
+    #reader_threads is per shard
+    def __init__(self, shards=None, reader_threads=READER_THREADS, **shard_options):
+        self.sync = shards if shards is not None else sharded_wellness_ai_db(**shard_options)
+        self.reader_threads = reader_threads
+        self.shards = {}
+        self.shards_lock = threading.Lock()
+
+
+    #async_wellness_ai_db for one shard, for calls that aren't about one user (claiming jobs, stats)
+    def shard(self, shard_id):
+        with self.shards_lock:
+            if shard_id not in self.shards:
+                self.shards[shard_id] = async_wellness_ai_db(self.sync.shard(shard_id), self.reader_threads)
+            return self.shards[shard_id]
+
+
+    def shard_ids(self):
+        return self.sync.shard_ids()
+
+
+    async def _shard_id_for(self, user_id):
+        shard_id = self.sync.catalog.lookup(user_id)
+        if shard_id is None:
+            # placing a new user commits to the catalog, keep that off the event loop
+            shard_id = await asyncio.to_thread(self.sync.shard_id_for, user_id)
+        return shard_id
+
+
+    #call a read-only method (by name) or func(db, ...) on the user's shard, on one of its reader threads
+    async def read(self, user_id, func, *args, **kwargs):
+        while True:
+            shard_id = await self._shard_id_for(user_id)
+            try:
+                return await self.shard(shard_id).read(_routed(self.sync.read_on, shard_id, user_id, func), *args, **kwargs)
+            except user_moved:
+                pass
+
+
+    #call a method or func(db, ...) that writes the user's rows, on their shard's writer thread
+    #runs in one transaction that also checks the user wasn't moved away meanwhile
+    async def write(self, user_id, func, *args, **kwargs):
+        while True:
+            shard_id = await self._shard_id_for(user_id)
+            try:
+                return await self.shard(shard_id).write(_routed(self.sync.write_on, shard_id, user_id, func), *args, **kwargs)
+            except user_moved:
+                pass
+
+
+    #call a read-only method on every shard at once, results in shard_ids() order
+    async def read_each(self, func, *args, **kwargs):
+        return await asyncio.gather(*(self.shard(shard_id).read(func, *args, **kwargs)
+                                      for shard_id in self.shard_ids()))
+
+
+    def close(self):
+        for db in self.shards.values():
+            db.writer.shutdown(wait=True)
+            db.readers.shutdown(wait=True)
+        self.sync.close()
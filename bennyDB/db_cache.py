@@ -0,0 +1,78 @@
+# Read-through cache for the Benny reference tables.
+#
+# questions, preferences_list and user_priorities are read on almost every
+# request but only change when someone edits them. Each cached value remembers
+# the version of the tables it was loaded from; wellness_ai_db bumps a table's
+# version after every committed write to it, so the next read reloads. Writes
+# made by another process are not seen here, max_age bounds how stale a value
+# can get in that case.
+
+import hashlib
+import re
+import threading
+import time
+
+
+REFERENCE_TABLES = ("questions", "preferences_list", "user_priorities")
+MAX_AGE_SECONDS = 60
+
+#table written by an INSERT/UPDATE/DELETE/REPLACE/DROP/ALTER statement
+WRITE_TABLE_PATTERN = re.compile(
+    r"^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM"
+    r"|DROP\s+TABLE(?:\s+IF\s+EXISTS)?|ALTER\s+TABLE)\s+[\"'`\[]?(\w+)",
+    re.IGNORECASE)
+
+
+def written_table(query):
+    match = WRITE_TABLE_PATTERN.match(query)
+    return match.group(1).lower() if match else None
+
+
+#stable hash of a cached value, used as an HTTP ETag
+def content_etag(value):
+    return '"' + hashlib.sha1(repr(value).encode("utf-8")).hexdigest()[:16] + '"'
+
+
+class reference_cache:
+    def __init__(self, tables=REFERENCE_TABLES, max_age=MAX_AGE_SECONDS):
+        self.tables = set(tables)
+        self.max_age = max_age
+        self.versions = {table: 0 for table in self.tables}
+        self.entries = {}   # key -> (table versions, loaded at, value, etag)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def _snapshot(self, tables):
+        return tuple(self.versions[table] for table in tables)
+
+
+    #cached (value, etag) for key, calling loader() when missing, invalidated or too old
+    def get(self, key, tables, loader):
+        versions = self._snapshot(tables)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == versions and time.monotonic() - entry[1] < self.max_age:
+            self.hits += 1
+            return entry[2], entry[3]
+
+        self.misses += 1
+        # versions were read before loading, so a write that lands during the
+        # load leaves this entry already out of date instead of caching stale rows
+        value = loader()
+        etag = content_etag(value)
+        with self.lock:
+            self.entries[key] = (versions, time.monotonic(), value, etag)
+        return value, etag
+
+
+    #called after a write to table has committed
+    def invalidate(self, table):
+        if table in self.tables:
+            with self.lock:
+                self.versions[table] += 1
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
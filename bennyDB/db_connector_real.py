@@ -3,39 +3,286 @@
 # my own work based off of this db manager I produced for CS361, 
 # and CS361 course materials. 
 
+import contextlib
 import datetime
+import json
+import os
 import requests
 import sqlite3
 import pathlib
+import threading
+import time
+
+import db_migrations
+from db_cache import reference_cache, written_table
+from db_stats import query_stats
+from db_pool import connection_pool, buffered_result
 
 
 FRONTEND_URL = "http://localhost:5173/"
 BENNY_AI_URL = "http://127.0.0.1:8001"
 
-DATABASE_PATH = pathlib.Path(__file__).parent / "BennyDB.sqlite3"
+#BENNY_DB_PATH points every service at another file, e.g. a throwaway one for load tests
+DATABASE_PATH = pathlib.Path(os.getenv("BENNY_DB_PATH") or pathlib.Path(__file__).parent / "BennyDB.sqlite3")
+
+#seed rows for the reference tables
+POSSIBLE_PREFERENCES = [
+    "sleep",
+    "meditation",
+    "outside time",
+    "strength training",
+    "cardiovascular training",
+    "mobility training",
+    "protein intake",
+    "fruit and veggie intake",
+    "hydration",
+]
+
+CHECK_IN_QUESTIONS = [
+    "Ready for our daily check in? How did you feel about your nutrition choices today?",
+    "And how would you rate your sleep last night?",
+    "Now for fitness. Did you complete your planned fitness activity today?",
+    "Finally, let us check in on your well-being. How would you rate your stress levels today?",
+    "Thanks for completing our check in. You are doing great!",
+]
+
+
+#chat_history owner for callers that don't pass a user (the JWT "sub" otherwise)
+ANONYMOUS_USER = "anonymous"
+
+#default number of chat entries per page for fetch_chat_page
+CHAT_PAGE_SIZE = 10
+
+#recommendation_jobs.status values
+#queued -> running -> done, a failed attempt goes back to queued with a later run_after
+#until the runner gives up and marks it failed
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+#seconds a claimed job stays with its worker, while running run_after holds when the lease ends
+#a job still running after that is claimed again, so one whose outcome could not be saved isn't stuck
+JOB_LEASE_SECONDS = 300
+
+#dates are stored as ISO-8601 "YYYY-MM-DD" strings so they sort and range-scan correctly
+#callers may still pass the older "MM/DD/YYYY" format or a date object
+ISO_DATE_FORMAT = "%Y-%m-%d"
+LEGACY_DATE_FORMAT = "%m/%d/%Y"
+
+
+def to_iso_date(value):
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    for date_format in (ISO_DATE_FORMAT, LEGACY_DATE_FORMAT):
+        try:
+            return datetime.datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            pass
+    raise ValueError(f"Unrecognized date {value!r}, expected YYYY-MM-DD or MM/DD/YYYY")
+
+
+def today_iso():
+    return datetime.date.today().isoformat()
+
+
+#columns holding dates, and the secondary indexes for the hot lookups
+DATE_COLUMNS = [
+    ("chat_history", "date"),
+    ("daily_log_table", "log_date"),
+    ("user_program", "date"),
+]
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_chat_history_date ON chat_history (date);",
+    "CREATE INDEX IF NOT EXISTS idx_chat_entries_parent_seq ON chat_history_entries (fk_row_id, sequence_number);",
+    "CREATE INDEX IF NOT EXISTS idx_daily_log_date ON daily_log_table (log_date);",
+    "CREATE INDEX IF NOT EXISTS idx_user_program_date ON user_program (date);",
+    "CREATE INDEX IF NOT EXISTS idx_user_program_current ON user_program (in_curr_four_week);",
+]
+
+
+#statements that can be served by a read-only connection
+READ_QUERY_PREFIXES = ("SELECT", "EXPLAIN")
+
+
+def is_read_query(query):
+    return query.lstrip().upper().startswith(READ_QUERY_PREFIXES)
 
 
 class wellness_ai_db:
-    def __init__(self):
-        self.db = sqlite3.connect(DATABASE_PATH)
-        self.cursor = self.db.cursor()
-        self.create_sql_possible_preferences_table()
-        self.create_sql_user_preferences_table()
-        self.create_sql_create_ideal_plan_table()
-        self.create_log_table()
-        self.create_check_in_question_table()
-        self.create_chat_history_table()
-        self.create_chat_history_entry_table()
+    #pool_options are passed to connection_pool (busy_timeout, synchronous, cache_size, max_readers)
+    def __init__(self, database_path=DATABASE_PATH, **pool_options):
+        self.db = connection_pool(database_path, **pool_options)
+        self.local = threading.local()  # per-thread transaction depth
+        self.cache = reference_cache()
+        self.stats = None  # query_stats when instrumentation is on, see enable_stats()
+        # an up to date database only costs this one pragma read
+        if self.schema_version() < db_migrations.LATEST_VERSION:
+            db_migrations.apply_migrations(self)
         print("initialized")
 
 
+    #schema version the database file is at, see db_migrations.py
+    def schema_version(self):
+        with self.db.write_connection() as conn:
+            return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+
     #generic run-query function
+    #SELECTs go to a pooled read-only connection, everything else to the writer
+    #inside a transaction() everything runs on the writer and commits once at the end
+    #results are fetched up front so the connection can go straight back to the pool
     def run_query(self, query, *query_args):
-        do_it = self.cursor.execute(query, [*query_args])
-        self.db.commit()
+        if is_read_query(query) and not self.in_transaction():
+            return self.read_query(query, *query_args)
+        if self.stats is not None:
+            return self._instrumented(self.db.write_connection, query, [*query_args], write=True)
+        with self.db.write_connection() as conn:
+            do_it = buffered_result(conn.execute(query, [*query_args]))
+            if not self.in_transaction():
+                conn.commit()
+        self.invalidate_cache_for(query)
+        return do_it
+
+
+    #run one statement for every tuple in rows with a single commit
+    def run_many(self, query, rows):
+        if self.stats is not None:
+            return self._instrumented(self.db.write_connection, query, list(rows), write=True, many=True)
+        with self.db.write_connection() as conn:
+            do_it = buffered_result(conn.executemany(query, rows))
+            if not self.in_transaction():
+                conn.commit()
+        self.invalidate_cache_for(query)
         return do_it
 
 
+    #drop cached reference data a write touched, once the write is committed
+    def invalidate_cache_for(self, query):
+        table = written_table(query)
+        if table is None:
+            return
+        if self.in_transaction():
+            self.local.written_tables.add(table)
+        else:
+            self.cache.invalidate(table)
+
+
+    #run a SELECT on a read-only connection, never waits for the writer
+    def read_query(self, query, *query_args):
+        if self.stats is not None:
+            return self._instrumented(self.db.read_connection, query, [*query_args], write=False)
+        with self.db.read_connection() as conn:
+            return buffered_result(conn.execute(query, [*query_args]))
+
+
+    #same as the plain paths above, plus timing for query_stats
+    def _instrumented(self, checkout, query, query_args, write, many=False):
+        requested = time.perf_counter()
+        with checkout() as conn:
+            started = time.perf_counter()
+            if many:
+                do_it = buffered_result(conn.executemany(query, query_args))
+            else:
+                do_it = buffered_result(conn.execute(query, query_args))
+            if write and not self.in_transaction():
+                conn.commit()
+            finished = time.perf_counter()
+        if write:
+            self.invalidate_cache_for(query)
+
+        stats = self.stats
+        if stats is not None:
+            elapsed = finished - started
+            rows = len(do_it.rows) if do_it.description else max(do_it.rowcount, 0)
+            stats.record(query, elapsed, rows, started - requested)
+            if stats.is_slow(elapsed):
+                plan_args = (query_args[0] if query_args else []) if many else query_args
+                stats.record_slow(query, elapsed, self.explain(query, plan_args))
+        return do_it
+
+
+    #EXPLAIN QUERY PLAN detail lines for a statement
+    def explain(self, query, query_args=()):
+        try:
+            with self.db.read_connection() as conn:
+                return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, list(query_args))]
+        except sqlite3.Error as e:
+            return [f"plan unavailable: {e}"]
+
+
+    #turn on per-statement timing, rows, lock wait and the slow query log
+    def enable_stats(self, slow_query_ms=None):
+        if self.stats is None:
+            self.stats = query_stats()
+        if slow_query_ms is not None:
+            self.stats.slow_query_ms = slow_query_ms
+        return self.stats
+
+
+    def disable_stats(self):
+        self.stats = None
+
+
+    def get_stats(self):
+        if self.stats is None:
+            return {"enabled": False}
+        return self.stats.snapshot()
+
+
+    def in_transaction(self):
+        return getattr(self.local, "depth", 0) > 0
+
+
+    #group statements into one commit:
+    #   with db.transaction():
+    #       db.run_query(...)
+    #       db.run_many(...)
+    #holds the writer for the whole block, rolls back if the block raises
+    #nested blocks become savepoints of the outer transaction
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.db.write_connection() as conn:
+            depth = getattr(self.local, "depth", 0)
+            savepoint = f"benny_sp_{depth}"
+            if depth == 0:
+                conn.execute("BEGIN IMMEDIATE;")
+                self.local.written_tables = set()
+            else:
+                conn.execute(f"SAVEPOINT {savepoint};")
+            self.local.depth = depth + 1
+            try:
+                yield self
+            except BaseException:
+                self.local.depth = depth
+                if depth == 0:
+                    conn.rollback()
+                    self._invalidate_written_tables()
+                else:
+                    conn.execute(f"ROLLBACK TO {savepoint};")
+                    conn.execute(f"RELEASE {savepoint};")
+                raise
+            self.local.depth = depth
+            if depth == 0:
+                conn.commit()
+                self._invalidate_written_tables()
+            else:
+                conn.execute(f"RELEASE {savepoint};")
+
+
+    def _invalidate_written_tables(self):
+        for table in self.local.written_tables:
+            self.cache.invalidate(table)
+        self.local.written_tables = set()
+
+
+    def close(self):
+        self.db.close()
+
+
 ##########  Database TABLE BUILD Functions  ######################
 
     # full list of selectable goal preferences
@@ -46,9 +293,7 @@ class wellness_ai_db:
             preference_name VARCHAR(255)
         );
         """
-        self.run_query("DROP TABLE IF EXISTS preferences_list;")
         self.run_query(query)
-        self.build_possible_pref_table()
 
 
     #build daily reporting form
@@ -62,17 +307,10 @@ class wellness_ai_db:
         self.run_query(query)
 
 
-    #build possible preferences table
+    #build possible preferences table, only adds the names that are missing
     def build_possible_pref_table(self):
-        self.run_query("INSERT INTO preferences_list(preference_name) VALUES ('sleep');" )
-        self.run_query("INSERT INTO preferences_list(preference_name) VALUES ('meditation');" )
-        self.run_query("INSERT INTO preferences_list(preference_name) VALUES ('outside time');" )
-        self.run_query("INSERT INTO preferences_list(preference_name) VALUES ('strength training');" )
-        self.run_query("INSERT INTO preferences_list(preference_name) VALUES ('cardiovascular training');" )
-        self.run_query("INSERT INTO preferences_list(preference_name) VALUES ('mobility training');" )
-        self.run_query("INSERT INTO preferences_list(preference_name) VALUES ('protein intake');")
-        self.run_query("INSERT INTO preferences_list(preference_name) VALUES ('fruit and veggie intake');")
-        self.run_query("INSERT INTO preferences_list(preference_name) VALUES ('hydration');")
+        self.run_many("INSERT INTO preferences_list(preference_name) SELECT ? WHERE NOT EXISTS (SELECT 1 FROM preferences_list WHERE preference_name = ?);",
+                      [(name, name) for name in POSSIBLE_PREFERENCES])
 
 
     # stores user goal preferences/ranking 
@@ -126,18 +364,18 @@ class wellness_ai_db:
 
     #create daily check in questions table
     def create_check_in_question_table(self):
-        self.run_query("DROP TABLE IF EXISTS questions;")
         query = """
             CREATE TABLE IF NOT EXISTS questions(
             row_id INTEGER PRIMARY KEY AUTOINCREMENT,
             question_text VARCHAR(255)
         );"""
         self.run_query(query)
-        self.run_query("INSERT INTO questions (question_text) VALUES ('Ready for our daily check in? How did you feel about your nutrition choices today?');")
-        self.run_query("INSERT INTO questions (question_text) VALUES ('And how would you rate your sleep last night?');")
-        self.run_query("INSERT INTO questions (question_text) VALUES ('Now for fitness. Did you complete your planned fitness activity today?');")
-        self.run_query("INSERT INTO questions (question_text) VALUES ('Finally, let us check in on your well-being. How would you rate your stress levels today?');")
-        self.run_query("INSERT INTO questions (question_text) VALUES ('Thanks for completing our check in. You are doing great!')")
+
+
+    #fill the check in questions, only adds the ones that are missing
+    def build_check_in_questions(self):
+        self.run_many("INSERT INTO questions (question_text) SELECT ? WHERE NOT EXISTS (SELECT 1 FROM questions WHERE question_text = ?);",
+                      [(question, question) for question in CHECK_IN_QUESTIONS])
 
 
     #create table for conversation history
@@ -165,20 +403,132 @@ class wellness_ai_db:
         );"""
         self.run_query(query)
 
+
+    #create table for background recommendation jobs, one per submitted check in
+    #checkin is the answers as JSON, run_after/created_at/updated_at are unix timestamps
+    def create_recommendation_jobs_table(self):
+        query = """
+            CREATE TABLE IF NOT EXISTS recommendation_jobs (
+            job_id VARCHAR(64) PRIMARY KEY,
+            log_row_id INTEGER NOT NULL,
+            user_id VARCHAR(255) NOT NULL DEFAULT 'anonymous',
+            checkin TEXT NOT NULL,
+            status VARCHAR(16) NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            run_after REAL NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            FOREIGN KEY (log_row_id) REFERENCES daily_log_table(row_id)
+        );"""
+        self.run_query(query)
+
+
+    #rewrite any MM/DD/YYYY dates left from older databases as YYYY-MM-DD
+    def migrate_dates_to_iso(self):
+        for table, column in DATE_COLUMNS:
+            self.run_query(f"""
+                UPDATE {table}
+                SET {column} = substr({column}, 7, 4) || '-' || substr({column}, 1, 2) || '-' || substr({column}, 4, 2)
+                WHERE {column} GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]';""")
+
+
+    #secondary indexes for date lookups, chat entries by parent and the current plan
+    def create_indexes(self):
+        for query in INDEXES:
+            self.run_query(query)
+
 ############### DATABASE ADD AND UPDATE FUNCTIONS ###############
 
     #add row to chat history table
-    def insert_row_chat_history_main(self, input_date):
-        self.run_query("INSERT INTO chat_history (date) VALUES (?);", input_date)
+    def insert_row_chat_history_main(self, input_date, user_id=ANONYMOUS_USER):
+        self.run_query("INSERT INTO chat_history (user_id, date) VALUES (?,?);", user_id, to_iso_date(input_date))
 
 
     #add entry into chat history table
-    def add_chat_entry(self, input_date, sequence_number, user_or_benny, chat_text):
-        get_pk = self.run_query("SELECT row_id FROM chat_history WHERE date = (?);", input_date)
+    def add_chat_entry(self, input_date, sequence_number, user_or_benny, chat_text, user_id=ANONYMOUS_USER):
+        get_pk = self.run_query("SELECT row_id FROM chat_history WHERE user_id = (?) AND date = (?);", user_id, to_iso_date(input_date))
         fk_tuple = get_pk.fetchone()
         fk = fk_tuple[0]
         self.run_query("INSERT INTO chat_history_entries (fk_row_id, sequence_number, user_or_benny, entry_text) VALUES (?,?,?,?);", fk, sequence_number, user_or_benny, chat_text)
 
+
+    #save one user message and benny's reply in a single transaction
+    #creates the day's chat_history row if needed and takes the next sequence numbers
+    #from the (fk_row_id, sequence_number) index, so the cost doesn't grow with the day's chat
+    #returns the sequence number of the user message
+    def append_chat_exchange(self, user_id, input_date, user_text, benny_text):
+        input_date = to_iso_date(input_date)
+        with self.transaction():
+            self.run_query("INSERT INTO chat_history (user_id, date) VALUES (?,?) ON CONFLICT (user_id, date) DO NOTHING;", user_id, input_date)
+            fk = self.run_query("SELECT row_id FROM chat_history WHERE user_id = (?) AND date = (?);", user_id, input_date).fetchone()[0]
+            seq_num = self.run_query("SELECT COALESCE(MAX(sequence_number), 0) + 1 FROM chat_history_entries WHERE fk_row_id = (?);", fk).fetchone()[0]
+            self.run_many("INSERT INTO chat_history_entries (fk_row_id, sequence_number, user_or_benny, entry_text) VALUES (?,?,?,?);",
+                          [(fk, seq_num, 0, user_text), (fk, seq_num + 1, 1, benny_text)])
+        return seq_num
+
+
+    #save a submitted check in and queue the job for its recommendation in one transaction
+    #so a check in is never stored without a job or the other way round, returns the log row_id
+    #request_id is the submitting request's, the job passes it on to the AI service
+    def add_checkin_with_job(self, job_id, log_date, checkin, user_id=ANONYMOUS_USER, request_id=None):
+        now = time.time()
+        with self.transaction():
+            log_row_id = self.run_query("""
+                INSERT INTO daily_log_table
+                (user_id, log_date, nutrition, sleep_quality, stress_level, activity_complete, activity_name, user_program_row_id, activity_addresses_goal)
+                VALUES (?,?,?,?,?,?,?,?,?);""",
+                user_id, to_iso_date(log_date), checkin.get("nutrition"), checkin.get("sleep"),
+                checkin.get("stress"), 1, "Daily Check-in", 1, 1).lastrowid
+            self.run_query("INSERT INTO recommendation_jobs (job_id, log_row_id, user_id, checkin, status, created_at, updated_at, request_id) VALUES (?,?,?,?,?,?,?,?);",
+                           job_id, log_row_id, user_id, json.dumps(checkin), JOB_QUEUED, now, now, request_id)
+        return log_row_id
+
+
+    #take the oldest job that is due, queued or running past its lease, and mark it running
+    #for lease seconds, None if there is nothing to do
+    #select and update share the write lock, so two workers never get the same job
+    #returns a dict of job_id, log_row_id, user_id, checkin, attempts (counting this one) and request_id
+    def claim_recommendation_job(self, lease=JOB_LEASE_SECONDS):
+        now = time.time()
+        with self.transaction():
+            row = self.run_query("""
+                SELECT job_id, log_row_id, user_id, checkin, attempts, request_id FROM recommendation_jobs
+                WHERE status IN (?, ?) AND run_after <= (?)
+                ORDER BY run_after, created_at LIMIT 1;""", JOB_QUEUED, JOB_RUNNING, now).fetchone()
+            if row is None:
+                return None
+            self.run_query("UPDATE recommendation_jobs SET status = (?), attempts = attempts + 1, run_after = (?), updated_at = (?) WHERE job_id = (?);",
+                           JOB_RUNNING, now + lease, now, row[0])
+        return {"job_id": row[0], "log_row_id": row[1], "user_id": row[2],
+                "checkin": json.loads(row[3]), "attempts": row[4] + 1, "request_id": row[5]}
+
+
+    #jobs left running by a process that stopped are queued again, call once before starting workers
+    #returns how many were requeued
+    def requeue_running_recommendation_jobs(self):
+        return self.run_query("UPDATE recommendation_jobs SET status = (?), run_after = 0, updated_at = (?) WHERE status = (?);",
+                              JOB_QUEUED, time.time(), JOB_RUNNING).rowcount
+
+
+    #store the recommendation on the check in's daily log row and mark the job done
+    def complete_recommendation_job(self, job_id, recommendation):
+        with self.transaction():
+            self.run_query("UPDATE daily_log_table SET recommendation = (?) WHERE row_id = (SELECT log_row_id FROM recommendation_jobs WHERE job_id = (?));",
+                           recommendation, job_id)
+            self.run_query("UPDATE recommendation_jobs SET status = (?), error = NULL, updated_at = (?) WHERE job_id = (?);",
+                           JOB_DONE, time.time(), job_id)
+
+
+    #record a failed attempt, the job is queued again from retry_at or marked failed if retry_at is None
+    def fail_recommendation_job(self, job_id, error, retry_at=None):
+        if retry_at is None:
+            self.run_query("UPDATE recommendation_jobs SET status = (?), error = (?), updated_at = (?) WHERE job_id = (?);",
+                           JOB_FAILED, error, time.time(), job_id)
+        else:
+            self.run_query("UPDATE recommendation_jobs SET status = (?), error = (?), run_after = (?), updated_at = (?) WHERE job_id = (?);",
+                           JOB_QUEUED, error, retry_at, time.time(), job_id)
+
         
     #sets user preferences, takes as input a ranking integer and a goal name input
     def set_preferences(self, pref_name, pref_rank):
@@ -190,26 +540,29 @@ class wellness_ai_db:
 
     # adds a row to the four week plan
     def add_four_week_plan_row(self, input_date):
-        self.run_query("INSERT INTO user_program (date, in_curr_four_week) VALUES (?,?);", input_date,1)
+        self.run_query("INSERT INTO user_program (date, in_curr_four_week) VALUES (?,?);", to_iso_date(input_date),1)
 
 
     #build four weeks worth of rows in four week plan
+    #reset and inserts are one transaction so a half-built plan is never visible
     def build_full_four_week_plan(self):
-        self.reset_four_week_status()
         now = datetime.datetime.now()
         now = now.date()
         input_date = now
+        plan_rows = []
         day = 0
         while(day<=28): #build 28 new rows for new 4 week plan, with ascending primary keys corresponding to days from today
             day+=1
             input_date += datetime.timedelta(days=1)
-            nowstring = now.strftime("%m/%d/%Y")
-            self.add_four_week_plan_row(nowstring)
+            plan_rows.append((input_date.isoformat(), 1))
+        with self.transaction():
+            self.reset_four_week_status()
+            self.run_many("INSERT INTO user_program (date, in_curr_four_week) VALUES (?,?);", plan_rows)
 
 
     #adds an activity to the full ideal program
     def add_activity_to_full_ideal_program(self, input_date, activity_name):
-        main_prog_row_id = self.run_query("SELECT row_id FROM user_program WHERE date=(?);", input_date)
+        main_prog_row_id = self.run_query("SELECT row_id FROM user_program WHERE date=(?);", to_iso_date(input_date))
         main_prog_row_id = main_prog_row_id[1]
         activity_pk = self.get_user_priority_pk(activity_name)
         self.run_query("INSERT INTO daily_activities_ref (program_row_id,activity_name, activity_addresses_goal) VALUES (?,?,?);", (main_prog_row_id, activity_name, activity_pk))
@@ -226,55 +579,95 @@ class wellness_ai_db:
         main_prog_row_id = program_get[0]
         main_prog_activity = program_get[2]
         main_prog_activity_reason = program_get[3]
-        self.run_query("INSERT INTO daily_log_table (user_program_row_id, log_date, activity_complete, activity_name, activity_addresses_goal) VALUES (?)", main_prog_row_id, today_date, 0, main_prog_activity, main_prog_activity_reason)
+        self.run_query("INSERT INTO daily_log_table (user_program_row_id, log_date, activity_complete, activity_name, activity_addresses_goal) VALUES (?)", main_prog_row_id, to_iso_date(today_date), 0, main_prog_activity, main_prog_activity_reason)
 
 
     #updates user success from default of 0 to 1 if user successfully completed activity
     def update_user_success_daily_log(self, date):
-        self.run_query("UPDATE daily_log_table SET activity_complete=(?) WHERE log_date=(?);", 1, date)
+        self.run_query("UPDATE daily_log_table SET activity_complete=(?) WHERE log_date=(?);", 1, to_iso_date(date))
 
 
     #undoes the user success logging above if needed for error recovery
     def reset_user_success_daily_log(self, date):
-        self.run_query("UPDATE daily_log_table SET activity_complete=(?) WHERE log_date=(?);", 0, date)
+        self.run_query("UPDATE daily_log_table SET activity_complete=(?) WHERE log_date=(?);", 0, to_iso_date(date))
 
     #add ranked goal to goal table
     #can be updated to use preference pk instead of name
     def add_ranked_goal(self, preference_name, preference_rank):
-        pk = self.run_query("SELECT preference_id FROM preferences_list WHERE preference_name = (?);", preference_name)
-        fk = pk.fetchone()
+        fk = self.get_preference_ids().get(preference_name)
         self.run_query("INSERT INTO user_priorities (user_rating, user_ref_pref_id) VALUES (?,?);", preference_rank, fk)
 
     
     #delete a row from user priorities table
     def delete_ranked_goal(self, preference_name):
-        pk = self.run_query("SELECT preference_id FROM preferences_list WHERE preference_name = (?);", preference_name)
-        fk = pk.fetchone()
+        fk = self.get_preference_ids().get(preference_name)
         self.run_query("DELETE FROM user_priorities WHERE user_ref_pref_id = (?);", fk)
 
     
     #update user ranking of existing priority
     def delete_ranked_goal(self, preference_name, preference_rank):
-        pk = self.run_query("SELECT preference_id FROM preferences_list WHERE preference_name = (?);", preference_name)
-        fk = pk.fetchone()
+        fk = self.get_preference_ids().get(preference_name)
         self.run_query("UPDATE user_priorities SET user_rating = (?) WHERE user_ref_pref_id = (?);", preference_rank, fk)
 
 ############ DATABASE GET FUNCTIONS ##################
 
     #get chat history main table pk given date
-    def fetch_main_chat_history_pk(self, input_date):
-        pk = self.run_query("SELECT row_id FROM chat_history WHERE date = (?);", input_date)
+    def fetch_main_chat_history_pk(self, input_date, user_id=ANONYMOUS_USER):
+        pk = self.run_query("SELECT row_id FROM chat_history WHERE user_id = (?) AND date = (?);", user_id, to_iso_date(input_date))
         return pk.fetchone()
 
 
     #gets all chat entries for a certain date and orders by sequence
-    def fetch_chat_logs_by_date(self, input_date):
-        row_id_tuple = self.fetch_main_chat_history_pk(input_date)
+    def fetch_chat_logs_by_date(self, input_date, user_id=ANONYMOUS_USER):
+        row_id_tuple = self.fetch_main_chat_history_pk(input_date, user_id)
         row_id = row_id_tuple[0]
         chats = self.run_query("SELECT * FROM chat_history_entries WHERE fk_row_id = (?) ORDER BY sequence_number ASC;", row_id)
         return chats.fetchall()
    
 
+    #one page of a user's chat entries, newest first, as (sequence_number, user_or_benny, entry_text, date)
+    #before_date/before_seq is the keyset cursor: the date and sequence number of the
+    #oldest entry on the previous page. Both queries are index seeks, so a page costs
+    #the same however long the history is
+    def fetch_chat_page(self, user_id, limit=CHAT_PAGE_SIZE, before_date=None, before_seq=None):
+        columns = """
+            SELECT che.sequence_number, che.user_or_benny, che.entry_text, ch.date
+            FROM chat_history ch
+            JOIN chat_history_entries che ON che.fk_row_id = ch.row_id"""
+        if before_date is None:
+            return self.read_query(columns + """
+                WHERE ch.user_id = ?
+                ORDER BY ch.date DESC, che.sequence_number DESC
+                LIMIT ?;""", user_id, limit).fetchall()
+
+        before_date = to_iso_date(before_date)
+        # rest of the day the cursor points into
+        page = self.read_query(columns + """
+            WHERE ch.user_id = ? AND ch.date = ? AND che.sequence_number < ?
+            ORDER BY che.sequence_number DESC
+            LIMIT ?;""", user_id, before_date, before_seq, limit).fetchall()
+        # then the days before it
+        if len(page) < limit:
+            page += self.read_query(columns + """
+                WHERE ch.user_id = ? AND ch.date < ?
+                ORDER BY ch.date DESC, che.sequence_number DESC
+                LIMIT ?;""", user_id, before_date, limit - len(page)).fetchall()
+        return page
+
+
+    #status of a recommendation job and, once it is done, the recommendation stored on its daily log row
+    #returns a dict of job_id, status, attempts, error, user_id, log_date and recommendation, None for an unknown job
+    def get_recommendation_job(self, job_id):
+        row = self.run_query("""
+            SELECT j.job_id, j.status, j.attempts, j.error, j.user_id, d.log_date, d.recommendation
+            FROM recommendation_jobs j JOIN daily_log_table d ON d.row_id = j.log_row_id
+            WHERE j.job_id = (?);""", job_id).fetchone()
+        if row is None:
+            return None
+        return {"job_id": row[0], "status": row[1], "attempts": row[2], "error": row[3],
+                "user_id": row[4], "log_date": row[5], "recommendation": row[6]}
+
+
     #gets user priority pk based on goal name
     def get_user_priority_pk(self, goal_name):
         goal_pk = self.run_query("SELECT * FROM user_priorities WHERE preference_name=(?);", goal_name)
@@ -284,29 +677,45 @@ class wellness_ai_db:
 
     #gets user preference ratings for benny decision making
     def get_all_user_preferences(self):
-        preferences = self.run_query("SELECT * FROM user_priorities;")
-        return preferences.fetchall()
+        return list(self._cached_user_priorities())
 
 
     #get all user priorities
     def get_user_priorities(self):
-        prios = self.run_query("SELECT * FROM user_priorities;")
-        return prios.fetchall()
+        return list(self._cached_user_priorities())
+
+
+    def _cached_user_priorities(self):
+        prios, etag = self.cache.get("user_priorities", ("user_priorities",),
+                                     lambda: self.run_query("SELECT * FROM user_priorities;").fetchall())
+        return prios
+
+
+    #preference name -> preference_id, served from the reference cache
+    def get_preference_ids(self):
+        ids, etag = self.cache.get("preference_ids", ("preferences_list",),
+                                   lambda: {name: pk for pk, name in self.run_query("SELECT preference_id, preference_name FROM preferences_list;")})
+        return dict(ids)
 
 
     #retrieve log form responses for today as dictionary
     def get_form_responses_for_benny(self):
-        now = datetime.datetime.now()
-        now = now.date()
-        nowstring = now.strftime("%m/%d/%Y")
+        nowstring = today_iso()
         log_answers_para_bennward = self.run_query("SELECT * FROM daily_log_table WHERE log_date=(?);", nowstring)
         return log_answers_para_bennward.fetchall()
 
 
     #returns form questions for frontend as dictionary
     def get_form_questions_daily_checkin(self):
-        questions = self.run_query("SELECT * FROM questions ORDER BY row_id ASC;")
-        return questions.fetchall()
+        questions, etag = self.get_form_questions_with_etag()
+        return questions
+
+
+    #form questions plus an ETag that changes whenever they do, served from the reference cache
+    def get_form_questions_with_etag(self):
+        questions, etag = self.cache.get("questions", ("questions",),
+                                         lambda: self.run_query("SELECT * FROM questions ORDER BY row_id ASC;").fetchall())
+        return list(questions), etag
 
 
     #returns 4 week plan
@@ -317,13 +726,13 @@ class wellness_ai_db:
 
     #gets a row from the daily log based on date
     def daily_log_row_fetch(self, date):
-        log_get = self.run_query("SELECT * FROM daily_log_table WHERE log_date = (?);", date)
+        log_get = self.run_query("SELECT * FROM daily_log_table WHERE log_date = (?);", to_iso_date(date))
         return log_get.fetchone()
     
 
     #gets a row from the user program based on date
     def user_program_day_get(self, date):
-        program_get = self.run_query("SELECT * FROM user_program WHERE date = (?);", date)
+        program_get = self.run_query("SELECT * FROM user_program WHERE date = (?);", to_iso_date(date))
         return program_get.fetchone()
 
 #################  API communication functions  #########################
@@ -358,6 +767,3 @@ class wellness_ai_db:
         except requests.exceptions.RequestException as e:
             print(f"Error calling Benny API: {e}")
             return {"error": f"Benny API request failed: {e}"}
-         
-#### Main DB Backend ####
-main_db = wellness_ai_db()
\ No newline at end of file
@@ -0,0 +1,118 @@
+# Versioned schema migrations for BennyDB.
+#
+# PRAGMA user_version holds the version the database is at, so an up to date
+# database is recognised with a single pragma read. The schema_version table
+# keeps a record of when each migration was applied. Migrations run in order
+# inside one BEGIN IMMEDIATE transaction, which also makes a second process
+# that starts at the same time wait and then skip the work already done.
+#
+# To change the schema, add a function below and append it to MIGRATIONS with
+# the next version number. Never edit a migration that has already shipped.
+
+import datetime
+
+
+#version 1: the original tables plus the reference data they were seeded with
+def baseline_schema(db):
+    db.create_sql_possible_preferences_table()
+    db.create_sql_user_preferences_table()
+    db.create_sql_create_ideal_plan_table()
+    db.create_log_table()
+    db.create_check_in_question_table()
+    db.create_chat_history_table()
+    db.create_chat_history_entry_table()
+    db.build_possible_pref_table()
+    db.build_check_in_questions()
+
+
+#version 2: ISO-8601 dates and the secondary indexes
+def iso_dates_and_indexes(db):
+    db.migrate_dates_to_iso()
+    db.create_indexes()
+
+
+#version 3: chat history is kept per user, one chat_history row per (user, date)
+def chat_history_per_user(db):
+    if not column_exists(db, "chat_history", "user_id"):
+        db.run_query("ALTER TABLE chat_history ADD COLUMN user_id VARCHAR(255) NOT NULL DEFAULT 'anonymous';")
+    # fold duplicate parent rows for the same day into the oldest one before adding the unique index
+    db.run_query("""
+        UPDATE chat_history_entries
+        SET fk_row_id = (SELECT MIN(keep.row_id) FROM chat_history keep, chat_history dup
+                         WHERE dup.row_id = chat_history_entries.fk_row_id
+                         AND keep.user_id = dup.user_id AND keep.date = dup.date);""")
+    db.run_query("""
+        DELETE FROM chat_history
+        WHERE row_id NOT IN (SELECT MIN(row_id) FROM chat_history GROUP BY user_id, date);""")
+    db.run_query("CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_history_user_date ON chat_history (user_id, date);")
+    db.run_query("DROP INDEX IF EXISTS idx_chat_history_date;")
+
+
+#version 4: daily logs and the program carry their owner, so a user's rows can be found and moved between shards
+def user_owned_rows(db):
+    for table in ("daily_log_table", "user_program"):
+        if not column_exists(db, table, "user_id"):
+            db.run_query(f"ALTER TABLE {table} ADD COLUMN user_id VARCHAR(255) NOT NULL DEFAULT 'anonymous';")
+    db.run_query("CREATE INDEX IF NOT EXISTS idx_daily_log_user_date ON daily_log_table (user_id, log_date);")
+    db.run_query("CREATE INDEX IF NOT EXISTS idx_user_program_user_date ON user_program (user_id, date);")
+
+
+#version 5: check-in recommendations are generated by background jobs and stored on the log row
+def recommendation_jobs(db):
+    if not column_exists(db, "daily_log_table", "recommendation"):
+        db.run_query("ALTER TABLE daily_log_table ADD COLUMN recommendation TEXT;")
+    db.create_recommendation_jobs_table()
+    db.run_query("CREATE INDEX IF NOT EXISTS idx_recommendation_jobs_status ON recommendation_jobs (status, run_after);")
+
+
+#version 6: a recommendation job keeps the request id of the check in that queued it
+def recommendation_job_request_ids(db):
+    if not column_exists(db, "recommendation_jobs", "request_id"):
+        db.run_query("ALTER TABLE recommendation_jobs ADD COLUMN request_id VARCHAR(128);")
+
+
+# (version, description, function) in the order they are applied
+MIGRATIONS = [
+    (1, "baseline schema and reference data", baseline_schema),
+    (2, "ISO-8601 dates and secondary indexes", iso_dates_and_indexes),
+    (3, "per-user chat history", chat_history_per_user),
+    (4, "user_id on daily_log_table and user_program", user_owned_rows),
+    (5, "recommendation jobs and daily_log_table.recommendation", recommendation_jobs),
+    (6, "request_id on recommendation_jobs", recommendation_job_request_ids),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def column_exists(db, table, column):
+    columns = db.run_query(f"PRAGMA table_info({table});").fetchall()
+    return any(row[1] == column for row in columns)
+
+
+def create_schema_version_table(db):
+    db.run_query("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description VARCHAR(255) NOT NULL,
+        applied_at VARCHAR(255) NOT NULL
+    );""")
+
+
+#bring the database up to LATEST_VERSION, returns the versions that were applied
+def apply_migrations(db):
+    applied = []
+    with db.transaction():
+        # re-read inside the write lock, another process may have migrated already
+        version = db.run_query("PRAGMA user_version;").fetchone()[0]
+        if version >= LATEST_VERSION:
+            return applied
+        create_schema_version_table(db)
+        for migration_version, description, migration in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            migration(db)
+            db.run_query("INSERT OR REPLACE INTO schema_version (version, description, applied_at) VALUES (?,?,?);",
+                         migration_version, description, datetime.datetime.now().isoformat(timespec="seconds"))
+            db.run_query(f"PRAGMA user_version = {int(migration_version)};")
+            applied.append(migration_version)
+    return applied
@@ -0,0 +1,153 @@
+# Connection pool for the Benny SQLite database.
+#
+# SQLite allows many readers but only one writer at a time. The pool keeps a
+# single writer connection guarded by a lock (so concurrent request handlers
+# queue in Python instead of failing with "database is locked") and a set of
+# read-only connections that are checked out for SELECTs. With WAL journaling
+# readers see the last committed state and never block behind the writer.
+
+import contextlib
+import pathlib
+import queue
+import sqlite3
+import threading
+
+
+# default pragmas, can be overridden per pool
+BUSY_TIMEOUT_MS = 5000
+SYNCHRONOUS = "NORMAL"      # safe with WAL, skips the fsync on every commit
+CACHE_SIZE_KB = 8000        # page cache per connection
+MAX_READERS = 8
+
+SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+
+#rows returned from a query, fetched before the connection goes back to the pool
+class buffered_result:
+    def __init__(self, cursor):
+        self.rows = cursor.fetchall() if cursor.description else []
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+        self.description = cursor.description
+        self.position = 0
+
+    def fetchone(self):
+        if self.position >= len(self.rows):
+            return None
+        row = self.rows[self.position]
+        self.position += 1
+        return row
+
+    def fetchall(self):
+        rows = self.rows[self.position:]
+        self.position = len(self.rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+class connection_pool:
+    def __init__(self, database_path, busy_timeout=BUSY_TIMEOUT_MS, synchronous=SYNCHRONOUS,
+                 cache_size=CACHE_SIZE_KB, max_readers=MAX_READERS):
+        synchronous = synchronous.upper()
+        if synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError(f"synchronous must be one of {SYNCHRONOUS_LEVELS}, got {synchronous!r}")
+        if max_readers < 1:
+            raise ValueError("max_readers must be at least 1")
+
+        self.database_path = str(database_path)
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.max_readers = max_readers
+
+        self.write_lock = threading.RLock()
+        self.readers = queue.LifoQueue()
+        self.reader_count = 0
+        self.reader_count_lock = threading.Lock()
+        self.closed = False
+
+        # the writer is opened first so the file exists and WAL is switched on
+        # before any read-only connection is attempted
+        self.writer = self._connect(read_only=False)
+        self.writer.execute("PRAGMA journal_mode=WAL;")
+
+
+    #open a connection and apply the pool pragmas
+    def _connect(self, read_only):
+        if read_only:
+            uri = pathlib.Path(self.database_path).resolve().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, timeout=self.busy_timeout / 1000,
+                                   check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.database_path, timeout=self.busy_timeout / 1000,
+                                   check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)};")
+        conn.execute(f"PRAGMA synchronous={self.synchronous};")
+        conn.execute(f"PRAGMA cache_size={-int(self.cache_size)};")
+        return conn
+
+
+    #exclusive use of the writer connection
+    @contextlib.contextmanager
+    def write_connection(self):
+        if self.closed:
+            raise sqlite3.ProgrammingError("Connection pool is closed")
+        with self.write_lock:
+            yield self.writer
+
+
+    #check out a read-only connection, opening a new one if the pool is not full yet
+    @contextlib.contextmanager
+    def read_connection(self):
+        if self.closed:
+            raise sqlite3.ProgrammingError("Connection pool is closed")
+        conn = self._checkout_reader()
+        try:
+            yield conn
+        finally:
+            if self.closed:
+                conn.close()
+            else:
+                self.readers.put(conn)
+
+
+    def _checkout_reader(self):
+        try:
+            return self.readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self.reader_count_lock:
+            if self.reader_count < self.max_readers:
+                self.reader_count += 1
+                open_new = True
+            else:
+                open_new = False
+        if open_new:
+            try:
+                return self._connect(read_only=True)
+            except Exception:
+                with self.reader_count_lock:
+                    self.reader_count -= 1
+                raise
+        return self.readers.get()
+
+
+    #kept for callers that used the old sqlite3 connection directly
+    def commit(self):
+        with self.write_lock:
+            self.writer.commit()
+
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        with self.write_lock:
+            self.writer.close()
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
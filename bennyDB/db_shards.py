@@ -0,0 +1,407 @@
+# Per-user sharding for the Benny database.
+#
+# Every SQLite file has a single write lock, so with one BennyDB.sqlite3 all
+# users queue behind each other. sharded_wellness_ai_db splits users across N
+# shard files (BennyDB.shard0.sqlite3, BennyDB.shard1.sqlite3, ...), each with
+# its own wellness_ai_db and write lock, so writes for users on different
+# shards run in parallel.
+#
+# A user (the JWT "sub") is placed with a consistent hash ring the first time
+# they are seen, and the choice is stored in a small routing catalog
+# (BennyDB.catalog.sqlite3). The catalog is the source of truth, so users only
+# move when rebalance() is run; changing N with the ring only moves about 1/N
+# of them.
+#
+#   shards = sharded_wellness_ai_db()
+#   shards.write_for(user_id, "append_chat_exchange", user_id, today, question, answer)
+#   page = shards.read_for(user_id, "fetch_chat_page", user_id, 10)
+#
+# Rebalancing from the command line, safe while the services are running:
+#   python db_shards.py status
+#   python db_shards.py rebalance --shards 8
+#   python db_shards.py import        (move rows from an unsharded BennyDB.sqlite3)
+#
+# A user is moved while holding the old shard's write lock, and the catalog
+# is updated before that lock is released. write_for() checks the catalog
+# again once it holds the shard's write lock, so a write racing a move waits
+# for it and then goes to the new shard, and read_for() retries a read that
+# finished after its user moved. Processes keep routes cached but correct
+# them from the catalog the first time they hit a moved user.
+#
+# Only rows with a user_id are sharded. Reference tables (questions,
+# preferences_list, user_priorities, which has no user id and is read as
+# global reference data) stay in the main BennyDB.sqlite3.
+
+import argparse
+import bisect
+import hashlib
+import pathlib
+import sqlite3
+import threading
+
+from db_connector_real import wellness_ai_db, DATABASE_PATH
+
+
+SHARD_COUNT = 4
+VIRTUAL_NODES = 64      # points per shard on the ring, evens out the split
+SHARD_DIRECTORY = DATABASE_PATH.parent
+
+#tables that hold a user's rows, in the order they are copied
+USER_TABLES = ("user_program", "daily_log_table", "chat_history")
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class hash_ring:
+    def __init__(self, shard_count, virtual_nodes=VIRTUAL_NODES):
+        if shard_count < 1:
+            raise ValueError("shard_count must be at least 1")
+        self.shard_count = shard_count
+        points = sorted((ring_hash(f"shard-{shard_id}-{node}"), shard_id)
+                        for shard_id in range(shard_count) for node in range(virtual_nodes))
+        self.hashes = [point[0] for point in points]
+        self.shards = [point[1] for point in points]
+
+
+    #first point clockwise from the key's hash
+    def shard_for(self, key):
+        index = bisect.bisect(self.hashes, ring_hash(key)) % len(self.hashes)
+        return self.shards[index]
+
+
+#raised by write_on/read_on when the user's rows are no longer on that shard
+class user_moved(Exception):
+    pass
+
+
+#user -> shard routing table, kept in its own small SQLite file
+#routes are cached in memory, route() re-reads one from the file for callers that must not act on a stale one
+class shard_catalog:
+    def __init__(self, catalog_path):
+        self.conn = sqlite3.connect(str(catalog_path), check_same_thread=False)
+        self.lock = threading.Lock()
+        self.routes = {}
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL;")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS user_shards (
+                user_id VARCHAR(255) PRIMARY KEY,
+                shard_id INTEGER NOT NULL
+            );""")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS shard_config (
+                name VARCHAR(255) PRIMARY KEY,
+                value INTEGER NOT NULL
+            );""")
+            self.conn.commit()
+            self.routes = dict(self.conn.execute("SELECT user_id, shard_id FROM user_shards;").fetchall())
+
+
+    def shard_count(self):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM shard_config WHERE name = 'shard_count';").fetchone()
+        return row[0] if row else None
+
+
+    def set_shard_count(self, shard_count):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO shard_config (name, value) VALUES ('shard_count', ?);", (shard_count,))
+            self.conn.commit()
+
+
+    def lookup(self, user_id):
+        return self.routes.get(user_id)
+
+
+    #the route as stored, which another process may have changed since it was cached
+    def route(self, user_id):
+        with self.lock:
+            row = self.conn.execute("SELECT shard_id FROM user_shards WHERE user_id = ?;", (user_id,)).fetchone()
+            if row is None:
+                self.routes.pop(user_id, None)
+                return None
+            self.routes[user_id] = row[0]
+            return row[0]
+
+
+    #record a route, keeps an existing one if another thread or process got there first
+    def assign(self, user_id, shard_id, replace=False):
+        with self.lock:
+            if not replace and user_id in self.routes:
+                return self.routes[user_id]
+            verb = "REPLACE" if replace else "IGNORE"
+            self.conn.execute(f"INSERT OR {verb} INTO user_shards (user_id, shard_id) VALUES (?, ?);", (user_id, shard_id))
+            self.conn.commit()
+            shard_id = self.conn.execute("SELECT shard_id FROM user_shards WHERE user_id = ?;", (user_id,)).fetchone()[0]
+            self.routes[user_id] = shard_id
+            return shard_id
+
+
+    #every route as stored, refreshing the cache
+    def users(self):
+        with self.lock:
+            self.routes = dict(self.conn.execute("SELECT user_id, shard_id FROM user_shards;").fetchall())
+            return dict(self.routes)
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def shard_path(directory, shard_id):
+    return pathlib.Path(directory) / f"BennyDB.shard{shard_id}.sqlite3"
+
+
+class sharded_wellness_ai_db:
+    #shard_count is only used for a new catalog, after that the catalog's count wins until rebalance()
+    #db_options are passed to every shard's wellness_ai_db
+    def __init__(self, shard_count=SHARD_COUNT, directory=SHARD_DIRECTORY, **db_options):
+        self.directory = pathlib.Path(directory)
+        self.db_options = db_options
+        self.catalog = shard_catalog(self.directory / "BennyDB.catalog.sqlite3")
+        if self.catalog.shard_count() is None:
+            self.catalog.set_shard_count(shard_count)
+        self.ring = hash_ring(self.catalog.shard_count())
+        self.shards = {}
+        self.shards_lock = threading.Lock()
+        for shard_id in range(self.ring.shard_count):
+            self.shard(shard_id)
+
+
+    #wellness_ai_db for one shard file, opened on first use
+    def shard(self, shard_id):
+        with self.shards_lock:
+            if shard_id not in self.shards:
+                self.shards[shard_id] = wellness_ai_db(shard_path(self.directory, shard_id), **self.db_options)
+            return self.shards[shard_id]
+
+
+    #every shard that may hold rows: the catalog's current count plus any opened before a rebalance
+    def shard_ids(self):
+        with self.shards_lock:
+            opened = set(self.shards)
+        return sorted(opened | set(range(self.catalog.shard_count())))
+
+
+    def shard_id_for(self, user_id):
+        shard_id = self.catalog.lookup(user_id)
+        if shard_id is None:
+            # a rebalance in another process may have changed the count new users are placed with
+            shard_count = self.catalog.shard_count()
+            if shard_count != self.ring.shard_count:
+                self.ring = hash_ring(shard_count)
+            shard_id = self.catalog.assign(user_id, self.ring.shard_for(user_id))
+        return shard_id
+
+
+    #the database holding this user's rows
+    #for one-off use, write_for/read_for also cope with the user being moved meanwhile
+    def for_user(self, user_id):
+        return self.shard(self.shard_id_for(user_id))
+
+
+    #call a wellness_ai_db method (by name) or func(db, ...) that writes the user's rows on shard_id
+    #the route is checked with the shard's write lock held, which rebalance() holds for the whole move
+    #raises user_moved if the user is no longer on that shard
+    def write_on(self, shard_id, user_id, func, *args, **kwargs):
+        db = self.shard(shard_id)
+        with db.transaction():
+            if self.catalog.route(user_id) != shard_id:
+                raise user_moved(user_id)
+            return _call(db, func, args, kwargs)
+
+
+    #same for a read, checked after it ran: a read that started before a move saw the old shard
+    #in full, one that finished after it could have missed rows
+    def read_on(self, shard_id, user_id, func, *args, **kwargs):
+        result = _call(self.shard(shard_id), func, args, kwargs)
+        if self.catalog.route(user_id) != shard_id:
+            raise user_moved(user_id)
+        return result
+
+
+    #write_on the user's current shard, following them if they are moved meanwhile
+    def write_for(self, user_id, func, *args, **kwargs):
+        while True:
+            try:
+                return self.write_on(self.shard_id_for(user_id), user_id, func, *args, **kwargs)
+            except user_moved:
+                pass
+
+
+    def read_for(self, user_id, func, *args, **kwargs):
+        while True:
+            try:
+                return self.read_on(self.shard_id_for(user_id), user_id, func, *args, **kwargs)
+            except user_moved:
+                pass
+
+
+    #move users so the catalog matches a ring of new_shard_count shards
+    #each user is copied to the new shard, re-routed, then deleted from the old one, all while
+    #holding the old shard's write lock, so writes for that user wait and then follow the new route
+    #an interrupted run leaves every user readable and can simply be run again
+    #returns {user_id: (old shard, new shard)} for the users that moved
+    def rebalance(self, new_shard_count):
+        new_ring = hash_ring(new_shard_count)
+        # users seen from now on are placed with the new ring and never need moving
+        self.catalog.set_shard_count(new_shard_count)
+        self.ring = new_ring
+        moved = {}
+        for user_id, old_shard in sorted(self.catalog.users().items()):
+            new_shard = new_ring.shard_for(user_id)
+            if new_shard == old_shard:
+                continue
+            source = self.shard(old_shard)
+            with source.transaction():
+                move_user_rows(user_id, source, self.shard(new_shard))
+                self.catalog.assign(user_id, new_shard, replace=True)
+                delete_user_rows(user_id, source)
+            moved[user_id] = (old_shard, new_shard)
+        return moved
+
+
+    #move every user's rows from an unsharded wellness_ai_db (the BennyDB.sqlite3 used before
+    #sharding) into their shards, returns {user_id: shard} for the users found there
+    def import_database(self, source):
+        imported = {}
+        users = set()
+        for table in USER_TABLES + ("recommendation_jobs",):
+            users.update(row[0] for row in source.run_query(f"SELECT DISTINCT user_id FROM {table};").fetchall())
+        for user_id in sorted(users):
+            shard_id = self.shard_id_for(user_id)
+            dest = self.shard(shard_id)
+            # dest commits first, so an interrupted import can leave a duplicate but never lose rows
+            with source.transaction(), dest.transaction():
+                move_user_rows(user_id, source, dest, replace=False)
+                delete_user_rows(user_id, source)
+            imported[user_id] = shard_id
+        return imported
+
+
+    def close(self):
+        for db in self.shards.values():
+            db.close()
+        self.catalog.close()
+
+
+def _call(db, func, args, kwargs):
+    if isinstance(func, str):
+        return getattr(db, func)(*args, **kwargs)
+    return func(db, *args, **kwargs)
+
+
+#rows of table as (column names, rows) for one user
+def _user_rows(db, table, user_id):
+    result = db.run_query(f"SELECT * FROM {table} WHERE user_id = ?;", user_id)
+    return [column[0] for column in result.description], result.fetchall()
+
+
+def _insert_row(db, table, columns, row, overrides):
+    values = dict(zip(columns, row))
+    values.pop("row_id")
+    values.update(overrides)
+    names = list(values)
+    placeholders = ",".join("?" for _ in names)
+    return db.run_query(f"INSERT INTO {table} ({','.join(names)}) VALUES ({placeholders});",
+                        *[values[name] for name in names]).lastrowid
+
+
+#copy a user's program, logs and chats from source to dest with new row ids
+#rows already on dest are replaced (leftovers of an interrupted move) unless replace is False
+def move_user_rows(user_id, source, dest, replace=True):
+    tables = {table: _user_rows(source, table, user_id) for table in USER_TABLES}
+    parents = [row[0] for row in tables["chat_history"][1]]
+    entries = []
+    if parents:
+        placeholders = ",".join("?" for _ in parents)
+        result = source.run_query(f"SELECT * FROM chat_history_entries WHERE fk_row_id IN ({placeholders});", *parents)
+        entries = ([column[0] for column in result.description], result.fetchall())
+    result = source.run_query("SELECT * FROM recommendation_jobs WHERE user_id = ?;", user_id)
+    jobs = ([column[0] for column in result.description], result.fetchall())
+
+    with dest.transaction():
+        # leftovers from an interrupted move are replaced, not duplicated
+        if replace:
+            delete_user_rows(user_id, dest)
+
+        program_ids = {}
+        columns, rows = tables["user_program"]
+        for row in rows:
+            program_ids[row[0]] = _insert_row(dest, "user_program", columns, row, {})
+
+        log_ids = {}
+        columns, rows = tables["daily_log_table"]
+        for row in rows:
+            old_program_id = row[columns.index("user_program_row_id")]
+            log_ids[row[0]] = _insert_row(dest, "daily_log_table", columns, row,
+                                          {"user_program_row_id": program_ids.get(old_program_id, old_program_id)})
+
+        # job ids stay the same so a client polling one still finds it
+        columns, rows = jobs
+        for row in rows:
+            values = dict(zip(columns, row))
+            values["log_row_id"] = log_ids[values["log_row_id"]]
+            dest.run_query(f"INSERT INTO recommendation_jobs ({','.join(values)}) VALUES ({','.join('?' for _ in values)});",
+                           *values.values())
+
+        chat_ids = {}
+        columns, rows = tables["chat_history"]
+        for row in rows:
+            chat_ids[row[0]] = _insert_row(dest, "chat_history", columns, row, {})
+
+        if entries:
+            columns, rows = entries
+            for row in rows:
+                _insert_row(dest, "chat_history_entries", columns, row,
+                            {"fk_row_id": chat_ids[row[columns.index("fk_row_id")]]})
+
+
+def delete_user_rows(user_id, db):
+    with db.transaction():
+        db.run_query("DELETE FROM chat_history_entries WHERE fk_row_id IN (SELECT row_id FROM chat_history WHERE user_id = ?);", user_id)
+        db.run_query("DELETE FROM recommendation_jobs WHERE user_id = ?;", user_id)
+        for table in USER_TABLES:
+            db.run_query(f"DELETE FROM {table} WHERE user_id = ?;", user_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Inspect, rebalance or fill the BennyDB shards",
+        epilog="Rebalance and import can run while the services are up: writes for a user being moved "
+               "wait for the move and then go to the new shard.")
+    parser.add_argument("command", choices=["status", "rebalance", "import"])
+    parser.add_argument("--shards", type=int, help="new shard count for rebalance")
+    parser.add_argument("--directory", default=str(SHARD_DIRECTORY), help="folder holding the shard files")
+    parser.add_argument("--source", default=str(DATABASE_PATH), help="unsharded database to import from")
+    args = parser.parse_args()
+
+    shards = sharded_wellness_ai_db(directory=args.directory)
+    try:
+        if args.command == "rebalance":
+            if not args.shards:
+                parser.error("rebalance needs --shards")
+            moved = shards.rebalance(args.shards)
+            print(f"Moved {len(moved)} users to fit {args.shards} shards")
+        elif args.command == "import":
+            source = wellness_ai_db(args.source)
+            try:
+                imported = shards.import_database(source)
+            finally:
+                source.close()
+            print(f"Imported {len(imported)} users from {args.source}")
+        counts = {}
+        for shard_id in shards.catalog.users().values():
+            counts[shard_id] = counts.get(shard_id, 0) + 1
+        print(f"Shard count: {shards.ring.shard_count}")
+        for shard_id in range(shards.ring.shard_count):
+            print(f"  shard {shard_id}: {counts.get(shard_id, 0)} users")
+    finally:
+        shards.close()
+
+
+if __name__ == "__main__":
+    main()
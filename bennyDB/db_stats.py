@@ -0,0 +1,123 @@
+# Opt-in query instrumentation for wellness_ai_db.
+#
+#   db.enable_stats(slow_query_ms=50)
+#   ...
+#   db.get_stats()
+#
+# Statements are grouped by their normalized SQL (literals replaced with ?,
+# whitespace collapsed). For each one we keep a latency histogram, total and
+# max time, rows returned and the time spent waiting for a connection (the
+# writer lock or a free reader). Statements slower than the threshold go into
+# a bounded slow-query log together with their EXPLAIN QUERY PLAN.
+# When stats are disabled run_query only pays for one attribute check.
+
+import collections
+import functools
+import re
+import threading
+
+
+SLOW_QUERY_MS = 100
+SLOW_LOG_SIZE = 50
+
+#histogram bucket upper bounds in milliseconds, the last bucket is everything above
+BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+PLACEHOLDER_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)", re.IGNORECASE)
+WHITESPACE = re.compile(r"\s+")
+
+
+#same shape of statement -> same key, the app reuses a small set of query strings
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(query):
+    query = STRING_LITERAL.sub("?", query)
+    query = NUMBER_LITERAL.sub("?", query)
+    query = PLACEHOLDER_LIST.sub("IN (...)", query)
+    return WHITESPACE.sub(" ", query).strip().rstrip(";")
+
+
+class statement_stats:
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.lock_wait_ms = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, elapsed_ms, rows, lock_wait_ms):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.rows += rows
+        self.lock_wait_ms += lock_wait_ms
+        for index, bound in enumerate(BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[index] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def as_dict(self):
+        histogram = {f"le_{bound}ms": count for bound, count in zip(BUCKETS_MS, self.buckets)}
+        histogram["inf"] = self.buckets[-1]
+        return {
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "rows": self.rows,
+            "lock_wait_ms": round(self.lock_wait_ms, 3),
+            "histogram": histogram,
+        }
+
+
+class query_stats:
+    def __init__(self, slow_query_ms=SLOW_QUERY_MS, slow_log_size=SLOW_LOG_SIZE):
+        self.slow_query_ms = slow_query_ms
+        self.statements = {}
+        self.slow_queries = collections.deque(maxlen=slow_log_size)
+        self.lock = threading.Lock()
+
+
+    def is_slow(self, elapsed_seconds):
+        return elapsed_seconds * 1000 >= self.slow_query_ms
+
+
+    def record(self, query, elapsed_seconds, rows, lock_wait_seconds):
+        key = normalize_sql(query)
+        with self.lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = statement_stats()
+            stats.add(elapsed_seconds * 1000, rows, lock_wait_seconds * 1000)
+
+
+    def record_slow(self, query, elapsed_seconds, plan):
+        with self.lock:
+            self.slow_queries.append({
+                "sql": normalize_sql(query),
+                "ms": round(elapsed_seconds * 1000, 3),
+                "plan": plan,
+            })
+
+
+    #everything collected so far, slowest total time first
+    def snapshot(self):
+        with self.lock:
+            statements = sorted(((sql, stats.as_dict()) for sql, stats in self.statements.items()),
+                                key=lambda item: item[1]["total_ms"], reverse=True)
+            return {
+                "enabled": True,
+                "slow_query_ms": self.slow_query_ms,
+                "statements": [dict(sql=sql, **stats) for sql, stats in statements],
+                "slow_queries": list(self.slow_queries),
+            }
+
+
+    def reset(self):
+        with self.lock:
+            self.statements.clear()
+            self.slow_queries.clear()
@@ -0,0 +1,277 @@
+# Prometheus metrics for the Benny services, without the prometheus_client dependency.
+#
+#   requests = REGISTRY.histogram("benny_http_request_duration_seconds", "...", ("route", "status"))
+#   requests.observe(0.012, "/health", "200")
+#   REGISTRY.render()  -> text for GET /metrics
+#
+# Updates never take a lock. Every thread adds into its own shard (found through
+# threading.local), and render() sums the shards when /metrics is scraped. The
+# asyncio handlers all run on the event loop thread, so in practice they share
+# one shard and the db_async worker threads each have their own.
+# http_metrics is ASGI middleware that times every request by route template.
+
+import bisect
+import threading
+import time
+
+
+#latency bucket upper bounds in seconds, +Inf is added when rendering
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.local = threading.local()
+        self.shards = []
+        self.shards_lock = threading.Lock()
+
+
+    #this thread's {label values: value} dict, registered the first time the thread uses the metric
+    def _shard(self):
+        shard = getattr(self.local, "values", None)
+        if shard is None:
+            shard = self.local.values = {}
+            with self.shards_lock:
+                self.shards.append(shard)
+        return shard
+
+
+    #every thread's values merged, a thread may add a key while we copy so retry on that
+    def _collect(self, merge):
+        with self.shards_lock:
+            shards = list(self.shards)
+        merged = {}
+        for shard in shards:
+            while True:
+                try:
+                    items = list(shard.items())
+                    break
+                except RuntimeError:
+                    continue
+            for key, value in items:
+                merged[key] = merge(merged[key], value) if key in merged else merge(None, value)
+        return merged
+
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class counter(metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        shard = self._shard()
+        shard[label_values] = shard.get(label_values, 0) + amount
+
+
+    def value(self, *label_values):
+        return self._collect(lambda total, value: (total or 0) + value).get(label_values, 0)
+
+
+    def _samples(self):
+        merged = self._collect(lambda total, value: (total or 0) + value)
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+                for key, value in sorted(merged.items())]
+
+
+#a gauge that goes up and down, e.g. requests in flight, summed across threads
+class gauge(counter):
+    kind = "gauge"
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+#a gauge read when /metrics is scraped, read() returns {label values tuple: value}
+class callback_gauge(metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels, read):
+        super().__init__(name, documentation, labels)
+        self.read = read
+
+
+    def _samples(self):
+        try:
+            values = self.read()
+        except Exception:
+            return []
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+                for key, value in sorted(values.items())]
+
+
+class histogram(metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+
+    #per label values the shard holds [count per bucket..., count above the last bucket, sum]
+    def observe(self, value, *label_values):
+        shard = self._shard()
+        counts = shard.get(label_values)
+        if counts is None:
+            counts = shard[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+
+    #with metric.time("label"): ... observes the seconds the block took
+    def time(self, *label_values):
+        return timer(self, label_values)
+
+
+    def snapshot(self, *label_values):
+        counts = self._collect(self._merge).get(label_values)
+        if counts is None:
+            return {"count": 0, "sum": 0.0}
+        return {"count": sum(counts[:-1]), "sum": counts[-1]}
+
+
+    @staticmethod
+    def _merge(total, counts):
+        if total is None:
+            return list(counts)
+        return [a + b for a, b in zip(total, counts)]
+
+
+    def _samples(self):
+        samples = []
+        for key, counts in sorted(self._collect(self._merge).items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = format_labels(self.labels, key, f'le="{format_value(float(bound))}"')
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            samples.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(counts[-1])}")
+            samples.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return samples
+
+
+class timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+class registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+
+    #metrics are created once at import time, asking again for the same name returns the existing one
+    def _register(self, name, factory):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = factory()
+            return self.metrics[name]
+
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(name, lambda: counter(name, documentation, labels))
+
+
+    def gauge(self, name, documentation, labels=()):
+        return self._register(name, lambda: gauge(name, documentation, labels))
+
+
+    def callback_gauge(self, name, documentation, labels, read):
+        return self._register(name, lambda: callback_gauge(name, documentation, labels, read))
+
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(name, lambda: histogram(name, documentation, labels, buckets))
+
+
+    #Prometheus text exposition format of every metric
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for each in metrics:
+            lines.extend(each.render())
+        return "\n".join(lines) + "\n"
+
+
+#the process-wide registry both services serve at /metrics
+REGISTRY = registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "benny_http_request_duration_seconds", "Time to handle a request, until the last byte of the body was sent",
+    ("method", "route", "status"))
+HTTP_IN_FLIGHT = REGISTRY.gauge(
+    "benny_http_requests_in_flight", "Requests being handled right now", ("method",))
+
+
+#ASGI middleware: app.add_middleware(http_metrics)
+#routes are labelled by their template (/api/checkin/recommendation/{job_id}), so ids don't create new series
+class http_metrics:
+    def __init__(self, app, exclude=("/metrics",)):
+        self.app = app
+        self.exclude = set(exclude)
+
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude:
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = ["500"]
+        started = time.perf_counter()
+        # by method only, the route is not known until the router has matched it
+        HTTP_IN_FLIGHT.inc(method)
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = str(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_FLIGHT.dec(method)
+            route = scope.get("route")
+            route = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method, route, status[0])
@@ -19,7 +19,7 @@ def test_update_user_success_daily_log():
 
     # Initialize database connector and define test date
     db = wellness_ai_db()
-    test_date = "01/15/2025"
+    test_date = "2025-01-15"
 
     # Add a test row to daily_log_table first (with activity_complete = 0)
     db.run_query("""INSERT INTO daily_log_table
@@ -152,7 +152,7 @@ def test_get_form_responses_for_benny():
 
     # Add test data for today's date
     import datetime
-    today = datetime.datetime.now().date().strftime("%m/%d/%Y")
+    today = datetime.datetime.now().date().isoformat()
     test_activity_name = "test_activity_for_benny"
 
     db.run_query("""INSERT INTO daily_log_table
@@ -182,3 +182,687 @@ def test_get_form_responses_for_benny():
     # Cleanup
     db.run_query("DELETE FROM daily_log_table WHERE log_date = ? AND activity_name = ?;", today, test_activity_name)
     db.db.close()
+
+
+def test_connection_pool_readers_do_not_block_on_writer(tmp_path):
+    """
+    Readers use their own read-only WAL connections, so a SELECT returns
+    while another thread is holding the write lock mid-transaction.
+    """
+    import threading
+
+    db = wellness_ai_db(tmp_path / "pool_test.sqlite3", busy_timeout=1000)
+
+    with db.db.write_connection() as conn:
+        assert conn.execute("PRAGMA journal_mode;").fetchone()[0] == "wal"
+
+    writer_started = threading.Event()
+    release_writer = threading.Event()
+
+    def hold_writer():
+        with db.db.write_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            conn.execute("INSERT INTO chat_history (date) VALUES (?);", ("01/01/2025",))
+            writer_started.set()
+            release_writer.wait(5)
+            conn.commit()
+
+    writer = threading.Thread(target=hold_writer)
+    writer.start()
+    assert writer_started.wait(5)
+
+    # the uncommitted row is not visible and the read does not wait for it
+    rows = db.run_query("SELECT * FROM chat_history;").fetchall()
+    assert rows == []
+
+    release_writer.set()
+    writer.join()
+    assert len(db.run_query("SELECT * FROM chat_history;").fetchall()) == 1
+    db.close()
+
+
+def test_connection_pool_concurrent_writes(tmp_path):
+    """
+    Writes from many threads are serialized by the pool instead of failing
+    with "database is locked" or clobbering each other's results.
+    """
+    import threading
+
+    db = wellness_ai_db(tmp_path / "pool_test.sqlite3")
+    errors = []
+
+    def write_rows(thread_number):
+        try:
+            for i in range(25):
+                db.run_query("INSERT INTO chat_history (date) VALUES (?);", f"{thread_number}-{i}")
+                db.run_query("SELECT COUNT(*) FROM chat_history;").fetchone()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write_rows, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert db.run_query("SELECT COUNT(*) FROM chat_history;").fetchone()[0] == 200
+    db.close()
+
+
+def test_transaction_commits_once_and_rolls_back(tmp_path):
+    """
+    Statements inside transaction() commit together, and an exception in
+    the block rolls all of them back.
+    """
+    db = wellness_ai_db(tmp_path / "transaction_test.sqlite3")
+
+    with db.transaction():
+        db.insert_row_chat_history_main("02/01/2025")
+        # reads inside the transaction see its own uncommitted writes
+        assert db.fetch_main_chat_history_pk("02/01/2025") is not None
+        db.run_many("INSERT INTO chat_history_entries (fk_row_id, sequence_number, user_or_benny, entry_text) VALUES (?,?,?,?);",
+                    [(1, 1, 0, "hi"), (1, 2, 1, "hello")])
+
+    assert len(db.fetch_chat_logs_by_date("02/01/2025")) == 2
+
+    try:
+        with db.transaction():
+            db.insert_row_chat_history_main("02/02/2025")
+            raise RuntimeError("abort")
+    except RuntimeError:
+        pass
+
+    assert db.fetch_main_chat_history_pk("02/02/2025") is None
+    assert not db.in_transaction()
+    db.close()
+
+
+def query_plan(db, query, *query_args):
+    """Return the EXPLAIN QUERY PLAN detail lines for a query"""
+    rows = db.run_query("EXPLAIN QUERY PLAN " + query, *query_args).fetchall()
+    return [row[3] for row in rows]
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    """
+    The date, chat entry and four-week plan lookups are served from
+    secondary indexes instead of full table scans.
+    """
+    db = wellness_ai_db(tmp_path / "index_test.sqlite3")
+
+    hot_queries = [
+        ("SELECT row_id FROM chat_history WHERE user_id = (?) AND date = (?);", ("anonymous", "2025-01-15"), "idx_chat_history_user_date"),
+        ("SELECT COALESCE(MAX(sequence_number), 0) + 1 FROM chat_history_entries WHERE fk_row_id = (?);", (1,), "idx_chat_entries_parent_seq"),
+        ("SELECT * FROM chat_history_entries WHERE fk_row_id = (?) ORDER BY sequence_number ASC;", (1,), "idx_chat_entries_parent_seq"),
+        ("SELECT * FROM daily_log_table WHERE log_date = (?);", ("2025-01-15",), "idx_daily_log_date"),
+        ("SELECT * FROM daily_log_table WHERE log_date BETWEEN ? AND ?;", ("2025-01-01", "2025-01-31"), "idx_daily_log_date"),
+        ("SELECT * FROM user_program WHERE date = (?);", ("2025-01-15",), "idx_user_program_date"),
+        ("SELECT * FROM user_program WHERE in_curr_four_week=(?) ORDER BY row_id ASC;", (1,), "idx_user_program_current"),
+    ]
+
+    for query, query_args, index_name in hot_queries:
+        plan = query_plan(db, query, *query_args)
+        assert any(index_name in line for line in plan), f"{query!r} does not use {index_name}: {plan}"
+        assert not any("TEMP B-TREE" in line for line in plan), f"{query!r} sorts in a temp b-tree: {plan}"
+
+    db.close()
+
+
+def test_legacy_dates_migrated_to_iso(tmp_path):
+    """
+    MM/DD/YYYY dates from older databases are rewritten as YYYY-MM-DD so
+    they sort correctly across years, and lookups accept either format.
+    """
+    database_path = tmp_path / "legacy_test.sqlite3"
+    db = wellness_ai_db(database_path)
+    db.run_query("INSERT INTO chat_history (date) VALUES (?);", "12/31/2024")
+    db.run_query("INSERT INTO chat_history (date) VALUES (?);", "01/02/2025")
+    # pretend this file was written before the date migration
+    db.run_query("PRAGMA user_version = 1;")
+    db.close()
+
+    db = wellness_ai_db(database_path)
+    dates = [row[0] for row in db.run_query("SELECT date FROM chat_history ORDER BY date DESC;").fetchall()]
+    assert dates == ["2025-01-02", "2024-12-31"]
+    assert db.fetch_main_chat_history_pk("01/02/2025") == db.fetch_main_chat_history_pk("2025-01-02")
+    db.close()
+
+
+def test_migrations_only_run_once(tmp_path, monkeypatch):
+    """
+    A fresh database is migrated to the latest version with seed data, and
+    reopening a current database does not run any DDL or reseed.
+    """
+    import db_migrations
+
+    database_path = tmp_path / "migration_test.sqlite3"
+    db = wellness_ai_db(database_path)
+    assert db.schema_version() == db_migrations.LATEST_VERSION
+
+    versions = db.run_query("SELECT version FROM schema_version ORDER BY version;").fetchall()
+    assert [row[0] for row in versions] == [m[0] for m in db_migrations.MIGRATIONS]
+
+    # user edits to reference data survive a restart
+    db.run_query("DELETE FROM questions WHERE row_id = 5;")
+    db.close()
+
+    def fail_if_called(db):
+        raise AssertionError("migrations should not run on a current database")
+
+    monkeypatch.setattr(db_migrations, "apply_migrations", fail_if_called)
+    db = wellness_ai_db(database_path)
+    assert len(db.get_form_questions_daily_checkin()) == 4
+    db.close()
+
+
+def test_migrations_are_idempotent_on_old_database(tmp_path):
+    """
+    A database built by the old drop-and-rebuild code (tables present,
+    user_version 0) migrates without duplicating seed rows.
+    """
+    import db_migrations
+
+    database_path = tmp_path / "old_test.sqlite3"
+    db = wellness_ai_db(database_path)
+    db.run_query("DROP TABLE schema_version;")
+    db.run_query("PRAGMA user_version = 0;")
+    db.close()
+
+    db = wellness_ai_db(database_path)
+    assert db.schema_version() == db_migrations.LATEST_VERSION
+    preferences = db.run_query("SELECT COUNT(*) FROM preferences_list;").fetchone()[0]
+    assert preferences == len(set(db.run_query("SELECT preference_name FROM preferences_list;").fetchall()))
+    assert len(db.get_form_questions_daily_checkin()) == 5
+    db.close()
+
+
+def test_async_db_does_not_block_event_loop(tmp_path):
+    """
+    Awaiting a write that is stuck behind the writer lock leaves the event
+    loop free, and reads still complete in the meantime.
+    """
+    import asyncio
+    import threading
+    from db_async import async_wellness_ai_db
+
+    adb = async_wellness_ai_db(database_path=tmp_path / "async_test.sqlite3")
+    release_writer = threading.Event()
+    writer_held = threading.Event()
+
+    def hold_writer():
+        with adb.sync.db.write_connection():
+            writer_held.set()
+            release_writer.wait(5)
+
+    async def scenario():
+        blocker = threading.Thread(target=hold_writer)
+        blocker.start()
+        writer_held.wait(5)
+
+        write = asyncio.create_task(adb.write("insert_row_chat_history_main", "2025-03-01"))
+        # the loop keeps running while the write waits
+        await asyncio.sleep(0.05)
+        assert not write.done()
+        questions = await adb.read("get_form_questions_daily_checkin")
+        assert len(questions) == 5
+
+        release_writer.set()
+        await write
+        blocker.join()
+        row = (await adb.run_query("SELECT date FROM chat_history;")).fetchone()
+        assert row == ("2025-03-01",)
+
+    asyncio.run(scenario())
+    adb.close()
+
+
+def test_append_chat_exchange(tmp_path):
+    """
+    append_chat_exchange creates the day's row on first use, keeps users
+    apart and hands out unique sequence numbers under concurrent writers.
+    """
+    import threading
+
+    db = wellness_ai_db(tmp_path / "append_test.sqlite3")
+
+    assert db.append_chat_exchange("user-a", "2025-04-01", "hi", "hello") == 1
+    assert db.append_chat_exchange("user-a", "04/01/2025", "how are you", "great") == 3
+    assert db.append_chat_exchange("user-b", "2025-04-01", "hey", "hey there") == 1
+
+    entries = db.fetch_chat_logs_by_date("2025-04-01", "user-a")
+    assert [(row[2], row[3], row[4]) for row in entries] == [
+        (1, 0, "hi"), (2, 1, "hello"), (3, 0, "how are you"), (4, 1, "great")]
+
+    def chat(thread_number):
+        for i in range(20):
+            db.append_chat_exchange("user-c", "2025-04-01", f"q{thread_number}-{i}", "a")
+
+    threads = [threading.Thread(target=chat, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    sequence_numbers = [row[2] for row in db.fetch_chat_logs_by_date("2025-04-01", "user-c")]
+    assert sequence_numbers == list(range(1, 161))
+    assert db.run_query("SELECT COUNT(*) FROM chat_history WHERE user_id = ?;", "user-c").fetchone()[0] == 1
+    db.close()
+
+
+def test_fetch_chat_page_keyset_pagination(tmp_path):
+    """
+    Paging with the (date, sequence) cursor walks one user's history
+    newest to oldest without gaps, repeats or other users' messages.
+    """
+    db = wellness_ai_db(tmp_path / "page_test.sqlite3")
+    for day in ("2024-12-31", "2025-01-01", "2025-01-02"):
+        for i in range(3):
+            db.append_chat_exchange("user-a", day, f"{day} q{i}", f"{day} a{i}")
+    db.append_chat_exchange("user-b", "2025-01-02", "other", "other")
+
+    seen = []
+    before_date, before_seq = None, None
+    while True:
+        page = db.fetch_chat_page("user-a", 4, before_date, before_seq)
+        if not page:
+            break
+        assert len(page) <= 4
+        seen.extend(page)
+        before_seq, before_date = page[-1][0], page[-1][3]
+
+    assert len(seen) == 18
+    assert [(row[3], row[0]) for row in seen] == sorted(((row[3], row[0]) for row in seen), reverse=True)
+    assert all("other" not in row[2] for row in seen)
+
+    for query, query_args in [
+        ("SELECT che.sequence_number FROM chat_history ch JOIN chat_history_entries che ON che.fk_row_id = ch.row_id "
+         "WHERE ch.user_id = ? AND ch.date = ? AND che.sequence_number < ? ORDER BY che.sequence_number DESC LIMIT ?;",
+         ("user-a", "2025-01-01", 3, 4)),
+        ("SELECT che.sequence_number FROM chat_history ch JOIN chat_history_entries che ON che.fk_row_id = ch.row_id "
+         "WHERE ch.user_id = ? AND ch.date < ? ORDER BY ch.date DESC, che.sequence_number DESC LIMIT ?;",
+         ("user-a", "2025-01-01", 4)),
+    ]:
+        plan = query_plan(db, query, *query_args)
+        assert any("COVERING INDEX idx_chat_history_user_date" in line for line in plan), plan
+        assert any("idx_chat_entries_parent_seq" in line for line in plan), plan
+        assert not any("TEMP B-TREE" in line for line in plan), plan
+    db.close()
+
+
+def test_reference_cache_serves_and_invalidates(tmp_path, monkeypatch):
+    """
+    Reference data is served from memory after the first read, and a
+    committed write to the table invalidates it and changes the ETag.
+    """
+    db = wellness_ai_db(tmp_path / "cache_test.sqlite3")
+    questions, etag = db.get_form_questions_with_etag()
+    preference_ids = db.get_preference_ids()
+    assert "sleep" in preference_ids
+
+    def no_database(*args):
+        raise AssertionError("cache hit should not query the database")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(db, "read_query", no_database)
+        assert db.get_form_questions_with_etag() == (questions, etag)
+        assert db.get_preference_ids() == preference_ids
+
+    db.run_query("UPDATE questions SET question_text = ? WHERE row_id = 1;", "How was lunch?")
+    new_questions, new_etag = db.get_form_questions_with_etag()
+    assert new_questions[0][1] == "How was lunch?"
+    assert new_etag != etag
+
+    # writes inside a transaction invalidate when it commits
+    with db.transaction():
+        db.run_query("INSERT INTO preferences_list (preference_name) VALUES (?);", "journaling")
+    assert "journaling" in db.get_preference_ids()
+
+    # goal helpers use the cached ids
+    db.add_ranked_goal("journaling", 4)
+    assert (4, db.get_preference_ids()["journaling"]) in [row[1:] for row in db.get_user_priorities()]
+    db.close()
+
+
+def test_sharded_routing_and_rebalance(tmp_path):
+    """
+    Users are spread over the shards and keep their route across restarts,
+    and rebalancing moves only the users whose shard changed, with their
+    chats, logs, program rows and recommendation jobs intact.
+    """
+    from db_shards import sharded_wellness_ai_db, hash_ring
+
+    ring = hash_ring(4)
+    assert {ring.shard_for(f"user-{n}") for n in range(200)} == {0, 1, 2, 3}
+
+    shards = sharded_wellness_ai_db(2, tmp_path)
+    users = [f"user-{n}" for n in range(20)]
+    for user_id in users:
+        db = shards.for_user(user_id)
+        db.append_chat_exchange(user_id, "2025-05-01", f"{user_id} question", "answer")
+        db.run_query("INSERT INTO user_program (date, activity_name, activity_addresses_goal, in_curr_four_week, user_id) VALUES (?,?,?,?,?);",
+                     "2025-05-01", "walk", 1, 1, user_id)
+        program_id = db.run_query("SELECT row_id FROM user_program WHERE user_id = ?;", user_id).fetchone()[0]
+        db.run_query("INSERT INTO daily_log_table (user_program_row_id, log_date, activity_complete, activity_name, activity_addresses_goal, user_id) VALUES (?,?,?,?,?,?);",
+                     program_id, "2025-05-01", 1, "walk", 1, user_id)
+        db.add_checkin_with_job(f"job-{user_id}", "2025-05-02", {"sleep": "good"}, user_id)
+    routes = shards.catalog.users()
+    shards.close()
+
+    # the catalog keeps routes, even if a different count is asked for
+    shards = sharded_wellness_ai_db(8, tmp_path)
+    assert shards.ring.shard_count == 2
+    assert shards.catalog.users() == routes
+
+    moved = shards.rebalance(4)
+    assert moved and len(moved) < len(users)
+    for user_id in users:
+        db = shards.for_user(user_id)
+        assert shards.shard_id_for(user_id) == hash_ring(4).shard_for(user_id)
+        chat = db.fetch_chat_logs_by_date("2025-05-01", user_id)
+        assert [row[4] for row in chat] == [f"{user_id} question", "answer"]
+        log = db.run_query("SELECT user_program_row_id FROM daily_log_table WHERE user_id = ? AND log_date = '2025-05-01';", user_id).fetchall()
+        program = db.run_query("SELECT row_id FROM user_program WHERE user_id = ?;", user_id).fetchall()
+        assert len(log) == 1 and log[0][0] == program[0][0]
+        assert db.get_recommendation_job(f"job-{user_id}")["log_date"] == "2025-05-02"
+
+    for user_id, (old_shard, new_shard) in moved.items():
+        old_rows = shards.shard(old_shard).run_query("SELECT COUNT(*) FROM chat_history WHERE user_id = ?;", user_id).fetchone()[0]
+        assert old_rows == 0
+    shards.close()
+
+
+def test_write_during_rebalance_follows_the_user(tmp_path):
+    """
+    A write for a user who is being moved waits for the move and lands on
+    the new shard, and a second process with stale cached routes (and ring)
+    corrects them from the catalog instead of writing to the old shard.
+    """
+    import threading
+    import db_shards
+    from db_shards import sharded_wellness_ai_db, hash_ring
+
+    user_id = next(f"user-{n}" for n in range(100) if hash_ring(2).shard_for(f"user-{n}") != hash_ring(4).shard_for(f"user-{n}"))
+    shards = sharded_wellness_ai_db(2, tmp_path)
+    other_process = sharded_wellness_ai_db(2, tmp_path)
+    shards.write_for(user_id, "append_chat_exchange", user_id, "2025-05-01", "first", "answer")
+    assert other_process.shard_id_for(user_id) == hash_ring(2).shard_for(user_id)
+
+    copying, finish_copy = threading.Event(), threading.Event()
+    move_user_rows = db_shards.move_user_rows
+
+    def slow_move(*args, **kwargs):
+        move_user_rows(*args, **kwargs)
+        copying.set()
+        finish_copy.wait(5)
+
+    db_shards.move_user_rows = slow_move
+    try:
+        mover = threading.Thread(target=shards.rebalance, args=(4,))
+        mover.start()
+        assert copying.wait(5)
+        writer = threading.Thread(target=shards.write_for,
+                                  args=(user_id, "append_chat_exchange", user_id, "2025-05-01", "second", "answer"))
+        writer.start()
+        writer.join(0.2)
+        assert writer.is_alive()      # held back by the old shard's write lock
+        finish_copy.set()
+        mover.join(5)
+        writer.join(5)
+    finally:
+        db_shards.move_user_rows = move_user_rows
+
+    new_shard = hash_ring(4).shard_for(user_id)
+    assert shards.shard_id_for(user_id) == new_shard
+    other_process.write_for(user_id, "append_chat_exchange", user_id, "2025-05-01", "third", "answer")
+    assert other_process.shard_id_for(user_id) == new_shard
+    page = other_process.read_for(user_id, "fetch_chat_page", user_id, 10)
+    assert sorted(row[2] for row in page if row[1] == 0) == ["first", "second", "third"]
+
+    # users placed after the rebalance use the new ring in every process
+    newcomer = next(f"new-{n}" for n in range(100) if hash_ring(2).shard_for(f"new-{n}") != hash_ring(4).shard_for(f"new-{n}"))
+    assert other_process.shard_id_for(newcomer) == hash_ring(4).shard_for(newcomer)
+    other_process.close()
+    shards.close()
+
+
+def test_import_unsharded_database(tmp_path):
+    """Rows of the database used before sharding are moved to each user's shard"""
+    from db_shards import sharded_wellness_ai_db
+
+    source = wellness_ai_db(tmp_path / "BennyDB.sqlite3")
+    for user_id in ("user-a", "user-b"):
+        source.append_chat_exchange(user_id, "2025-05-01", f"{user_id} question", "answer")
+        source.add_checkin_with_job(f"job-{user_id}", "2025-05-02", {"sleep": "good"}, user_id)
+    shards = sharded_wellness_ai_db(2, tmp_path)
+    shards.write_for("user-a", "append_chat_exchange", "user-a", "2025-05-03", "newer question", "answer")
+
+    assert sorted(shards.import_database(source)) == ["user-a", "user-b"]
+    assert source.run_query("SELECT COUNT(*) FROM chat_history;").fetchone()[0] == 0
+    page = shards.read_for("user-a", "fetch_chat_page", "user-a", 10)
+    assert sorted(row[2] for row in page if row[1] == 0) == ["newer question", "user-a question"]
+    assert shards.read_for("user-b", "get_recommendation_job", "job-user-b")["status"] == "queued"
+    source.close()
+    shards.close()
+
+
+def test_async_sharded_calls(tmp_path):
+    """Per-user async calls go to the user's shard, read_each asks every shard"""
+    import asyncio
+    from db_async import async_sharded_wellness_ai_db
+
+    async def scenario():
+        users = async_sharded_wellness_ai_db(shard_count=2, directory=tmp_path)
+        try:
+            for n in range(10):
+                await users.write(f"user-{n}", "add_checkin_with_job", f"job-{n}", "2025-05-02", {"sleep": "good"}, f"user-{n}")
+            await users.write("user-3", "append_chat_exchange", "user-3", "2025-05-01", "question", "answer")
+            assert len(await users.read("user-3", "fetch_chat_page", "user-3", 10)) == 2
+            jobs = await users.read_each("get_recommendation_job", "job-3")
+            assert [job["user_id"] for job in jobs if job] == ["user-3"]
+            assert len(jobs) == 2
+        finally:
+            users.close()
+
+    asyncio.run(scenario())
+
+
+def test_query_stats(tmp_path):
+    """
+    With stats enabled statements are grouped by normalized SQL with
+    timings and row counts, and slow ones are logged with their plan.
+    """
+    db = wellness_ai_db(tmp_path / "stats_test.sqlite3")
+    assert db.get_stats() == {"enabled": False}
+
+    db.enable_stats(slow_query_ms=0)
+    db.insert_row_chat_history_main("2025-06-01")
+    db.insert_row_chat_history_main("2025-06-02")
+    db.run_query("SELECT * FROM chat_history WHERE date = '2025-06-01';")
+    db.run_query("SELECT * FROM chat_history WHERE date = '2025-06-02';")
+
+    stats = db.get_stats()
+    by_sql = {statement["sql"]: statement for statement in stats["statements"]}
+    assert by_sql["INSERT INTO chat_history (user_id, date) VALUES (?,?)"]["count"] == 2
+    select = by_sql["SELECT * FROM chat_history WHERE date = ?"]
+    assert select["count"] == 2 and select["rows"] == 2
+    assert sum(select["histogram"].values()) == 2
+
+    slow_plans = [entry["plan"] for entry in stats["slow_queries"] if entry["sql"].startswith("SELECT")]
+    assert slow_plans and any("chat_history" in line for line in slow_plans[0])
+
+    db.disable_stats()
+    db.run_query("SELECT 1;")
+    assert db.get_stats() == {"enabled": False}
+    db.close()
+
+
+def test_recommendation_jobs(tmp_path):
+    """
+    A check in and its job are saved together, each job is claimed by one
+    worker, retries wait for run_after and the finished recommendation is
+    stored on the daily log row. Jobs left running are requeued on restart.
+    """
+    import threading
+    import time
+
+    database_path = tmp_path / "jobs_test.sqlite3"
+    db = wellness_ai_db(database_path)
+    checkin = {"nutrition": "good", "sleep": "poor", "stress": "high"}
+    log_row_id = db.add_checkin_with_job("job-1", "2025-07-01", checkin, "user-a", request_id="req-1")
+    db.add_checkin_with_job("job-2", "2025-07-01", checkin, "user-b")
+
+    log_row = db.run_query("SELECT user_id, nutrition, sleep_quality, stress_level, recommendation FROM daily_log_table WHERE row_id = ?;",
+                           log_row_id).fetchone()
+    assert log_row == ("user-a", "good", "poor", "high", None)
+    assert db.get_recommendation_job("job-1")["status"] == "queued"
+    assert db.get_recommendation_job("missing") is None
+
+    # concurrent workers never claim the same job
+    claimed = []
+    def claim():
+        job = db.claim_recommendation_job()
+        if job is not None:
+            claimed.append(job["job_id"])
+    threads = [threading.Thread(target=claim) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == ["job-1", "job-2"]
+    assert db.run_query("SELECT request_id FROM recommendation_jobs WHERE job_id = 'job-1';").fetchone()[0] == "req-1"
+    assert db.claim_recommendation_job() is None
+
+    db.complete_recommendation_job("job-1", "Go for a walk.")
+    job = db.get_recommendation_job("job-1")
+    assert (job["status"], job["attempts"], job["recommendation"]) == ("done", 1, "Go for a walk.")
+
+    # a retry in the future is not claimed yet, a retry that is due is
+    db.fail_recommendation_job("job-2", "HTTP 503", retry_at=time.time() + 60)
+    assert db.claim_recommendation_job() is None
+    db.fail_recommendation_job("job-2", "HTTP 503", retry_at=0)
+    job = db.claim_recommendation_job()
+    assert (job["job_id"], job["attempts"], job["checkin"]) == ("job-2", 2, checkin)
+    db.close()
+
+    # the process stopped with job-2 running
+    db = wellness_ai_db(database_path)
+    assert db.requeue_running_recommendation_jobs() == 1
+    assert db.claim_recommendation_job()["attempts"] == 3
+    db.fail_recommendation_job("job-2", "HTTP 503")
+    job = db.get_recommendation_job("job-2")
+    assert (job["status"], job["error"], job["recommendation"]) == ("failed", "HTTP 503", None)
+    db.close()
+
+
+def test_recommendation_job_lease(tmp_path):
+    """
+    A job whose worker never saved an outcome is claimed again once its
+    lease runs out, and not before.
+    """
+    db = wellness_ai_db(tmp_path / "lease_test.sqlite3")
+    db.add_checkin_with_job("job-1", "2025-07-01", {"sleep": "poor"}, "user-a")
+
+    assert db.claim_recommendation_job(lease=60)["attempts"] == 1
+    assert db.claim_recommendation_job() is None
+
+    db.run_query("UPDATE recommendation_jobs SET run_after = 0 WHERE job_id = 'job-1';")
+    job = db.claim_recommendation_job()
+    assert (job["job_id"], job["attempts"]) == ("job-1", 2)
+    assert db.get_recommendation_job("job-1")["status"] == "running"
+    db.close()
+
+
+def test_metrics_merge_threads_and_render():
+    """
+    Counters and histograms updated from several threads are summed when
+    rendered, and the output is in the Prometheus text format.
+    """
+    import threading
+    from metrics import registry
+
+    metrics = registry()
+    calls = metrics.counter("test_calls_total", "Calls", ("kind",))
+    latency = metrics.histogram("test_latency_seconds", "Latency", ("kind",), buckets=(0.1, 1))
+    assert metrics.counter("test_calls_total", "Calls", ("kind",)) is calls
+
+    def work():
+        for _ in range(1000):
+            calls.inc("read")
+            latency.observe(0.05, "read")
+        latency.observe(5, "read")
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    calls.inc('say "hi"', amount=2)
+
+    assert calls.value("read") == 4000
+    assert latency.snapshot("read")["count"] == 4004
+    lines = metrics.render().splitlines()
+    assert "# TYPE test_calls_total counter" in lines
+    assert 'test_calls_total{kind="read"} 4000' in lines
+    assert 'test_calls_total{kind="say \\"hi\\""} 2' in lines
+    assert 'test_latency_seconds_bucket{kind="read",le="0.1"} 4000' in lines
+    assert 'test_latency_seconds_bucket{kind="read",le="1"} 4000' in lines
+    assert 'test_latency_seconds_bucket{kind="read",le="+Inf"} 4004' in lines
+    assert 'test_latency_seconds_count{kind="read"} 4004' in lines
+
+
+def test_async_db_calls_are_timed(tmp_path):
+    """db_async records how long each wellness_ai_db call took for /metrics"""
+    import asyncio
+    import db_async
+
+    async def run():
+        db = db_async.async_wellness_ai_db(database_path=tmp_path / "timed_test.sqlite3")
+        before = db_async.DB_CALL_SECONDS.snapshot("get_form_questions_with_etag", "reader")["count"]
+        await db.read("get_form_questions_with_etag")
+        await db.write("insert_row_chat_history_main", "2025-08-01")
+        after = db_async.DB_CALL_SECONDS.snapshot("get_form_questions_with_etag", "reader")["count"]
+        writes = db_async.DB_CALL_SECONDS.snapshot("insert_row_chat_history_main", "writer")["count"]
+        db.close()
+        return after - before, writes
+
+    reads, writes = asyncio.run(run())
+    assert reads == 1 and writes >= 1
+
+
+def test_request_tracing_headers_and_spans():
+    """
+    request_tracing keeps a valid X-Request-ID from the caller, replaces a
+    bad one, and answers with Server-Timing built from the request's spans.
+    """
+    import asyncio
+    import tracing
+
+    async def app(scope, receive, send):
+        with tracing.span("db"):
+            await asyncio.sleep(0.01)
+        with tracing.span("db"):
+            pass
+        with tracing.span("llm"):
+            await asyncio.sleep(0.01)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": tracing.request_id().encode()})
+
+    async def call(request_id):
+        sent = []
+        async def send(message):
+            sent.append(message)
+        scope = {"type": "http", "method": "GET", "path": "/x",
+                 "headers": [(b"x-request-id", request_id.encode())]}
+        await tracing.request_tracing(app)(scope, None, send)
+        return dict(sent[0]["headers"]), sent[1]["body"].decode()
+
+    headers, body = asyncio.run(call("checkin-123"))
+    assert headers[b"x-request-id"] == b"checkin-123" and body == "checkin-123"
+    timings = tracing.parse_server_timing(headers[b"server-timing"].decode())
+    assert list(timings) == ["db", "llm", "total"]
+    assert timings["db"] >= 10 and timings["llm"] >= 10 and timings["total"] >= timings["db"] + timings["llm"]
+
+    headers, _ = asyncio.run(call("bad id\r\n"))
+    assert headers[b"x-request-id"] != b"bad id\r\n" and len(headers[b"x-request-id"]) == 32
+    assert tracing.request_id() is None
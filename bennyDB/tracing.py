@@ -0,0 +1,220 @@
+# Request IDs, stage timings and structured logs for the Benny services.
+#
+#   app.add_middleware(tracing.request_tracing)
+#   with tracing.span("llm"):
+#       ...
+#   log = tracing.get_logger("benny.ai")
+#   log.info("chat saved", user_id=user_id)
+#
+# request_tracing takes the caller's X-Request-ID (or makes one up), keeps it
+# and the request's spans in a context variable, and answers with the same
+# X-Request-ID plus a Server-Timing header listing the time spent per stage.
+# Every log line is one JSON object carrying the request_id, so one check-in
+# can be followed from the backend into the AI service. With no request in
+# progress span() costs a single context variable lookup.
+
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+#ids from callers are passed on as they are if they look like this, otherwise we make a new one
+VALID_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+#Server-Timing metric names are HTTP tokens
+TIMING_NAME = re.compile(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]")
+
+#requests that are too frequent to be worth a log line each
+QUIET_PATHS = ("/metrics", "/health")
+
+current_trace = contextvars.ContextVar("benny_trace", default=None)
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+def valid_request_id(value):
+    return value if value and VALID_REQUEST_ID.match(value) else new_request_id()
+
+
+class trace:
+    def __init__(self, request_id=None):
+        self.request_id = request_id or new_request_id()
+        self.started = time.perf_counter()
+        self.spans = []  # (name, milliseconds) in the order they finished
+
+
+    def add(self, name, seconds):
+        self.spans.append((name, seconds * 1000))
+
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+
+    #total milliseconds per stage, a stage that ran more than once is summed
+    def timings(self):
+        totals = {}
+        for name, ms in self.spans:
+            totals[name] = totals.get(name, 0.0) + ms
+        return {name: round(ms, 3) for name, ms in totals.items()}
+
+
+    #Server-Timing header value, e.g. "db;dur=1.2, llm;dur=310.5, total;dur=312.9"
+    def server_timing(self):
+        parts = [f"{TIMING_NAME.sub('_', name)};dur={ms}" for name, ms in self.timings().items()]
+        parts.append(f"total;dur={round(self.elapsed_ms(), 3)}")
+        return ", ".join(parts)
+
+
+def request_id():
+    current = current_trace.get()
+    return current.request_id if current is not None else None
+
+
+#run a block as its own trace, for work that doesn't come from a request (background jobs)
+@contextlib.contextmanager
+def start_trace(request_id=None):
+    current = trace(request_id)
+    token = current_trace.set(current)
+    try:
+        yield current
+    finally:
+        current_trace.reset(token)
+
+
+#time a stage of the current request, does nothing outside a request
+@contextlib.contextmanager
+def span(name):
+    current = current_trace.get()
+    if current is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.add(name, time.perf_counter() - started)
+
+
+#"llm;dur=310.5, total;dur=312.9" -> {"llm": 310.5, "total": 312.9}, entries without a dur are skipped
+def parse_server_timing(header):
+    timings = {}
+    for entry in (header or "").split(","):
+        name, _, params = entry.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur" and name:
+                try:
+                    timings[name] = float(value)
+                except ValueError:
+                    pass
+    return timings
+
+
+class event_logger:
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+
+    #one JSON object per line: time, level, logger, event, request_id, then the fields
+    def _log(self, level, event, fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        record = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": logging.getLevelName(level).lower(),
+            "logger": self.logger.name,
+            "event": event,
+        }
+        current_id = request_id()
+        if current_id is not None:
+            record["request_id"] = current_id
+        record.update(fields)
+        self.logger.log(level, json.dumps(record, default=str))
+
+
+def get_logger(name):
+    return event_logger(name)
+
+
+#send the "benny" loggers to stderr as bare JSON lines, level from BENNY_LOG_LEVEL (INFO by default)
+def configure_logging(level=None):
+    logger = logging.getLogger("benny")
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel((level or os.getenv("BENNY_LOG_LEVEL", "INFO")).upper())
+
+
+access_log = get_logger("benny.access")
+
+
+#ASGI middleware: app.add_middleware(tracing.request_tracing)
+#adds X-Request-ID and Server-Timing to every response and logs one line per request
+#for streamed responses Server-Timing only covers the stages finished before the first byte
+class request_tracing:
+    def __init__(self, app, quiet_paths=QUIET_PATHS):
+        self.app = app
+        self.quiet_paths = set(quiet_paths)
+
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = None
+        for name, value in scope.get("headers", ()):
+            if name == b"x-request-id":
+                incoming = value.decode("latin-1")
+                break
+        current = trace(valid_request_id(incoming))
+        token = current_trace.set(current)
+        status = [500]
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                headers = list(message.get("headers", ()))
+                headers.append((b"x-request-id", current.request_id.encode("latin-1")))
+                headers.append((b"server-timing", current.server_timing().encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            current_trace.reset(token)
+            if scope["path"] not in self.quiet_paths:
+                route = getattr(scope.get("route"), "path", None) or scope["path"]
+                access_log.info("request", request_id=current.request_id, method=scope["method"],
+                                route=route, status=status[0], duration_ms=round(current.elapsed_ms(), 3),
+                                timings=current.timings())
@@ -0,0 +1,377 @@
+# End-to-end load test for the check-in and chat flows.
+#
+# Starts benny-ai-service on the stub LLM and benny-backend, both on a
+# temporary SQLite file, then sends a weighted mix of check-in submits, recent
+# chat pages and chats for --duration seconds and prints one JSON report:
+# throughput, p50/p95/p99 latency, error rates and status codes per operation.
+#
+#   python benny_load.py --concurrency 32 --duration 30
+#   python benny_load.py --rate 50 --mix checkin=1,recent=4,chat=2 --output run.json
+#   python benny_load.py --backend-url http://127.0.0.1:8000 --ai-url http://127.0.0.1:8001 --secret-key ...
+#
+# --concurrency is a closed loop: that many virtual users send one request
+# after another. --rate is an open loop: requests arrive at that average rate
+# (Poisson) whether or not earlier ones have finished, and latency is counted
+# from when a request was due, so a stalled server can't hide its queue.
+# Passing --backend-url and --ai-url tests services that are already running.
+
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import jwt
+
+
+REPO = pathlib.Path(__file__).resolve().parent.parent
+AI_SERVICE_DIR = REPO / "benny-ai-service" / "src" / "api"
+BACKEND_DIR = REPO / "benny-backend"
+
+OPERATIONS = ("checkin", "recent", "chat")
+DEFAULT_MIX = "checkin=1,recent=3,chat=2"
+STARTUP_TIMEOUT = 60
+
+CHECKIN_ANSWERS = {
+    "nutrition": ["great", "good", "okay", "poor"],
+    "sleep": ["great", "good", "okay", "poor"],
+    "fitness": ["yes", "partly", "no"],
+    "stress": ["low", "medium", "high"],
+}
+
+CHAT_MESSAGES = [
+    "How can I eat more fiber?",
+    "I slept badly again, any tips?",
+    "What is a good warm up before a run?",
+    "How do I stay motivated to work out in the morning?",
+    "I feel stressed at work, what can I do in five minutes?",
+    "How much water should I drink on a training day?",
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}, expected {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    if not any(weight > 0 for weight in mix.values()):
+        raise argparse.ArgumentTypeError("the mix needs at least one operation with a weight above 0")
+    return mix
+
+
+class services:
+    """The AI service and the backend as child processes, sharing a temporary database"""
+
+    def __init__(self, directory, secret_key, stub_latency_ms, stub_error_rate, seed):
+        self.directory = pathlib.Path(directory)
+        self.ai_port = free_port()
+        self.backend_port = free_port()
+        self.ai_url = f"http://127.0.0.1:{self.ai_port}"
+        self.backend_url = f"http://127.0.0.1:{self.backend_port}"
+        self.env = dict(
+            os.environ,
+            BENNY_DB_PATH=str(self.directory / "loadtest.sqlite3"),
+            BENNY_LLM_PROVIDER="stub",
+            BENNY_STUB_LATENCY_MS=str(stub_latency_ms),
+            BENNY_STUB_ERROR_RATE=str(stub_error_rate),
+            BENNY_STUB_SEED=str(seed),
+            BENNY_AI_URL=self.ai_url,
+            BENNY_LOG_LEVEL=os.getenv("BENNY_LOG_LEVEL", "WARNING"),
+            SECRET_KEY=secret_key,
+        )
+        self.processes = []
+
+
+    async def start(self):
+        # the AI service first, it creates the database the backend then opens
+        self._spawn("ai-service", AI_SERVICE_DIR, self.ai_port)
+        await self._wait_healthy(self.ai_url, "ai-service")
+        self._spawn("backend", BACKEND_DIR, self.backend_port)
+        await self._wait_healthy(self.backend_url, "backend")
+
+
+    def _spawn(self, name, directory, port):
+        log = open(self.directory / f"{name}.log", "wb")
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+             "--no-access-log"],
+            cwd=directory, env=self.env, stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append((name, process, log))
+
+
+    async def _wait_healthy(self, url, name):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        async with httpx.AsyncClient(timeout=2) as client:
+            while time.monotonic() < deadline:
+                for process_name, process, _ in self.processes:
+                    if process.poll() is not None:
+                        raise RuntimeError(f"{process_name} exited, see {self.directory / (process_name + '.log')}")
+                try:
+                    if (await client.get(f"{url}/health")).status_code == 200:
+                        return
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.2)
+        raise RuntimeError(f"{name} did not become healthy within {STARTUP_TIMEOUT}s")
+
+
+    def stop(self):
+        for _, process, _ in self.processes:
+            process.terminate()
+        for _, process, log in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            log.close()
+
+
+class recorder:
+    """Latency samples, status codes and errors per operation"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+        self.dropped = 0
+
+
+    def add(self, operation, seconds, status, ok):
+        self.latencies.setdefault(operation, []).append(seconds * 1000)
+        codes = self.statuses.setdefault(operation, {})
+        codes[str(status)] = codes.get(str(status), 0) + 1
+        if not ok:
+            self.errors[operation] = self.errors.get(operation, 0) + 1
+
+
+    def report(self, elapsed):
+        operations = {}
+        for operation, samples in sorted(self.latencies.items()):
+            operations[operation] = summarize(samples, self.errors.get(operation, 0), elapsed)
+            operations[operation]["status_codes"] = dict(sorted(self.statuses[operation].items()))
+        everything = [sample for samples in self.latencies.values() for sample in samples]
+        total = summarize(everything, sum(self.errors.values()), elapsed)
+        total["dropped"] = self.dropped
+        return {"total": total, "operations": operations}
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(samples, errors, elapsed):
+    ordered = sorted(samples)
+    count = len(ordered)
+    return {
+        "requests": count,
+        "errors": errors,
+        "error_rate": round(errors / count, 4) if count else 0.0,
+        "throughput_rps": round(count / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(ordered) / count, 3) if count else 0.0,
+            "p50": round(percentile(ordered, 0.50), 3),
+            "p95": round(percentile(ordered, 0.95), 3),
+            "p99": round(percentile(ordered, 0.99), 3),
+            "max": round(ordered[-1], 3) if count else 0.0,
+        },
+    }
+
+
+class workload:
+    """Builds and sends one request of each kind for a random virtual user"""
+
+    def __init__(self, backend, ai, users, secret_key, follow_recommendations, rng):
+        self.backend = backend
+        self.ai = ai
+        self.users = [f"loadtest-user-{n}" for n in range(users)]
+        self.tokens = {user: jwt.encode({"sub": user, "exp": int(time.time()) + 24 * 3600}, secret_key, algorithm="HS256")
+                       for user in self.users}
+        self.follow_recommendations = follow_recommendations
+        self.rng = rng
+
+
+    async def checkin(self, user, recorder, due):
+        responses = [{"category": category, "question": category, "response": self.rng.choice(answers)}
+                     for category, answers in CHECKIN_ANSWERS.items()]
+        response = await self.backend.post("/api/checkin/submit", json={"responses": responses},
+                                           headers=self._auth(user))
+        ok = response.status_code == 200 and response.json().get("success") is True
+        recorder.add("checkin", time.perf_counter() - due, response.status_code, ok)
+        if ok and self.follow_recommendations:
+            # submit to recommendation stored, through the background job
+            url = response.json()["recommendation_url"]
+            status, poll = None, None
+            while status not in ("done", "failed"):
+                poll = await self.backend.get(url, params={"wait": 25})
+                if poll.status_code != 200:
+                    break
+                status = poll.json()["status"]
+            recorder.add("recommendation", time.perf_counter() - due, poll.status_code, status == "done")
+
+
+    async def recent(self, user, recorder, due):
+        response = await self.backend.get("/api/chat/recent", params={"limit": 10}, headers=self._auth(user))
+        recorder.add("recent", time.perf_counter() - due, response.status_code, response.status_code == 200)
+
+
+    async def chat(self, user, recorder, due):
+        response = await self.ai.post("/chat", json={"message": self.rng.choice(CHAT_MESSAGES)},
+                                      headers=self._auth(user))
+        ok = response.status_code == 200 and response.json().get("success") is True
+        recorder.add("chat", time.perf_counter() - due, response.status_code, ok)
+
+
+    async def send(self, operation, recorder, due):
+        user = self.rng.choice(self.users)
+        try:
+            await getattr(self, operation)(user, recorder, due)
+        except httpx.HTTPError as e:
+            recorder.add(operation, time.perf_counter() - due, type(e).__name__, False)
+
+
+    def _auth(self, user):
+        return {"Authorization": f"Bearer {self.tokens[user]}"}
+
+
+async def closed_loop(work, mix, recorder, concurrency, until, rng):
+    names, weights = list(mix), list(mix.values())
+
+    async def virtual_user():
+        while time.perf_counter() < until:
+            await work.send(rng.choices(names, weights)[0], recorder, time.perf_counter())
+
+    await asyncio.gather(*(virtual_user() for _ in range(concurrency)))
+
+
+async def open_loop(work, mix, recorder, rate, until, max_in_flight, rng):
+    names, weights = list(mix), list(mix.values())
+    in_flight = set()
+    due = time.perf_counter()
+    while True:
+        due += rng.expovariate(rate)
+        if due >= until:
+            break
+        await asyncio.sleep(max(0.0, due - time.perf_counter()))
+        if len(in_flight) >= max_in_flight:
+            # the harness itself is saturated, count it rather than queue without bound
+            recorder.dropped += 1
+            continue
+        task = asyncio.create_task(work.send(rng.choices(names, weights)[0], recorder, due))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    await asyncio.gather(*in_flight)
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    secret_key = args.secret_key or secrets.token_hex(32)
+    with tempfile.TemporaryDirectory(prefix="benny-load-") as directory:
+        started_services = None
+        backend_url, ai_url = args.backend_url, args.ai_url
+        if not (backend_url and ai_url):
+            started_services = services(directory, secret_key, args.stub_latency_ms, args.stub_error_rate,
+                                        args.seed)
+            await started_services.start()
+            backend_url, ai_url = started_services.backend_url, started_services.ai_url
+        try:
+            limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+            timeout = httpx.Timeout(args.timeout)
+            async with httpx.AsyncClient(base_url=backend_url, limits=limits, timeout=timeout) as backend, \
+                       httpx.AsyncClient(base_url=ai_url, limits=limits, timeout=timeout) as ai:
+                work = workload(backend, ai, args.users, secret_key, args.follow_recommendations, rng)
+
+                if args.warmup:
+                    await closed_loop(work, args.mix, recorder(), min(args.concurrency, 4),
+                                      time.perf_counter() + args.warmup, rng)
+
+                results = recorder()
+                started = time.perf_counter()
+                until = started + args.duration
+                if args.rate:
+                    await open_loop(work, args.mix, results, args.rate, until, args.max_in_flight, rng)
+                else:
+                    await closed_loop(work, args.mix, results, args.concurrency, until, rng)
+                elapsed = time.perf_counter() - started
+        finally:
+            if started_services is not None:
+                started_services.stop()
+
+    report = {
+        "config": {
+            "mode": "open" if args.rate else "closed",
+            "rate": args.rate,
+            "concurrency": None if args.rate else args.concurrency,
+            "duration_s": args.duration,
+            "mix": args.mix,
+            "users": args.users,
+            "follow_recommendations": args.follow_recommendations,
+            "stub_latency_ms": None if args.backend_url else args.stub_latency_ms,
+            "stub_error_rate": None if args.backend_url else args.stub_error_rate,
+            "seed": args.seed,
+        },
+        "elapsed_s": round(elapsed, 3),
+    }
+    report.update(results.report(elapsed))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Benny check-in and chat flows")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of unmeasured load first")
+    parser.add_argument("--concurrency", type=int, default=16, help="virtual users in the closed loop")
+    parser.add_argument("--rate", type=float, help="requests per second, switches to the open loop")
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="open loop requests outstanding before arrivals are dropped")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"operation weights, default {DEFAULT_MIX}")
+    parser.add_argument("--users", type=int, default=50, help="distinct user ids")
+    parser.add_argument("--follow-recommendations", action="store_true",
+                        help="also time each check-in until its recommendation is stored")
+    parser.add_argument("--timeout", type=float, default=60, help="per request timeout in seconds")
+    parser.add_argument("--stub-latency-ms", type=float, default=300, help="mean stub LLM latency")
+    parser.add_argument("--stub-error-rate", type=float, default=0.0, help="share of stub LLM calls that fail")
+    parser.add_argument("--backend-url", help="use a running backend instead of starting one")
+    parser.add_argument("--ai-url", help="use a running AI service instead of starting one")
+    parser.add_argument("--secret-key", help="the backend's SECRET_KEY, needed with --backend-url")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    parser.add_argument("--max-error-rate", type=float,
+                        help="exit with status 1 if the overall error rate is higher, for CI")
+    args = parser.parse_args()
+    if bool(args.backend_url) != bool(args.ai_url):
+        parser.error("--backend-url and --ai-url go together")
+    if args.backend_url and not args.secret_key:
+        parser.error("--secret-key is needed to sign tokens for a running backend")
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        pathlib.Path(args.output).write_text(text + "\n")
+    if args.max_error_rate is not None and report["total"]["error_rate"] > args.max_error_rate:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()